@@ -0,0 +1,68 @@
+"""
+Benchmark del kernel di aggregazione del CE (services/riclassifica.py).
+
+  somma_matrice  vs pivot_table  : cubo conti × mesi dai movimenti
+  _raggruppa     vs groupby.sum  : righe del cubo raggruppate per voce
+
+Uso (dalla radice del repository):
+    python benchmarks/bench_aggregazione.py [righe ...]
+Default: 100k, 1M e 10M movimenti su 2.000 conti × 36 mesi, 40 voci.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.riclassifica import somma_matrice, _raggruppa  # noqa: E402
+
+N_CONTI, N_MESI, N_VOCI = 2000, 36, 40
+
+
+def _tempo(fn, ripetizioni=3):
+    migliore = float('inf')
+    for _ in range(ripetizioni):
+        t = time.perf_counter()
+        risultato = fn()
+        migliore = min(migliore, time.perf_counter() - t)
+    return risultato, migliore
+
+
+def bench_cubo(n, rng):
+    conti = rng.integers(0, N_CONTI, n).astype(np.int32)
+    mesi  = rng.integers(0, N_MESI, n).astype(np.int32)
+    valori = rng.normal(size=n)
+    df = pd.DataFrame({'conto': conti, 'mese': mesi, 'valore': valori})
+    pivot, t_pivot = _tempo(lambda: pd.pivot_table(
+        df, values='valore', index='conto', columns='mese', aggfunc='sum', fill_value=0))
+    kernel, t_kernel = _tempo(lambda: somma_matrice(conti, mesi, valori, N_CONTI, N_MESI))
+    assert np.allclose(pivot.to_numpy(), kernel)
+    return t_pivot, t_kernel
+
+
+def bench_voci(rng):
+    cubo = pd.DataFrame(rng.normal(size=(N_CONTI, N_MESI)))
+    voce = pd.Series(rng.integers(0, N_VOCI, N_CONTI)).map('Voce {:02d}'.format)
+    base, t_groupby = _tempo(lambda: cubo.groupby(voce.to_numpy()).sum())
+    kernel, t_kernel = _tempo(lambda: _raggruppa(cubo, voce, '_voce_label'))
+    assert np.allclose(base.to_numpy(), kernel.to_numpy())
+    return t_groupby, t_kernel
+
+
+def main(righe):
+    rng = np.random.default_rng(0)
+    print('Cubo conti × mesi ({} conti × {} mesi)'.format(N_CONTI, N_MESI))
+    for n in righe:
+        t_pivot, t_kernel = bench_cubo(n, rng)
+        print('  {:>12,} righe  pivot_table {:8.1f} ms  somma_matrice {:7.1f} ms  x{:.1f}'.format(
+            n, t_pivot * 1000, t_kernel * 1000, t_pivot / t_kernel))
+    t_groupby, t_kernel = bench_voci(rng)
+    print('Voci dal cubo ({} conti → {} voci)'.format(N_CONTI, N_VOCI))
+    print('  groupby.sum {:7.2f} ms  _raggruppa {:7.2f} ms  x{:.1f}'.format(
+        t_groupby * 1000, t_kernel * 1000, t_groupby / t_kernel))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [100_000, 1_000_000, 10_000_000])
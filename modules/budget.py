@@ -3,7 +3,8 @@ import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go
 import numpy as np
-from services.data_utils import get_cliente, save_cliente, fmt_eur
+from services.data_utils import get_cliente, save_cliente, fmt_eur, stato_upload, segna_upload
+from services.riclassifica import label_mese, anni_disponibili, mesi_anno
 
 
 def render_budget():
@@ -15,10 +16,11 @@ def render_budget():
     if df_db is None or not cliente.get('mapping'):
         st.info("Carica i dati e configura la mappatura prima di usare il Budget."); return
 
-    from services.riclassifica import costruisci_ce_riclassificato, get_mesi_disponibili
+    from services.ce_cache import costruisci_ce_in_cache
+    from services.riclassifica import get_mesi_disponibili
     schema_att = cliente.get('schema_attivo', '')
     schema_cfg = cliente.get('schemi', {}).get(schema_att, {})
-    pivot, _, errore = costruisci_ce_riclassificato(
+    pivot, _, errore = costruisci_ce_in_cache(
         df_db, cliente.get('df_piano'), cliente.get('df_ricl'),
         cliente.get('mapping', {}), schema_cfg, cliente.get('rettifiche', [])
     )
@@ -60,7 +62,7 @@ def _render_crea(cliente, pivot, mesi, ca, budget, voci, cols_mesi):
         "📂 Carica da file CSV/Excel"
     ], key="bud_metodo", horizontal=False)
 
-    anni = sorted(set(m[:4] for m in mesi), reverse=True)
+    anni = anni_disponibili(mesi)
 
     if "precedente" in metodo:
         if len(anni) < 2:
@@ -75,13 +77,14 @@ def _render_crea(cliente, pivot, mesi, ca, budget, voci, cols_mesi):
             with c3:
                 st.markdown("<br>", unsafe_allow_html=True)
                 if st.button("⚡ Genera", type="primary"):
-                    cols_base = [c for c in pivot.columns if c.startswith(str(anno_base))]
+                    cols_base = mesi_anno(cols_mesi, anno_base)
                     mult = 1 + var / 100
                     bud_new = {}
                     for voce in voci:
                         bud_new[voce] = {}
                         for m in cols_base:
-                            target_m = m.replace(str(anno_base), str(int(anno_base)+1))
+                            # Il budget resta indicizzato per 'AAAA-MM' (formato del file budget)
+                            target_m = label_mese(m + 100)
                             v = float(pivot.loc[voce, m]) if m in pivot.columns else 0
                             bud_new[voce][target_m] = round(v * mult, 2)
                     save_cliente({'budget': bud_new})
@@ -90,7 +93,7 @@ def _render_crea(cliente, pivot, mesi, ca, budget, voci, cols_mesi):
 
     elif "manuale" in metodo:
         anno_bud = st.selectbox("Anno:", anni, key="bud_anno_man")
-        mesi_a   = sorted([m for m in cols_mesi if m.startswith(str(anno_bud))])
+        mesi_a   = mesi_anno(cols_mesi, anno_bud)
         if not mesi_a:
             st.info("Nessun dato per l'anno selezionato.")
             return
@@ -103,13 +106,14 @@ def _render_crea(cliente, pivot, mesi, ca, budget, voci, cols_mesi):
                 for i, mese in enumerate(mesi_a):
                     with cols[i % ncols]:
                         eff = float(pivot.loc[voce, mese]) if mese in pivot.columns else 0
+                        lbl = label_mese(mese)
                         v   = st.number_input(
-                            mese, value=float(bud_tmp[voce].get(mese, 0)),
+                            lbl, value=float(bud_tmp[voce].get(lbl, 0)),
                             step=1000.0, format="%.0f",
                             help=f"Effettivo: {fmt_eur(eff)}",
-                            key=f"bud_{voce}_{mese}"
+                            key=f"bud_{voce}_{lbl}"
                         )
-                        bud_tmp[voce][mese] = v
+                        bud_tmp[voce][lbl] = v
 
         if st.button("💾 Salva Budget", type="primary"):
             save_cliente({'budget': bud_tmp})
@@ -123,7 +127,12 @@ Voce;2024-01;2024-02;...
 Ricavi vendite;100000;120000;...
 ```""")
         f = st.file_uploader("Carica file:", type=['csv','xlsx'], key="bud_file_up")
-        if f:
+        esito = stato_upload(f, "bud_file_up") if f else None
+        if esito is False:
+            st.error("Errore: file budget non leggibile.")
+        elif f and esito is None:
+            # Import una sola volta: dopo st.rerun() il file è ancora nell'uploader
+            segna_upload("bud_file_up", False)
             try:
                 if f.name.endswith('.xlsx'):
                     df_b = pd.read_excel(f, index_col=0, dtype=str)
@@ -140,6 +149,7 @@ Ricavi vendite;100000;120000;...
                         except Exception:
                             pass
                 save_cliente({'budget': bud_new})
+                segna_upload("bud_file_up", True)
                 st.success(f"✅ Budget caricato: {len(bud_new)} voci")
                 st.rerun()
             except Exception as e:
@@ -165,12 +175,12 @@ def _render_scostamenti(pivot, budget, cols_mesi, voci):
             continue
         for m in cols_mesi:
             eff = float(pivot.loc[voce, m]) if m in pivot.columns else 0
-            bud = budget[voce].get(m, 0)
+            bud = budget[voce].get(label_mese(m), 0)
             if bud == 0:
                 continue
             sc  = eff - bud
             pct = sc / abs(bud) * 100
-            rows.append({'Voce': voce, 'Mese': m, 'Effettivo': eff, 'Budget': bud, 'Scostamento': sc, 'Sc%': pct})
+            rows.append({'Voce': voce, 'Mese': label_mese(m), 'Effettivo': eff, 'Budget': bud, 'Scostamento': sc, 'Sc%': pct})
 
     if not rows:
         st.info("Nessun dato di confronto disponibile.")
@@ -270,7 +280,7 @@ def _alert_intelligenti(pivot, budget, cols_mesi, voci) -> list:
         sc_list = []
         for m in cols_mesi:
             eff = float(pivot.loc[voce, m]) if m in pivot.columns else 0
-            bud = budget[voce].get(m, 0)
+            bud = budget[voce].get(label_mese(m), 0)
             if bud != 0:
                 sc_list.append((eff - bud) / abs(bud) * 100)
         if len(sc_list) < 2:
@@ -283,7 +293,7 @@ def _alert_intelligenti(pivot, budget, cols_mesi, voci) -> list:
 
         ultimo_m = cols_mesi[-1]
         eff_u = float(pivot.loc[voce, ultimo_m]) if ultimo_m in pivot.columns else 0
-        bud_u = budget[voce].get(ultimo_m, 0)
+        bud_u = budget[voce].get(label_mese(ultimo_m), 0)
         if bud_u == 0:
             continue
         sc_u = (eff_u - bud_u) / abs(bud_u) * 100
@@ -291,7 +301,7 @@ def _alert_intelligenti(pivot, budget, cols_mesi, voci) -> list:
         if abs(sc_u) >= soglia:
             alerts.append({
                 'voce': voce,
-                'mese': ultimo_m,
+                'mese': label_mese(ultimo_m),
                 'sc_pct': sc_u,
                 'tipo': 'NEG' if sc_u < 0 else 'POS',
                 'motivo': f"Scostamento {sc_u:+.1f}% supera soglia adattiva {soglia:.1f}% (media±1.5σ su {len(finestra)} periodi)"
@@ -24,9 +24,10 @@ import plotly.express as px
 from datetime import datetime
 from services.data_utils import get_cliente, save_cliente, get_api_key, fmt_eur, fmt_pct, fmt_k
 from services.riclassifica import (
-    costruisci_ce_riclassificato, get_mesi_disponibili,
-    calcola_kpi_finanziari, calcola_trend, calcola_statistiche_mensili
+    get_mesi_disponibili, calcola_kpi_finanziari, calcola_trend, calcola_statistiche_mensili,
+    label_mese, anni_disponibili, mesi_anno, mesi_corrispondenti, CEResult
 )
+from services.ce_cache import costruisci_ce_in_cache
 from services.report_generator import (
     format_ce_for_prompt, format_kpi_for_prompt,
     format_budget_variance_for_prompt, wrap_report
@@ -67,7 +68,7 @@ PLOTLY_THEME = dict(
 def _anno_selectbox(label, anni_dati, key, include_none_label=None, extra_range=3):
     """
     Selectbox anno con range esteso oltre i dati disponibili.
-    anni_dati: anni ricavati dai dati (es. ['2024','2023'])
+    anni_dati: anni ricavati dai dati (es. [2024, 2023])
     extra_range: quanti anni aggiungere oltre il massimo dei dati
     """
     from datetime import datetime
@@ -95,7 +96,7 @@ def _anno_selectbox(label, anni_dati, key, include_none_label=None, extra_range=
     sel = st.selectbox(label, options, index=default_idx, key=key, label_visibility="collapsed")
     if sel == include_none_label:
         return None
-    return sel.rstrip(" ↩")  # ritorna l'anno pulito senza il marker
+    return int(sel.rstrip(" ↩"))  # ritorna l'anno pulito senza il marker
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -129,7 +130,7 @@ def render_cfo_agent():
     budget     = cliente.get('budget', {})
 
     with st.spinner("⚙️ Elaborazione dati finanziari in corso…"):
-        pivot, dettaglio, errore = costruisci_ce_riclassificato(
+        pivot, dettaglio, errore = costruisci_ce_in_cache(
             df_db, df_piano, df_ricl, mapping, schema_cfg, rettifiche
         )
 
@@ -189,6 +190,8 @@ def render_cfo_agent():
 
 def _pval(pivot, voce, col, default=0.0):
     """Estrae scalare float sicuro da pivot (gestisce Series da label duplicati)."""
+    if isinstance(pivot, CEResult):
+        return pivot.valore(voce, col, default)
     if col not in pivot.columns:
         return default
     try:
@@ -202,6 +205,8 @@ def _pval(pivot, voce, col, default=0.0):
 
 def _is_sep(pivot, voce):
     """True se la riga è un separatore."""
+    if isinstance(pivot, CEResult):
+        return pivot.tipo(voce) == 'separatore'
     if '_tipo' not in pivot.columns:
         return False
     try:
@@ -223,7 +228,7 @@ def _render_auto_kpi_dashboard(pivot, mesi, budget, ca, schema_cfg=None):
         mode = st.selectbox("Periodo:", ["Ultimo mese", "Ultimi 3 mesi", "Ultimi 6 mesi", "YTD", "Anno completo"],
                              key="kpi_dash_mode", label_visibility="collapsed")
     with c2:
-        anni = sorted(set(m[:4] for m in mesi), reverse=True)
+        anni = anni_disponibili(mesi)
         if mode in ["YTD", "Anno completo"]:
             anno = _anno_selectbox("Anno", anni, "kpi_anno")
         else:
@@ -241,9 +246,9 @@ def _render_auto_kpi_dashboard(pivot, mesi, budget, ca, schema_cfg=None):
     elif mode == "Ultimi 6 mesi":
         mesi_sel = mesi[-6:]
     elif mode == "YTD":
-        mesi_sel = [m for m in mesi if m.startswith(str(anno))]
+        mesi_sel = mesi_anno(mesi, anno)
     else:  # Anno completo
-        mesi_sel = [m for m in mesi if m.startswith(str(anno))]
+        mesi_sel = mesi_anno(mesi, anno)
 
     cols_sel = [c for c in mesi_sel if c in pivot.columns]
     if not cols_sel:
@@ -254,9 +259,8 @@ def _render_auto_kpi_dashboard(pivot, mesi, budget, ca, schema_cfg=None):
 
     # Confronto
     kpi_conf = {}
-    if anno_conf != "— nessun confronto —":
-        mesi_num = {m[5:] for m in mesi_sel}
-        cols_conf = [c for c in pivot.columns if c[:4] == anno_conf and c[5:] in mesi_num and c not in ('_tipo','_cod','TOTALE')]
+    if anno_conf is not None:
+        cols_conf = [c for c in mesi_corrispondenti(mesi_sel, anno_conf) if c in pivot.columns]
         if cols_conf:
             kpi_conf = calcola_kpi_finanziari(pivot, cols_conf, schema_cfg)
 
@@ -264,7 +268,7 @@ def _render_auto_kpi_dashboard(pivot, mesi, budget, ca, schema_cfg=None):
     bud_kpi = {}
     if show_budget_kpi and budget:
         for voce, vals in budget.items():
-            bud_kpi[voce] = sum(vals.get(m, 0) for m in mesi_sel)
+            bud_kpi[voce] = sum(vals.get(label_mese(m), 0) for m in mesi_sel)
 
     # ── KPI CARDS ─────────────────────────────────────────────────────────────
     def kpi_card(label, value, unit, color, icon, conf_val=None, bud_val=None, benchmark=None):
@@ -340,7 +344,7 @@ def _render_auto_kpi_dashboard(pivot, mesi, budget, ca, schema_cfg=None):
         for i, voce in enumerate(voci_spark[:3]):
             vals = [_pval(pivot, voce, m) for m in all_mesi_plot]
             fig.add_trace(go.Scatter(
-                x=all_mesi_plot, y=vals, name=str(voce)[:25],
+                x=[label_mese(m) for m in all_mesi_plot], y=vals, name=str(voce)[:25],
                 mode='lines', line=dict(color=colors_spark[i], width=2),
                 fill='tozeroy',
                 fillcolor=f"rgba({','.join(str(int(colors_spark[i].lstrip('#')[j:j+2], 16)) for j in (0,2,4))}, 0.06)",
@@ -488,7 +492,7 @@ def _render_chat(ca, cliente, pivot, mesi, budget, schema_cfg=None):
                 kpi_m = calcola_kpi_finanziari(pivot, [m], schema_cfg)
                 if kpi_m:
                     kpi_trend.append(
-                        f"{m}: Ricavi={kpi_m.get('ricavi',0):,.0f}€ "
+                        f"{label_mese(m)}: Ricavi={kpi_m.get('ricavi',0):,.0f}€ "
                         f"EBITDA={kpi_m.get('ebitda',0):,.0f}€ "
                         f"EBITDA%={kpi_m.get('ebitda_margin',0):.1f}%"
                     )
@@ -515,7 +519,7 @@ def _render_chat(ca, cliente, pivot, mesi, budget, schema_cfg=None):
                     if abs(delta) > 100:  # Soglia minima
                         delta_rows.append(
                             f"  {voce[:35]:35s}: {delta:+,.0f}€ ({delta_pct:+.1f}%) "
-                            f"[{m_prev} → {m_curr}]"
+                            f"[{label_mese(m_prev)} → {label_mese(m_curr)}]"
                         )
                 if delta_rows:
                     context_parts.append(
@@ -527,7 +531,7 @@ def _render_chat(ca, cliente, pivot, mesi, budget, schema_cfg=None):
             context_parts.append("## SETTORE AZIENDALE\n" + settore)
         if note_az:
             context_parts.append("## NOTE AZIENDA\n" + note_az)
-        context_parts.append("## PERIODO ANALISI\n" + " → ".join([mesi_ctx[0], mesi_ctx[-1]]))
+        context_parts.append("## PERIODO ANALISI\n" + " → ".join([label_mese(mesi_ctx[0]), label_mese(mesi_ctx[-1])]))
 
         context = "\n\n".join(context_parts)
 
@@ -623,7 +627,7 @@ def _render_visual_analytics(pivot, mesi, budget, schema_cfg=None):
             for voce in voci_sel:
                 for m in mesi_p:
                     if m in pivot.columns:
-                        rows_data.append({'Mese': m, 'Voce': str(voce)[:30], 'Importo': _pval(pivot, voce, m)})
+                        rows_data.append({'Mese': label_mese(m), 'Voce': str(voce)[:30], 'Importo': _pval(pivot, voce, m)})
             df_m = pd.DataFrame(rows_data)
 
             PALETTE = ['#3B82F6', '#10B981', '#C9A84C', '#EF4444', '#8B5CF6', '#F59E0B', '#06B6D4', '#EC4899']
@@ -646,7 +650,7 @@ def _render_visual_analytics(pivot, mesi, budget, schema_cfg=None):
                 voce_wf = voci_sel[0]
                 vals_wf = [_pval(pivot, voce_wf, m) for m in mesi_p]
                 fig = go.Figure(go.Waterfall(
-                    orientation='v', x=mesi_p, y=vals_wf,
+                    orientation='v', x=[label_mese(m) for m in mesi_p], y=vals_wf,
                     connector=dict(line=dict(color='rgba(255,255,255,0.1)', width=1)),
                     increasing=dict(marker=dict(color=C['green'], line=dict(width=0))),
                     decreasing=dict(marker=dict(color=C['red'], line=dict(width=0))),
@@ -675,7 +679,7 @@ def _render_visual_analytics(pivot, mesi, budget, schema_cfg=None):
                 hm_norm = hm.div(hm.abs().max(axis=1).replace(0, 1), axis=0)
                 fig_hm = go.Figure(go.Heatmap(
                     z=hm_norm.values,
-                    x=list(hm_norm.columns),
+                    x=[label_mese(m) for m in hm_norm.columns],
                     y=[str(v)[:30] for v in hm_norm.index],
                     colorscale=[[0,'#EF4444'],[0.5,'#1E3A6E'],[1,'#10B981']],
                     text=[[f"{v:,.0f}€" for v in row] for row in hm.values],
@@ -699,16 +703,16 @@ def _render_visual_analytics(pivot, mesi, budget, schema_cfg=None):
         Seleziona il periodo di riferimento (attuale) e quello di confronto (precedente).
         </div>""", unsafe_allow_html=True)
 
-        anni = sorted(set(m[:4] for m in mesi), reverse=True)
+        anni = anni_disponibili(mesi)
         c1, c2 = st.columns(2)
         with c1:
             anno_att = _anno_selectbox("Periodo attuale", anni, "bridge_att")
-            mesi_att = [m for m in mesi if m.startswith(str(anno_att))]
+            mesi_att = mesi_anno(mesi, anno_att)
         with c2:
             altri_anni = [a for a in anni if a != anno_att]
             if True:
                 anno_prec = _anno_selectbox("Confronto", anni, "bridge_prec", include_none_label="— nessun confronto —")
-                mesi_prec = [m for m in mesi if m.startswith(str(anno_prec))]
+                mesi_prec = mesi_anno(mesi, anno_prec) if anno_prec is not None else []
             else:
                 # Splitta l'anno in S1 e S2
                 mid = len(mesi_att)//2
@@ -818,7 +822,7 @@ def _render_visual_analytics(pivot, mesi, budget, schema_cfg=None):
                 ]:
                     v = kpi_m.get(k)
                     if v is not None:
-                        margin_data.append({'Mese': m, 'KPI': label, 'Valore': v})
+                        margin_data.append({'Mese': label_mese(m), 'KPI': label, 'Valore': v})
 
             if margin_data:
                 df_marg = pd.DataFrame(margin_data)
@@ -881,7 +885,8 @@ def _render_visual_analytics(pivot, mesi, budget, schema_cfg=None):
         st.markdown("##### 🥧 Composizione CE — Struttura dei Costi e Ricavi")
         c1, c2 = st.columns(2)
         with c1:
-            mese_comp = st.selectbox("Mese di riferimento:", mesi, index=len(mesi)-1, key="comp_mese")
+            mese_comp = st.selectbox("Mese di riferimento:", mesi, index=len(mesi)-1, key="comp_mese",
+                                     format_func=label_mese)
         with c2:
             soglia_pct = st.slider("Soglia minima (%):", 0.5, 10.0, 2.0, 0.5, key="comp_soglia")
 
@@ -930,8 +935,8 @@ def _render_visual_analytics(pivot, mesi, budget, schema_cfg=None):
             BLUES  = ['#1E3A6E','#2563EB','#3B82F6','#60A5FA','#93C5FD','#BFDBFE']
             REDS   = ['#7F1D1D','#DC2626','#EF4444','#F87171','#FCA5A5','#FECACA']
 
-            fig_pos = make_pie(pos, tot_pos, f"Voci Positive — {mese_comp}", BLUES)
-            fig_neg = make_pie(neg, tot_neg, f"Voci Negative — {mese_comp}", REDS)
+            fig_pos = make_pie(pos, tot_pos, f"Voci Positive — {label_mese(mese_comp)}", BLUES)
+            fig_neg = make_pie(neg, tot_neg, f"Voci Negative — {label_mese(mese_comp)}", REDS)
 
             p1, p2 = st.columns(2)
             if fig_pos:
@@ -961,7 +966,7 @@ def _render_report_gen(ca, cliente, pivot, mesi, budget, schema_cfg=None):
     settore   = cfo_cfg.get('settore', '')
     note_az   = cfo_cfg.get('note_azienda', '')
     targets   = cfo_cfg.get('kpi_targets', {})
-    anni_disp = sorted(set(m[:4] for m in mesi), reverse=True)
+    anni_disp = anni_disponibili(mesi)
 
     # ── Config ────────────────────────────────────────────────────────────────
     c1, c2, c3, c4 = st.columns([2, 2, 2, 1])
@@ -976,9 +981,10 @@ def _render_report_gen(ca, cliente, pivot, mesi, budget, schema_cfg=None):
     with c2:
         if "Annuale" in tipo_report or "Board" in tipo_report:
             anno = _anno_selectbox("Anno", anni_disp, "rpt_anno")
-            mesi_sel = [m for m in mesi if m.startswith(str(anno))]
+            mesi_sel = mesi_anno(mesi, anno)
         else:
-            mese_sel = st.selectbox("Mese:", mesi, index=len(mesi)-1, key="rpt_mese")
+            mese_sel = st.selectbox("Mese:", mesi, index=len(mesi)-1, key="rpt_mese",
+                                    format_func=label_mese)
             mesi_sel = [mese_sel]
     with c3:
         settore_ov = st.text_input("Settore:", value=settore, placeholder="es. Manifattura", key="rpt_sett")
@@ -986,7 +992,7 @@ def _render_report_gen(ca, cliente, pivot, mesi, budget, schema_cfg=None):
         st.markdown("<br>", unsafe_allow_html=True)
         genera = st.button("🚀 Genera", type="primary", use_container_width=True)
 
-    periodo_label = mesi_sel[0] if len(mesi_sel) == 1 else f"{mesi_sel[0]}→{mesi_sel[-1]}"
+    periodo_label = label_mese(mesi_sel[0]) if len(mesi_sel) == 1 else f"{label_mese(mesi_sel[0])}→{label_mese(mesi_sel[-1])}"
 
     if genera:
         api_key = get_api_key()
@@ -1003,8 +1009,8 @@ def _render_report_gen(ca, cliente, pivot, mesi, budget, schema_cfg=None):
         bud_text   = format_budget_variance_for_prompt(pivot, budget, cols_sel) if budget else ""
 
         # Anno precedente
-        anno_num  = int(mesi_sel[0][:4])
-        mesi_prec = [m.replace(str(anno_num), str(anno_num-1)) for m in mesi_sel]
+        anno_num  = mesi_sel[0] // 100
+        mesi_prec = mesi_corrispondenti(mesi_sel, anno_num - 1)
         cols_prec = [c for c in mesi_prec if c in pivot.columns]
         ap_text   = format_ce_for_prompt(pivot, cols_prec) if cols_prec else ""
 
@@ -1310,7 +1316,7 @@ def _calcola_anomalie_avanzate(pivot, budget, mesi, n_finestra) -> list:
 
         # ─ Budget alert intelligente ────────────────────────────────────────
         if budget and voce in budget:
-            bud_ult = budget[voce].get(mesi_an[-1] if mesi_an else '', 0)
+            bud_ult = budget[voce].get(label_mese(mesi_an[-1]) if mesi_an else '', 0)
             if bud_ult != 0:
                 scost = (ultimo - bud_ult) / abs(bud_ult) * 100
                 # Soglia dinamica basata su CV storico
@@ -1332,7 +1338,7 @@ def _calcola_anomalie_avanzate(pivot, budget, mesi, n_finestra) -> list:
 def _render_trend_chart_with_bands(pivot, voce, mesi):
     """Visualizza trend con banda di confidenza ±2σ."""
     vals  = [_pval(pivot, voce, m) for m in mesi if m in pivot.columns]
-    mesi_v = [m for m in mesi if m in pivot.columns]
+    mesi_v = [label_mese(m) for m in mesi if m in pivot.columns]
     if not vals:
         return
 
@@ -1,6 +1,7 @@
 """clienti.py — Gestione parco clienti."""
 import streamlit as st
 from services.data_utils import get_cliente, save_cliente
+from services.ce_cache import svuota_cache_ce
 
 
 def render_clienti():
@@ -58,6 +59,7 @@ def render_clienti():
             st.rerun()
         if col_d.button("✕", key=f"del_{nome}", help="Elimina cliente"):
             del st.session_state['clienti'][nome]
+            svuota_cache_ce(nome)
             if ca == nome:
                 remaining = list(st.session_state['clienti'].keys())
                 st.session_state['cliente_attivo'] = remaining[0] if remaining else None
@@ -5,7 +5,7 @@ Supporta: import schema da file, voci contabili, subtotali calcolati, totali, se
 import streamlit as st
 import pandas as pd
 from services.data_utils import get_cliente, save_cliente, find_column, smart_load
-from services.riclassifica import get_label_map
+from services.riclassifica import get_label_map, compila_schema
 
 C = {
     'gold':   '#C9A84C',
@@ -389,6 +389,7 @@ def render_configurazione():
                             """<div style='font-size:0.75rem;color:#475569;margin-bottom:6px'>
                             Usa i <b>codici voce</b> come variabili (es. <code>A01 + B02 * 0.5</code>).<br>
                             Operatori: <code>+ - * / ( )</code> — numeri costanti supportati.<br>
+                            Si possono usare voci contabili, formule, subtotali e totali in qualsiasi posizione dello schema.<br>
                             Esempio: <code>(B6 + B6.1) / A01 * 100</code>
                             </div>""", unsafe_allow_html=True)
                         formula_val = st.text_input(
@@ -423,6 +424,10 @@ def render_configurazione():
                     for v in voci_ordinate if config.get(v, {}).get('kpi_role')
                 ))
 
+            # ── VERIFICA FORMULE (sintassi, voci sconosciute, cicli) ──────
+            for cod_err, msg_err in compila_schema(config_updated, label_map)['errori_formule']:
+                st.warning(f"🧮 Formula {cod_err}: {msg_err}")
+
             # Salva
             st.markdown("---")
             if st.button("💾 Salva Configurazione", type="primary", key="save_conf"):
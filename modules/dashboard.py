@@ -9,9 +9,10 @@ import plotly.graph_objects as go
 import plotly.express as px
 from services.data_utils import get_cliente, fmt_eur, fmt_pct
 from services.riclassifica import (
-    costruisci_ce_riclassificato, get_mesi_disponibili,
-    calcola_kpi_finanziari, _safe_scalar, _safe_str,
+    get_mesi_disponibili, calcola_kpi_finanziari,
+    label_mese, anni_disponibili, mesi_anno, mesi_corrispondenti,
 )
+from services.ce_cache import costruisci_ce_in_cache
 
 PALETTE = ['#1A3A7A','#10B981','#C9A84C','#EF4444','#8B5CF6',
            '#F59E0B','#06B6D4','#EC4899','#14B8A6','#6366F1']
@@ -67,7 +68,7 @@ def render_dashboard():
         return
 
     with st.spinner("⚙️ Elaborazione dati…"):
-        pivot, dettaglio, errore = costruisci_ce_riclassificato(
+        pivot, dettaglio, errore = costruisci_ce_in_cache(
             df_db, df_piano, df_ricl, mapping, schema_cfg, rettifiche
         )
 
@@ -94,56 +95,53 @@ def render_dashboard():
         with c1:
             modalita = st.selectbox("Periodo", ["Mese singolo","Range mesi","YTD","Anno completo"], key="d_mod")
         with c2:
-            anni = sorted(set(m[:4] for m in mesi), reverse=True)
+            anni = anni_disponibili(mesi)
             if modalita == "Mese singolo":
-                mese_s = st.selectbox("Mese", mesi, index=len(mesi)-1, key="d_mese")
+                mese_s = st.selectbox("Mese", mesi, index=len(mesi)-1, key="d_mese",
+                                      format_func=label_mese)
                 mesi_filtro = [mese_s]
             elif modalita == "Range mesi":
-                sel = st.multiselect("Mesi", mesi, default=mesi[-3:], key="d_range")
-                mesi_filtro = sel or mesi[-3:]
+                sel = st.multiselect("Mesi", mesi, default=mesi[-3:], key="d_range",
+                                     format_func=label_mese)
+                mesi_filtro = sorted(sel) or mesi[-3:]
             elif modalita == "YTD":
                 anno_y = st.selectbox("Anno", anni, key="d_ytd")
-                mesi_filtro = [m for m in mesi if m.startswith(str(anno_y))]
+                mesi_filtro = mesi_anno(mesi, anno_y)
             else:
                 anno_y = st.selectbox("Anno", anni, key="d_ay")
-                mesi_filtro = [m for m in mesi if m.startswith(str(anno_y))]
+                mesi_filtro = mesi_anno(mesi, anno_y)
         with c3:
             from datetime import datetime as _dt
-            _anno_max = max(int(a) for a in anni) if anni else _dt.now().year
-            _anni_ext = [str(a) for a in range(max(_anno_max, _dt.now().year)+2, min(int(a) for a in anni)-1 if anni else _dt.now().year-4, -1)]
-            _anni_opt_labels = [a if a in anni else a+" ↩" for a in _anni_ext]
-            _conf_raw = st.selectbox("Confronta vs", ['— nessuno —'] + _anni_opt_labels, key="d_conf")
-            anno_conf = _conf_raw.rstrip(" ↩") if _conf_raw != '— nessuno —' else '— nessuno —' 
+            _anno_max = max(anni) if anni else _dt.now().year
+            _anni_ext = list(range(max(_anno_max, _dt.now().year)+2, min(anni)-1 if anni else _dt.now().year-4, -1))
+            _conf_raw = st.selectbox("Confronta vs", ['— nessuno —'] + _anni_ext, key="d_conf",
+                                     format_func=lambda a: str(a) if a == '— nessuno —' or a in anni else "{} ↩".format(a))
+            anno_conf = _conf_raw 
         with c4:
             mostra_bud = st.checkbox("Budget", value=bool(budget), key="d_bud")
 
-    cols_filtro = [c for c in mesi_filtro if c in pivot.columns]
+    cols_filtro = [c for c in mesi_filtro if pivot.colonna(c) is not None]
     if not cols_filtro:
         st.warning("Nessun dato per il periodo."); return
 
-    # Build pf conservando _tipo
-    pf_cols  = [c for c in cols_filtro if c in pivot.columns]
-    meta_cols = [c for c in ('_tipo', '_cod') if c in pivot.columns]
-    pf        = pivot[pf_cols + meta_cols].copy()
-    pf['_PERIODO'] = pf[pf_cols].sum(axis=1)
+    # Valori del periodo: vista sulla matrice del CE (nessuna copia), totale per riga
+    valori  = pivot.periodo(cols_filtro)
+    periodo = np.nansum(valori, axis=1)
 
-    pf_conf = None
+    # Confronto: stessi mesi nell'anno scelto (chiave - 100 per anno di distanza)
+    periodo_conf = None
+    cols_conf = []
     if anno_conf != '— nessuno —':
-        mesi_num      = {m[5:] for m in cols_filtro}
-        cols_conf_raw = [c for c in pivot.columns if c[:4] == anno_conf and c[5:] in mesi_num and c not in ('_tipo','_cod')]
-        if cols_conf_raw:
-            pf_conf = pivot[cols_conf_raw + meta_cols].copy()
-            pf_conf['_PERIODO'] = pf_conf[cols_conf_raw].sum(axis=1)
+        cols_conf = [c for c in mesi_corrispondenti(cols_filtro, anno_conf) if pivot.colonna(c) is not None]
+        if cols_conf:
+            periodo_conf = np.nansum(pivot.periodo(cols_conf), axis=1)
 
     kpi = calcola_kpi_finanziari(pivot, cols_filtro, schema_cfg)
-    kpi_conf = calcola_kpi_finanziari(pivot,
-        [c for c in pivot.columns if c[:4] == anno_conf and c[5:] in {m[5:] for m in cols_filtro} and c not in ('_tipo','_cod')],
-        schema_cfg
-    ) if anno_conf != '— nessuno —' else {}
+    kpi_conf = calcola_kpi_finanziari(pivot, cols_conf, schema_cfg) if anno_conf != '— nessuno —' else {}
 
     # ── ALERT BUDGET ────────────────────────────────────────────────────────
     if mostra_bud and budget:
-        _render_budget_alerts(pf, budget, pf_cols)
+        _render_budget_alerts(pivot, periodo, budget, cols_filtro)
 
     # ── KPI CARDS ──────────────────────────────────────────────────────────
     _render_kpi_cards(kpi, kpi_conf, anno_conf)
@@ -155,7 +153,7 @@ def render_dashboard():
     tab_ce, tab_grafici, tab_budget = st.tabs(["📋 Conto Economico", "📈 Grafici", "🎯 Budget"])
 
     with tab_ce:
-        _render_tabella_ce(ca, pf, dettaglio, pf_cols, pf_conf,
+        _render_tabella_ce(ca, pivot, valori, periodo, dettaglio, cols_filtro, periodo_conf,
                            anno_conf, mostra_bud, budget, mesi_filtro, schema_cfg)
     with tab_grafici:
         _render_grafici(pivot, mesi, kpi)
@@ -201,12 +199,16 @@ def _render_kpi_cards(kpi, kpi_conf, anno_conf):
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# CE MATRIX — colonne=mesi, righe=voci con drill-down via <details>
+# CE MATRIX — colonne=mesi, righe=voci con drill-down sulle voci scelte
 # ─────────────────────────────────────────────────────────────────────────────
 
-def _render_tabella_ce(ca, pf, dettaglio, cols_show, pf_conf,
+def _render_tabella_ce(ca, pivot, valori, periodo, dettaglio, cols_show, periodo_conf,
                         anno_conf, mostra_bud, budget, mesi_filtro, schema_cfg=None):
-    """CE Matrix con toggle JS via st.components.v1.html (Streamlit non esegue <script> in markdown)."""
+    """CE Matrix con toggle JS via st.components.v1.html (Streamlit non esegue <script> in markdown).
+    pivot = CEResult; valori = pivot.periodo(cols_show), periodo = totale per riga,
+    periodo_conf = totale per riga del periodo di confronto (o None).
+    I conti di una voce si calcolano e finiscono nell'HTML solo se la voce è
+    aperta nel selettore: la tabella base non porta righe di dettaglio."""
     import re as _re
 
     def sid(s):
@@ -227,72 +229,66 @@ def _render_tabella_ce(ca, pf, dettaglio, cols_show, pf_conf,
     # Header
     hdr = '<th class="lft">Voce</th>'
     for c in cols_show:
-        hdr += f'<th class="rgt">{c}</th>'
+        hdr += f'<th class="rgt">{label_mese(c)}</th>'
     hdr += '<th class="rgt" style="color:#C9A84C;border-left:1px solid rgba(201,168,76,0.2)">Totale</th>'
-    if pf_conf is not None:
+    if periodo_conf is not None:
         hdr += f'<th class="rgt">vs {anno_conf}</th><th class="rgt">&#916;%</th>'
     if mostra_bud and budget:
         hdr += '<th class="rgt">Budget</th><th class="rgt">Scost.</th>'
 
+    voci_det = [v for v in dict.fromkeys(pivot.etichette) if v in dettaglio]
+    aperte = set(st.multiselect(
+        "🔍 Dettaglio conti", voci_det, key=f"ce_det_{ca}",
+        placeholder="Scegli le voci da espandere nei singoli conti"))
+
     rows_html = ""
-    for voce in pf.index:
-        tipo = _safe_str(pf.loc[voce, '_tipo']) if '_tipo' in pf.columns else 'contabile'
+    n_det = 0
+    for r, (voce, tipo) in enumerate(zip(pivot.etichette, pivot.tipi)):
         if tipo == 'separatore':
             rows_html += '<tr class="sep"><td colspan="99"></td></tr>'
             continue
 
-        try:
-            val_tot = float(pf.loc[voce, '_PERIODO']) if '_PERIODO' in pf.columns else 0.0
-        except Exception:
-            val_tot = 0.0
-
-        tds = ""
-        for c in cols_show:
-            v = _safe_scalar(pf.loc[voce, c]) if c in pf.columns else 0.0
-            tds += f'<td class="rgt">{fv(v, dash=(tipo=="contabile"))}</td>'
+        val_tot = float(periodo[r])
+        tds = "".join(f'<td class="rgt">{fv(v, dash=(tipo=="contabile"))}</td>' for v in valori[r])
         tds += f'<td class="rgt tot-col"><b>{fv(val_tot)}</b></td>'
 
-        if pf_conf is not None:
-            val_c = 0.0
-            if voce in pf_conf.index and '_PERIODO' in pf_conf.columns:
-                try:
-                    val_c = _safe_scalar(pf_conf.loc[voce, '_PERIODO'])
-                except Exception:
-                    pass
+        if periodo_conf is not None:
+            val_c = float(periodo_conf[r])
             dp = (val_tot - val_c) / abs(val_c) * 100 if val_c != 0 else 0.0
             dc = "#10B981" if dp >= 0 else "#EF4444"
             dp_s = f'<span style="color:{dc}">{dp:+.1f}%</span>' if val_c != 0 else '<span style="color:#334155">—</span>'
             tds += f'<td class="rgt">{fv(val_c, dash=True)}</td><td class="rgt">{dp_s}</td>'
 
         if mostra_bud and budget:
-            bud_tot = sum(budget.get(voce, {}).get(m, 0) for m in cols_show)
+            bud_tot = sum(budget.get(voce, {}).get(label_mese(m), 0) for m in cols_show)
             scost = val_tot - bud_tot
             tds += f'<td class="rgt">{fv(bud_tot,dash=True)}</td><td class="rgt">{fv(scost,dash=True)}</td>'
 
         if tipo == 'contabile':
-            has_det = (voce in dettaglio and dettaglio[voce] is not None
-                       and not dettaglio[voce].empty)
+            n = dettaglio.n_conti(voce) if voce in dettaglio else 0
             vid = sid(voce)
-            if has_det:
-                n = len(dettaglio[voce])
+            if n and voce in aperte:
                 badge = f' <span class="nbadge">({n})</span>'
                 rows_html += (
                     f'<tr class="voce clickable" onclick="tog(\'{vid}\')">' 
-                    f'<td class="lft"><span class="arr" id="a{vid}">&#9658;</span>{voce}{badge}</td>{tds}</tr>'
+                    f'<td class="lft"><span class="arr open" id="a{vid}">&#9658;</span>{voce}{badge}</td>{tds}</tr>'
                 )
                 det = dettaglio[voce]
-                for conto in det.index:
+                n_det += len(det)
+                det_vals = det.reindex(columns=cols_show, fill_value=0.0).to_numpy(dtype=float)
+                det_tot  = det['TOTALE'].to_numpy(dtype=float)
+                for i, conto in enumerate(det.index):
                     dc2 = f'<td class="lft det-n">{str(conto)}</td>'
-                    for c in cols_show:
-                        sv = _safe_scalar(det.loc[conto, c]) if c in det.columns else 0.0
-                        dc2 += f'<td class="rgt det-v">{fv(sv, dash=True)}</td>'
-                    sv_t = _safe_scalar(det.loc[conto,'TOTALE']) if 'TOTALE' in det.columns else 0.0
-                    dc2 += f'<td class="rgt det-v"><b>{fv(sv_t)}</b></td>'
-                    if pf_conf is not None:
+                    dc2 += "".join(f'<td class="rgt det-v">{fv(sv, dash=True)}</td>' for sv in det_vals[i])
+                    dc2 += f'<td class="rgt det-v"><b>{fv(det_tot[i])}</b></td>'
+                    if periodo_conf is not None:
                         dc2 += '<td></td><td></td>'
                     if mostra_bud and budget:
                         dc2 += '<td></td><td></td>'
-                    rows_html += f'<tr class="det d{vid}" style="display:none">{dc2}</tr>'
+                    rows_html += f'<tr class="det d{vid}">{dc2}</tr>'
+            elif n:
+                badge = f' <span class="nbadge">({n})</span>'
+                rows_html += f'<tr class="voce"><td class="lft" style="padding-left:10px">{voce}{badge}</td>{tds}</tr>'
             else:
                 rows_html += f'<tr class="voce"><td class="lft" style="padding-left:10px">{voce}</td>{tds}</tr>'
         elif tipo == 'subtotale':
@@ -346,21 +342,19 @@ function tog(id){{
 </script>
 </body></html>"""
 
-    n_main = sum(1 for v in pf.index
-                 if (_safe_str(pf.loc[v,'_tipo']) if '_tipo' in pf.columns else 'c') != 'separatore')
-    height = max(300, n_main * 38 + 100)
+    n_main = int((pivot.tipi != 'separatore').sum())
+    height = max(300, n_main * 38 + n_det * 30 + 100)
     _st_comp.html(html, height=height, scrolling=True)
 
     # Export
     exp = []
-    for voce in pf.index:
-        tipo = _safe_str(pf.loc[voce, '_tipo']) if '_tipo' in pf.columns else 'contabile'
+    for r, (voce, tipo) in enumerate(zip(pivot.etichette, pivot.tipi)):
         if tipo == 'separatore': continue
-        r = {"Voce": voce, "Tipo": tipo}
-        for c in cols_show:
-            r[c] = _safe_scalar(pf.loc[voce, c]) if c in pf.columns else 0.0
-        r["TOTALE"] = _safe_scalar(pf.loc[voce,'_PERIODO']) if '_PERIODO' in pf.columns else 0.0
-        exp.append(r)
+        riga = {"Voce": voce, "Tipo": tipo}
+        for c, v in zip(cols_show, valori[r]):
+            riga[label_mese(c)] = float(v)
+        riga["TOTALE"] = float(periodo[r])
+        exp.append(riga)
     if exp:
         import pandas as _pd
         csv = _pd.DataFrame(exp).to_csv(index=False, decimal=",", sep=";").encode("utf-8-sig")
@@ -370,8 +364,7 @@ function tog(id){{
 
 def _render_grafici(pivot, mesi, kpi):
     # Filtra voci non separatori
-    voci = [v for v in pivot.index
-            if _safe_str(pivot.loc[v, '_tipo']) != 'separatore'] if '_tipo' in pivot.columns else list(pivot.index)
+    voci = [v for v, t in zip(pivot.etichette, pivot.tipi) if t != 'separatore']
     cols_mesi = [c for c in mesi if c in pivot.columns]
     if not cols_mesi:
         st.info("Nessun dato temporale."); return
@@ -393,8 +386,8 @@ def _render_grafici(pivot, mesi, kpi):
         if voce not in pivot.index: continue
         for m in mesi_plot:
             if m in pivot.columns:
-                rows.append({'Mese': m, 'Voce': str(voce)[:30],
-                             'Importo': _safe_scalar(pivot.loc[voce, m])})
+                rows.append({'Mese': label_mese(m), 'Voce': str(voce)[:30],
+                             'Importo': pivot.valore(voce, m)})
     if not rows:
         st.info("Nessun dato."); return
 
@@ -424,9 +417,9 @@ def _render_grafici(pivot, mesi, kpi):
         st.markdown("#### 🌊 Waterfall")
         voce_wf = st.selectbox("Voce waterfall", voci, key="wf_v")
         if voce_wf in pivot.index:
-            vals_wf = [_safe_scalar(pivot.loc[voce_wf, m]) for m in mesi_plot]
+            vals_wf = [pivot.valore(voce_wf, m) for m in mesi_plot]
             fig_wf = go.Figure(go.Waterfall(
-                orientation='v', x=mesi_plot, y=vals_wf,
+                orientation='v', x=[label_mese(m) for m in mesi_plot], y=vals_wf,
                 connector=dict(line=dict(color='rgba(255,255,255,0.1)', width=1)),
                 increasing=dict(marker=dict(color='#10B981', line=dict(width=0))),
                 decreasing=dict(marker=dict(color='#EF4444', line=dict(width=0))),
@@ -442,12 +435,13 @@ def _render_grafici(pivot, mesi, kpi):
 
     with col_b:
         st.markdown("#### 📊 Composizione")
-        mese_pie = st.selectbox("Mese", mesi_plot, index=len(mesi_plot)-1, key="pie_m")
+        mese_pie = st.selectbox("Mese", mesi_plot, index=len(mesi_plot)-1, key="pie_m",
+                                format_func=label_mese)
         if mese_pie in pivot.columns:
             vals_pie = {}
             for v in voci_sel:
                 if v in pivot.index:
-                    val = _safe_scalar(pivot.loc[v, mese_pie])
+                    val = pivot.valore(v, mese_pie)
                     if val > 0:
                         vals_pie[str(v)[:25]] = val
             if vals_pie:
@@ -475,7 +469,7 @@ def _render_grafici(pivot, mesi, kpi):
         ]:
             v = km.get(k)
             if v is not None:
-                margin_rows.append({'Mese': m, 'KPI': lbl, 'Valore': v, '_c': clr})
+                margin_rows.append({'Mese': label_mese(m), 'KPI': lbl, 'Valore': v, '_c': clr})
     if margin_rows:
         df_mg = pd.DataFrame(margin_rows)
         cmap2 = {r['KPI']: r['_c'] for r in margin_rows}
@@ -497,14 +491,13 @@ def _render_grafici(pivot, mesi, kpi):
 # ALERT BUDGET
 # ─────────────────────────────────────────────────────────────────────────────
 
-def _render_budget_alerts(pf, budget, cols_filtro):
+def _render_budget_alerts(pivot, periodo, budget, cols_filtro):
     alerts = []
-    for voce in pf.index:
-        tipo = _safe_str(pf.loc[voce, '_tipo']) if '_tipo' in pf.columns else 'contabile'
+    for r, (voce, tipo) in enumerate(zip(pivot.etichette, pivot.tipi)):
         if tipo != 'contabile' or voce not in budget:
             continue
-        val_eff = _safe_scalar(pf.loc[voce, '_PERIODO']) if '_PERIODO' in pf.columns else 0.0
-        val_bud = sum(budget[voce].get(m, 0) for m in cols_filtro)
+        val_eff = float(periodo[r])
+        val_bud = sum(budget[voce].get(label_mese(m), 0) for m in cols_filtro)
         if val_bud == 0: continue
         pct = (val_eff - val_bud) / abs(val_bud) * 100
         if abs(pct) >= 15:
@@ -1,7 +1,8 @@
 """rettifiche.py — Rettifiche extra-contabili."""
 import streamlit as st
 import pandas as pd
-from services.data_utils import get_cliente, save_cliente, find_column, fmt_eur
+from services.data_utils import get_cliente, save_cliente, fmt_eur
+from services.riclassifica import colonna, chiave_mese
 
 
 def render_rettifiche():
@@ -31,8 +32,8 @@ def render_rettifiche():
     with tab1:
         # Costruisci opzioni conto
         if df_piano is not None:
-            col_cod  = find_column(df_piano, ['Codice','codice','CodConto','Conto','conto'])
-            col_desc = find_column(df_piano, ['Descrizione','descrizione','Nome','nome','Conto','conto'])
+            col_cod  = colonna(df_piano, 'df_piano', 'codice')
+            col_desc = colonna(df_piano, 'df_piano', 'descrizione')
             if col_cod:
                 if col_desc and col_desc != col_cod:
                     opts = [f"{r[col_cod]} — {r[col_desc]}" for _, r in df_piano.iterrows()]
@@ -105,6 +106,12 @@ def render_rettifiche():
         c2.metric("Effetto +", fmt_eur(tot_pos))
         c3.metric("Effetto netto", fmt_eur(tot_pos + tot_neg))
 
+        # Rettifiche attive con mese non valido: non entrano nel CE
+        scartate = [r for r in attive if chiave_mese(r.get('mese', '')) is None]
+        if scartate:
+            st.warning("⚠️ {} rettifiche attive con mese non valido sono escluse dal CE (ID: {}).".format(
+                len(scartate), ', '.join(str(r.get('id', '?')) for r in scartate)))
+
         # Tabella
         df_r = pd.DataFrame(retts)
         show_cols = [c for c in ['id','conto','descrizione','tipo','importo','data','attiva'] if c in df_r.columns]
@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 from services.data_utils import get_cliente, fmt_eur, find_column
-from services.riclassifica import costruisci_ce_riclassificato, get_mesi_disponibili
+from services.riclassifica import costruisci_ce_riclassificato, get_mesi_disponibili, label_mese
 
 
 def _compute_alerts(cliente: dict) -> list:
@@ -37,10 +37,10 @@ def _compute_alerts(cliente: dict) -> list:
     alerts = []
     for voce in pivot.index:
         for i in range(1, len(mesi)):
-            m_prec = mesi[i - 1]
-            m_curr = mesi[i]
-            v_prec = float(pivot.loc[voce, m_prec])
-            v_curr = float(pivot.loc[voce, m_curr])
+            v_prec = float(pivot.loc[voce, mesi[i - 1]])
+            v_curr = float(pivot.loc[voce, mesi[i]])
+            m_prec = label_mese(mesi[i - 1])
+            m_curr = label_mese(mesi[i])
 
             if v_prec == 0:
                 continue
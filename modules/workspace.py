@@ -1,11 +1,17 @@
 """workspace.py — Caricamento file, mappatura conti, import/export."""
 import streamlit as st
 import pandas as pd
+from functools import partial
 from services.data_utils import (
-    smart_load, find_column, get_cliente, save_cliente,
-    get_mapping, set_mapping, get_api_key
+    smart_load, smart_load_stream, find_column, get_cliente, save_cliente,
+    get_mapping, set_mapping, get_api_key, stato_upload, segna_upload, impronta_slot,
+    elenca_fogli, smart_load_batch
+)
+from services.upload_cache import carica_da_cache, salva_in_cache
+from services.riclassifica import (
+    get_label_map, prepara_ledger, accoda_movimenti, TIPIZZATE,
+    RUOLI_COLONNE, RUOLI_FACOLTATIVI, ETICHETTE_RUOLI, rileva_ruoli, colonna
 )
-from services.riclassifica import get_label_map
 
 
 def render_workspace():
@@ -60,19 +66,121 @@ def _tab_file(ca, cliente):
                 "</div>",
                 unsafe_allow_html=True
             )
-            f = st.file_uploader(label, type=["csv","xlsx","xls","xlsm"],
-                                  key="up_" + field + "_" + ca,
-                                  label_visibility="collapsed")
-            if f is not None:
-                df = smart_load(f)
-                if df is not None and not df.empty:
+            slot = "up_" + field + "_" + ca
+            # Aggiornamento mensile: si carica solo il nuovo estratto e lo si accoda
+            accoda = field == 'df_db' and has and st.radio(
+                "Modalità", ["Sostituisci", "Accoda movimenti"], horizontal=True,
+                key=slot + "_modo", label_visibility="collapsed") == "Accoda movimenti"
+            # DB contabile: anche più file o uno zip (un export per mese/registro)
+            multi = field == 'df_db'
+            f = st.file_uploader(label, type=["csv","xlsx","xls","xlsm"] + (["zip"] if multi else []),
+                                  accept_multiple_files=multi,
+                                  key=slot, label_visibility="collapsed")
+            batch = None
+            if multi:
+                if len(f) > 1 or (f and f[0].name.lower().endswith('.zip')):
+                    batch = f
+                else:
+                    f = f[0] if f else None
+            # Workbook con più fogli (uno per mese/società): scelta dei fogli da importare
+            fogli = _scegli_fogli(f, slot) if f is not None and not batch else None
+            # Stato "già elaborato" per uploader e contenuto letto, non per modalità:
+            # cambiare Accoda/Sostituisci non rielabora il file già nel caricatore
+            slot_el = slot + "|" + "|".join(fogli) if fogli else slot
+            # Parse una sola volta per upload: i rerun successivi non rileggono il file
+            esito = stato_upload(f, slot_el) if f is not None else None
+            # Sostituire il DB contabile scarta tutti i movimenti in memoria
+            # (anche quelli accodati): solo dopo conferma esplicita
+            in_attesa = False
+            if f is not None and esito is None and field == 'df_db' and has and not accoda:
+                st.warning("⚠️ Il nuovo file sostituirà i {} movimenti in memoria.".format(
+                    len(cliente[field])))
+                in_attesa = not st.button("Sostituisci il DB contabile", key=slot + "_sostituisci",
+                                          type="primary")
+            if f is not None and esito is None and not in_attesa:
+                # Piano di parsing salvato per il cliente: i caricamenti successivi
+                # dallo stesso gestionale saltano il rilevamento del formato
+                plan = cliente.setdefault('piani_parsing', {}).setdefault(field, {})
+                # Ruoli colonne confermati per il cliente: valgono anche per i nuovi file
+                ruoli_noti = (cliente.setdefault('ruoli_colonne', {}).get(field) or {}).get('ruoli')
+                tipizza = partial(prepara_ledger, ruoli=ruoli_noti)
+                # Stesso contenuto già visto (anche prima di un riavvio): lettura binaria.
+                # Il ledger in cache è tipizzato coi ruoli: fanno parte della chiave
+                variante = list(fogli or []) + (
+                    ['{}={}'.format(k, v) for k, v in sorted(ruoli_noti.items())]
+                    if ruoli_noti and field == 'df_db' else [])
+                digest = impronta_slot(slot_el, variante)
+                report, stati = {}, None
+                df = carica_da_cache(digest, field)
+                if df is not None:
+                    st.caption("⚡ File già elaborato: caricato dalla cache.")
+                else:
+                    if batch:
+                        # Un processo per file, poi un unico ledger
+                        bar = st.progress(0.0, text="Lettura file…")
+
+                        def _file_letto(n, tot, stato):
+                            bar.progress(n / tot, text="Letti {}/{} file · {}".format(n, tot, stato['File']))
+
+                        df, stati = smart_load_batch(batch, plan=plan, trasforma=tipizza,
+                                                     on_file=_file_letto)
+                    elif field == 'df_db':
+                        # Il DB contabile può avere milioni di righe: lettura a blocchi
+                        bar = st.progress(0.0, text="Lettura DB contabile…")
+
+                        def _progress(frac, n):
+                            bar.progress(float(frac), text="Lettura DB contabile… {:,} righe".format(n).replace(',', '.'))
+
+                        # Ogni blocco viene tipizzato al volo: in sessione finisce il ledger compatto
+                        df = smart_load_stream(f, on_progress=_progress, plan=plan,
+                                               trasforma=tipizza, report=report,
+                                               fogli=fogli)
+                    else:
+                        df = smart_load(f, plan=plan, report=report, fogli=fogli)
+                    if df is not None:
+                        salva_in_cache(digest, field, df)
+                ok = df is not None and not df.empty
+                if ok:
+                    ruoli, dubbi = rileva_ruoli(df, field, noti=ruoli_noti or df.attrs.get('ruoli'))
+                    df.attrs['ruoli'] = ruoli
+                acc = None
+                if ok and accoda:
+                    df_acc, acc = accoda_movimenti(cliente.get('df_db'), df)
+                    ok = acc is not None
+                segna_upload(slot_el, ok)
+                if ok and accoda:
+                    # Il cubo conti × mesi si aggiorna con i soli movimenti accodati
+                    save_cliente({field: df_acc})
+                    if df_acc.attrs.get('ruoli'):
+                        cliente['ruoli_colonne'][field] = {'ruoli': df_acc.attrs['ruoli'], 'dubbi': []}
+                    st.success("✅ {} movimenti accodati · {} duplicati scartati · {} righe totali".format(
+                        acc['nuovi'], acc['duplicati'], len(df_acc)))
+                    if acc['mesi']:
+                        st.caption("Mesi aggiornati: " + ", ".join(
+                            "{}-{:02d}".format(m // 100, m % 100) for m in acc['mesi']))
+                    _mostra_report(report, df)
+                elif ok:
+                    cliente['ruoli_colonne'][field] = {'ruoli': ruoli, 'dubbi': dubbi}
                     save_cliente({field: df})
                     st.success("✅ {} righe caricate — colonne: {}".format(
                         len(df), list(df.columns)[:6]))
+                    if plan:
+                        dec = df.attrs.get('decimale')
+                        st.caption("Formato: {} · separatore {}{} · confidenza {:.0%}".format(
+                            plan['encoding'], repr(plan['sep']),
+                            " · decimali {}".format(repr(dec)) if dec else "", plan['confidenza']))
+                    _mostra_report(report, df)
                     with st.expander("Anteprima"):
                         st.dataframe(df.head(5), use_container_width=True)
+                elif df is not None and accoda:
+                    st.error("⚠️ Colonne Data, Conto e Importo non trovate: impossibile accodare i movimenti.")
                 else:
                     st.error("⚠️ File non leggibile. Verifica formato, separatore e encoding.")
+                if stati:
+                    with st.expander("Dettaglio file ({})".format(len(stati)), expanded=not ok):
+                        st.dataframe(pd.DataFrame(stati), use_container_width=True, hide_index=True)
+            elif esito is False:
+                st.error("⚠️ File non leggibile. Verifica formato, separatore e encoding.")
             elif has:
                 df_cur = cliente[field]
                 st.markdown(
@@ -80,6 +188,84 @@ def _tab_file(ca, cliente):
                     "✅ {} righe in memoria</div>".format(len(df_cur)),
                     unsafe_allow_html=True
                 )
+            if cliente.get(field) is not None:
+                _conferma_ruoli(field, slot)
+
+    def _conferma_ruoli(field, slot):
+        """Ruoli delle colonne riconosciuti al caricamento; quelli dubbi vanno confermati."""
+        df = cliente[field]
+        registro = cliente.setdefault('ruoli_colonne', {})
+        if registro.get(field) is None:
+            # Frame caricato prima del registro: riconoscimento ora, una volta
+            ruoli, dubbi = rileva_ruoli(df, field, noti=df.attrs.get('ruoli'))
+            df.attrs['ruoli'] = ruoli
+            registro[field] = {'ruoli': ruoli, 'dubbi': dubbi}
+        ruoli, dubbi = registro[field]['ruoli'], registro[field]['dubbi']
+        titolo = "Colonne riconosciute" + (" — da confermare" if dubbi else "")
+        with st.expander(("⚠️ " if dubbi else "🔎 ") + titolo, expanded=bool(dubbi)):
+            cols = [c for c in df.columns if not str(c).startswith('_')]
+            scelti = {}
+            for ruolo in RUOLI_COLONNE[field]:
+                opts = ([None] if ruolo in RUOLI_FACOLTATIVI or ruoli.get(ruolo) is None else []) + cols
+                cur = ruoli.get(ruolo) if ruoli.get(ruolo) in opts else opts[0]
+                scelti[ruolo] = st.selectbox(
+                    ETICHETTE_RUOLI[ruolo] + (" (da confermare)" if ruolo in dubbi else ""),
+                    opts, index=opts.index(cur),
+                    format_func=lambda c: "— nessuna —" if c is None else str(c),
+                    key=slot + "_ruolo_" + ruolo)
+            if st.button("Conferma colonne", key=slot + "_ruoli_ok"):
+                mancanti = [ETICHETTE_RUOLI[r] for r, c in scelti.items()
+                            if c is None and r not in RUOLI_FACOLTATIVI]
+                if mancanti:
+                    st.error("⚠️ Indica la colonna per: " + ", ".join(mancanti))
+                    return
+                dati = {}
+                if field == 'df_db' and scelti != ruoli:
+                    # Le colonne tipizzate dipendono da data/importo/conto: si ricalcolano
+                    df = prepara_ledger(df.drop(columns=[c for c in df.columns
+                                                         if c in TIPIZZATE or c == '_giorno_key']),
+                                        ruoli=scelti)
+                df.attrs['ruoli'] = scelti
+                registro[field] = {'ruoli': scelti, 'dubbi': []}
+                dati[field] = df
+                save_cliente(dati)
+                st.success("✅ Colonne confermate.")
+
+    def _scegli_fogli(f, slot):
+        """Fogli Excel da importare; None per CSV o workbook con un solo foglio."""
+        if not f.name.lower().endswith(('.xlsx', '.xls', '.xlsm')):
+            return None
+        # L'elenco dei fogli si legge una volta per upload, non a ogni rerun
+        memo = st.session_state.setdefault('_fogli_upload', {})
+        file_id = getattr(f, 'file_id', None) or f.name
+        if memo.get(slot, (None,))[0] != file_id:
+            memo[slot] = (file_id, elenca_fogli(f))
+        nomi = memo[slot][1]
+        if len(nomi) <= 1:
+            return None
+        scelti = st.multiselect("Fogli da importare", nomi, default=nomi[:1],
+                                key=slot + "_fogli")
+        return scelti or nomi[:1]
+
+    def _mostra_report(report, df=None):
+        """Resoconto della pulizia: cosa è stato scartato durante il caricamento."""
+        if df is not None and '_saldo_num' in df.columns:
+            n_bad = int(df['_saldo_num'].isna().sum())
+            if n_bad:
+                st.warning("⚠️ {} importi non interpretabili (esclusi dai totali).".format(n_bad))
+        note = []
+        if report.get('righe_vuote'):
+            note.append("{} righe vuote rimosse".format(report['righe_vuote']))
+        if report.get('colonne_rimosse'):
+            note.append("{} colonne senza intestazione rimosse".format(len(report['colonne_rimosse'])))
+        if report.get('righe_scartate'):
+            note.append("{} righe malformate scartate".format(report['righe_scartate']))
+        if note:
+            msg = "Pulizia: " + " · ".join(note)
+            if report.get('righe_scartate'):
+                st.warning("⚠️ " + msg + ". Verifica il file sorgente.")
+            else:
+                st.caption(msg)
 
     c1, c2, c3 = st.columns(3)
     upload_block(c1, "1. Piano dei Conti",     "df_piano", "Colonne: Codice, Descrizione")
@@ -114,10 +300,10 @@ def _tab_mappatura(ca, cliente):
         st.warning("⚠️ Carica prima **Piano dei Conti** e **Schema Riclassifica** nel tab File.")
         return
 
-    col_cod_piano  = find_column(df_piano, ['Codice','codice','CodConto','Conto','conto','ID','cod'])
-    col_desc_piano = find_column(df_piano, ['Descrizione','descrizione','Nome','nome'])
-    col_cod_ricl   = find_column(df_ricl,  ['Codice','codice','ID','id','Voce','voce'])
-    col_desc_ricl  = find_column(df_ricl,  ['Descrizione','descrizione','Nome','nome','Voce','voce'])
+    col_cod_piano  = colonna(df_piano, 'df_piano', 'codice')
+    col_desc_piano = colonna(df_piano, 'df_piano', 'descrizione')
+    col_cod_ricl   = colonna(df_ricl,  'df_ricl',  'codice')
+    col_desc_ricl  = colonna(df_ricl,  'df_ricl',  'descrizione')
 
     if not col_cod_piano:
         st.error("Colonna Codice non trovata nel Piano. Colonne: {}".format(list(df_piano.columns)[:8]))
@@ -171,10 +357,16 @@ def _tab_mappatura(ca, cliente):
         with c_imp:
             st.markdown("**Importa da CSV/Excel**")
             st.caption("Colonne richieste: `Codice` (conto) e `VoceCodice` (codice schema)")
+            slot_imp = "imp_map_" + ca
             f_imp = st.file_uploader("Importa", type=["csv","xlsx","xls"],
-                                      key="imp_map_" + ca, label_visibility="collapsed")
-            if f_imp is not None:
+                                      key=slot_imp, label_visibility="collapsed")
+            esito_imp = stato_upload(f_imp, slot_imp) if f_imp is not None else None
+            if esito_imp is False:
+                st.error("File non leggibile o senza colonne Codice/VoceCodice.")
+            elif f_imp is not None and esito_imp is None:
+                # Import una sola volta: dopo st.rerun() il file è ancora nell'uploader
                 df_imp = smart_load(f_imp)
+                segna_upload(slot_imp, False)
                 if df_imp is not None and not df_imp.empty:
                     col_c = find_column(df_imp, ['Codice','codice','CodConto','conto'])
                     col_v = find_column(df_imp, ['VoceCodice','voce_codice','CodiceVoce','Voce','Mapping','mapping'])
@@ -188,6 +380,7 @@ def _tab_mappatura(ca, cliente):
                                 m[conto] = voce
                                 nuovi += 1
                         set_mapping(m)
+                        segna_upload(slot_imp, True)
                         st.success("✅ {} mapping importati. Ricarica la pagina.".format(nuovi))
                         st.rerun()
                     else:
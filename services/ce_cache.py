@@ -0,0 +1,72 @@
+"""ce_cache.py — CE riclassificato costruito una volta e condiviso tra le pagine.
+
+Dashboard, CFO Agent e Budget costruiscono lo stesso CE a ogni rerun (ogni
+click, ogni cambio di filtro). Il risultato dipende solo da ledger, piano,
+schema di riclassifica, mappatura, schema CE attivo e rettifiche: con quelle
+versioni come chiave il CE si ricalcola solo quando uno di essi cambia.
+Cache in session_state per cliente, LRU con pochi elementi, contatori hit/miss.
+"""
+import streamlit as st
+from services.data_utils import versione_frame, impronta_frame, impronta_dati
+from services.riclassifica import costruisci_ce_riclassificato, tabella_rettifiche
+
+MAX_CE_PER_CLIENTE = 4
+
+
+def _versione_frame(df):
+    """Contenuto del frame + ruoli delle colonne (cambiano le colonne usate)."""
+    if df is None:
+        return None
+    return versione_frame(df), tuple(sorted((df.attrs.get('ruoli') or {}).items()))
+
+
+def _cache_cliente(ca):
+    return st.session_state.setdefault('_cache_ce', {}).setdefault(
+        ca, {'voci': {}, 'hit': 0, 'miss': 0})
+
+
+def costruisci_ce_in_cache(df_db, df_piano, df_ricl, mapping, schema_config, rettifiche=None):
+    """
+    Come costruisci_ce_riclassificato (stessi argomenti, stesso risultato),
+    ma riusa il CE del cliente attivo se nessun input è cambiato.
+    Il risultato è condiviso: pivot e dettaglio vanno usati in sola lettura.
+    """
+    ca = st.session_state.get('cliente_attivo')
+    chiave = (
+        _versione_frame(df_db), _versione_frame(df_piano), _versione_frame(df_ricl),
+        impronta_dati(mapping or {}), impronta_dati(schema_config or {}),
+        # Solo ciò che entra nel CE: rettifiche attive come delta (conto, mese, importo)
+        impronta_frame(tabella_rettifiche(rettifiche)),
+    )
+    cache = _cache_cliente(ca)
+    voci = cache['voci']
+    if chiave in voci:
+        cache['hit'] += 1
+        voci[chiave] = voci.pop(chiave)   # LRU: in coda il più recente
+        return voci[chiave]
+
+    cache['miss'] += 1
+    risultato = costruisci_ce_riclassificato(
+        df_db, df_piano, df_ricl, mapping, schema_config, rettifiche)
+    voci[chiave] = risultato
+    while len(voci) > MAX_CE_PER_CLIENTE:
+        voci.pop(next(iter(voci)))
+    return risultato
+
+
+def statistiche_cache_ce(ca=None):
+    """{'voci', 'hit', 'miss'} della cache CE del cliente (default: attivo)."""
+    ca = ca or st.session_state.get('cliente_attivo')
+    cache = st.session_state.get('_cache_ce', {}).get(ca)
+    if not cache:
+        return {'voci': 0, 'hit': 0, 'miss': 0}
+    return {'voci': len(cache['voci']), 'hit': cache['hit'], 'miss': cache['miss']}
+
+
+def svuota_cache_ce(ca=None):
+    """Elimina i CE in cache di un cliente (o di tutti con ca=None)."""
+    cache = st.session_state.get('_cache_ce', {})
+    if ca is None:
+        cache.clear()
+    else:
+        cache.pop(ca, None)
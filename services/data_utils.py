@@ -1,104 +1,762 @@
 """data_utils.py — Utility core. Zero type hints moderni per max compatibilità."""
 import pandas as pd
 import numpy as np
+import csv
 import io
+import os
+import re
+import hashlib
+import json
+import time
+import weakref
+import warnings
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+import openpyxl
 import streamlit as st
 
+# Versione della pipeline di lettura, pulizia e tipizzazione dei file caricati
+# (qui e in riclassifica.prepara_ledger): incrementarla a ogni modifica che
+# cambia il frame prodotto. La cache su disco degli upload ne dipende.
+#   2: importi non validi → NaN   3: date e chiavi mese   4: ruoli colonne
+#   5: intestazione con campi tra virgolette, righe pulite per posizione
+#   6: separatore decimale unico per tutti i blocchi di un file
+VERSIONE_PIPELINE = 6
 
-def smart_load(file):
+
+def smart_load(file, plan=None, report=None, fogli=None):
     """
     Carica CSV/Excel da UploadedFile Streamlit.
     Gestisce: utf-8, utf-8-sig, latin1, cp1252; separatori ; , tab;
     formati Excel .xlsx .xls; BOM; encoding italiani.
+
+    plan: piano di parsing CSV (vedi rileva_formato). Se valorizzato viene
+    usato senza rilevamento; se vuoto o non più valido viene ricalcolato e
+    aggiornato in place, così il chiamante può salvarlo per il cliente.
+    report: dict opzionale riempito con il resoconto della pulizia
+    (vedi nuovo_report_pulizia).
+    fogli: per Excel, lista dei fogli da importare (default il primo);
+    con più fogli le righe vengono accodate con la colonna 'Foglio'.
     """
     if file is None:
         return None
+    if report is not None:
+        report.update(nuovo_report_pulizia())
     try:
         name = getattr(file, 'name', '') or ''
         name = name.lower().strip()
 
         # ── Excel ──────────────────────────────────────────────────────────
         if name.endswith(('.xlsx', '.xls', '.xlsm')):
-            try:
-                # reset file position
-                if hasattr(file, 'seek'):
-                    file.seek(0)
-                df = pd.read_excel(file, dtype=str)
-            except Exception as e1:
-                try:
-                    if hasattr(file, 'seek'):
-                        file.seek(0)
-                    raw = file.read()
-                    df = pd.read_excel(io.BytesIO(raw), dtype=str)
-                except Exception:
-                    return None
+            df = _leggi_excel(file, name, fogli, report)
+            if df is None:
+                return None
 
         # ── CSV / TXT ──────────────────────────────────────────────────────
         else:
-            if hasattr(file, 'seek'):
-                file.seek(0)
-            raw = file.read()
-            if not raw:
+            if plan is None:
+                plan = {}
+            df = None
+            for p in _piani_candidati(file, plan):
+                df = _leggi_csv(file, p, report)
+                if df is not None:
+                    plan.update(p)
+                    break
+            if df is None:
                 return None
 
-            df = None
-            for enc in ['utf-8-sig', 'utf-8', 'latin1', 'cp1252', 'iso-8859-15']:
-                try:
-                    text = raw.decode(enc)
-                except Exception:
-                    continue
+        df = _pulisci_righe(_pulisci_colonne(df, report), report)
+        return df if not df.empty else None
 
-                lines = [l for l in text.split('\n') if l.strip()]
-                if len(lines) < 2:
-                    continue
+    except Exception:
+        return None
+
+
+def _nomi_colonne(columns):
+    """Normalizza i nomi colonna: BOM, zero-width, NBSP, spazi."""
+    return (
+        columns.astype(str)
+        .str.strip()
+        .str.replace('\ufeff', '', regex=False)  # BOM
+        .str.replace('\u200b', '', regex=False)  # zero-width space
+        .str.replace('\xa0', ' ', regex=False)   # non-breaking space
+    )
+
+
+def nuovo_report_pulizia():
+    """
+    Resoconto della pulizia di un caricamento:
+      righe_vuote      righe senza alcun valore, rimosse
+      colonne_rimosse  colonne 'Unnamed' (senza intestazione), rimosse
+      righe_scartate   righe malformate (numero di campi errato) saltate dal parser
+    """
+    return {'righe_vuote': 0, 'colonne_rimosse': [], 'righe_scartate': 0}
+
+
+def _pulisci_colonne(df, report=None):
+    df.columns = _nomi_colonne(df.columns)
+    # Rimuovi colonne "Unnamed"
+    unnamed = df.columns.str.startswith('Unnamed')
+    if report is not None:
+        report['colonne_rimosse'] += list(df.columns[unnamed])
+    return df.loc[:, ~unnamed]
+
+
+def _pulisci_righe(df, report=None):
+    """
+    Rimuove le righe completamente vuote (NaN o solo spazi, NBSP compresi).
+    Vettoriale colonna per colonna: ogni colonna controlla solo le righe
+    ancora candidate, che di solito si esauriscono già alla prima.
+    """
+    vuota = np.ones(len(df), dtype=bool)
+    # Posizionale: i nomi normalizzati possono ripetersi ('Data' e ' Data ')
+    for j in range(df.shape[1]):
+        idx = np.flatnonzero(vuota)
+        if not len(idx):
+            break
+        col = df.iloc[idx, j]
+        piena = col.notna().to_numpy().copy()
+        if piena.any():
+            testo = col[piena].astype(str).str.strip()
+            piena[piena] = (testo != '').to_numpy()
+        vuota[idx[piena]] = False
+    n_vuote = int(vuota.sum())
+    if report is not None:
+        report['righe_vuote'] += n_vuote
+    if n_vuote:
+        df = df[~vuota]
+    return df.reset_index(drop=True)
+
+
+def _conta_scartate(caught):
+    """Righe saltate da on_bad_lines='warn' (un ParserWarning può elencarne molte)."""
+    return sum(str(w.message).count('Skipping line') for w in caught
+               if issubclass(w.category, pd.errors.ParserWarning))
+
+
+# ─── RILEVAMENTO FORMATO CSV ─────────────────────────────────────────────────
+
+_SNIFF_BYTES = 256 * 1024  # byte ispezionati per rilevare il formato
+_SNIFF_RIGHE = 200
+_ENCODINGS   = ['utf-8-sig', 'utf-8', 'latin1', 'cp1252', 'iso-8859-15']
+_SEPARATORI  = [';', ',', '\t', '|']
+
+
+def rileva_formato(file):
+    """
+    Rileva il formato di un CSV leggendo solo i primi _SNIFF_BYTES.
+    Ritorna il piano di parsing:
+      encoding, sep, header (righe da saltare prima dell'intestazione),
+      confidenza (0-1: righe coerenti col separatore)
+    Il separatore decimale non fa parte del piano: si decide sulla colonna
+    degli importi (vedi to_numeric).
+    oppure None se il campione non sembra una tabella.
+    """
+    try:
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        head = file.read(_SNIFF_BYTES)
+        file.seek(0)
+    except Exception:
+        return None
+    if not head:
+        return None
+    if len(head) == _SNIFF_BYTES:
+        # Campione troncato: scarta l'ultima riga (e l'eventuale carattere multibyte spezzato)
+        head = head[:head.rfind(b'\n') + 1] or head
+
+    for enc in _ENCODINGS:
+        try:
+            text = head.decode(enc)
+        except UnicodeDecodeError:
+            continue
+        lines = [l.rstrip('\r') for l in text.split('\n')[:_SNIFF_RIGHE]]
+        non_vuote = [l for l in lines if l.strip()]
+        if len(non_vuote) < 2:
+            return None
+
+        # Campi contati con csv.reader: separatori tra virgolette ("12,50",
+        # "Fatt. 1; acconto") non contano come colonne
+        sep, coerenza, k, campi = ',', 0.0, 0, None
+        for cand in _SEPARATORI:
+            righe = _campi_righe(non_vuote, cand)
+            counts = [len(r) for r in righe]
+            moda = max(set(counts), key=counts.count)
+            if moda < 2:
+                continue
+            coer = counts.count(moda) / len(counts)
+            if (coer, moda) > (coerenza, k):
+                sep, coerenza, k, campi = cand, coer, moda, righe
+
+        # Intestazione = prima riga con almeno tanti campi non vuoti quanti la
+        # riga dati tipica (salta righe di titolo/preambolo che molti gestionali
+        # aggiungono; separatori finali e colonne facoltative vuote non contano)
+        header = 0
+        if campi:
+            pieni = [sum(1 for c in r if c.strip()) for r in campi]
+            moda_pieni = max(set(pieni), key=pieni.count)
+            indici = [i for i, l in enumerate(lines) if l.strip()]
+            header = next((indici[j] for j, n in enumerate(pieni) if n >= moda_pieni), 0)
+
+        return {
+            'encoding':   enc,
+            'sep':        sep,
+            'header':     header,
+            'confidenza': round(coerenza, 2),
+        }
+    return None
+
+
+def _campi_righe(righe, sep):
+    """Campi di ogni riga secondo le regole CSV (virgolette comprese)."""
+    try:
+        return [r for r in csv.reader(righe, delimiter=sep)]
+    except csv.Error:
+        return [r.split(sep) for r in righe]
+
+
+def _piani_candidati(file, plan):
+    """Prima il piano salvato (se c'è), poi un rilevamento fresco sul campione."""
+    if plan:
+        yield dict(plan)
+    nuovo = rileva_formato(file)
+    if nuovo:
+        yield nuovo
+
+
+def _leggi_csv(file, plan, report=None):
+    """
+    Parsing unico dell'intero file secondo il piano.
+    Il buffer di byte dell'upload va direttamente al parser con l'encoding del
+    piano (decodifica incrementale): niente copia in str né StringIO.
+    """
+    # Un utf-8 valido sul campione può fallire più avanti: ripiego su cp1252
+    for encoding, errors in [(plan['encoding'], 'strict'), ('cp1252', 'replace')]:
+        try:
+            buf = _byte_buffer(file)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always', pd.errors.ParserWarning)
+                df = pd.read_csv(
+                    buf, sep=plan['sep'], skiprows=plan.get('header') or None,
+                    dtype=str, encoding=encoding, encoding_errors=errors,
+                    on_bad_lines='warn', skip_blank_lines=True,
+                    low_memory=False
+                )
+        except UnicodeDecodeError:
+            continue
+        except Exception:
+            return None
+        plan['encoding'] = encoding
+        if len(df.columns) >= 2 and len(df) >= 1:
+            if report is not None:
+                report['righe_scartate'] += _conta_scartate(caught)
+            return df
+        return None
+    return None
+
+
+def _byte_buffer(file):
+    """
+    Handle binario sui byte dell'upload, riavvolto, senza copiarli.
+    UploadedFile è già un BytesIO; per bytes/memoryview si crea un BytesIO
+    che condivide il buffer (CPython copia solo in scrittura).
+    """
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        return io.BytesIO(file)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return file
+
+
+# ─── EXCEL ───────────────────────────────────────────────────────────────────
+# .xlsx/.xlsm: openpyxl in modalità read-only, che scorre le righe del foglio
+# in streaming senza costruire il modello completo del workbook (stili, celle
+# vuote, ...). .xls: xlrd via pandas. Più fogli vengono letti in parallelo,
+# un processo per foglio: il parsing XML è CPU-bound e il GIL non lo divide.
+
+MAX_PROCESSI = os.cpu_count() or 1     # processi per fogli Excel e caricamenti multipli
+
+
+def elenca_fogli(file):
+    """Nomi dei fogli di un file Excel, in ordine; [] se non leggibile."""
+    name = (getattr(file, 'name', '') or '').lower().strip()
+    try:
+        if name.endswith(('.xlsx', '.xlsm')):
+            wb = openpyxl.load_workbook(_byte_buffer(file), read_only=True)
+            try:
+                return list(wb.sheetnames)
+            finally:
+                wb.close()
+        return list(pd.ExcelFile(_byte_buffer(file)).sheet_names)
+    except Exception:
+        return []
+
+
+def _leggi_excel(file, name, fogli, report=None):
+    """Legge i fogli richiesti (default il primo) e li accoda; None se illeggibile."""
+    raw = _byte_buffer(file)
+    raw = raw.getvalue() if hasattr(raw, 'getvalue') else raw.read()
+    xlsx = name.endswith(('.xlsx', '.xlsm'))
+    fogli = list(fogli) if fogli else [None]
+    try:
+        dfs = _leggi_fogli(raw, fogli, xlsx)
+    except Exception:
+        if not xlsx:
+            return None
+        try:
+            # Estensione che non corrisponde al contenuto: lascia scegliere a pandas
+            dfs = [pd.read_excel(io.BytesIO(raw), sheet_name=f or 0, dtype=str) for f in fogli]
+        except Exception:
+            return None
+    parts = []
+    for foglio, df in zip(fogli, dfs):
+        if df is None or df.empty:
+            continue
+        df = _pulisci_colonne(df, report)
+        if len(fogli) > 1:
+            df['Foglio'] = foglio
+        parts.append(df)
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+
+
+def _leggi_fogli(raw, fogli, xlsx):
+    """
+    Un DataFrame per foglio; più fogli su un pool di processi se disponibile.
+    I byte del workbook arrivano a ogni processo una volta sola, con
+    l'initializer del pool: i task portano solo il nome del foglio.
+    """
+    n = min(len(fogli), MAX_PROCESSI)
+    if n > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n, initializer=_imposta_workbook,
+                                     initargs=(raw,)) as pool:
+                return list(pool.map(_leggi_foglio_pool, fogli, repeat(xlsx)))
+        except BrokenProcessPool:
+            pass   # ambiente senza fork/spawn: lettura sequenziale
+    return [_leggi_foglio(raw, f, xlsx) for f in fogli]
+
+
+_WORKBOOK_POOL = None   # byte del workbook nel processo del pool (vedi _leggi_fogli)
+
+
+def _imposta_workbook(raw):
+    global _WORKBOOK_POOL
+    _WORKBOOK_POOL = raw
+
+
+def _leggi_foglio_pool(foglio, xlsx):
+    return _leggi_foglio(_WORKBOOK_POOL, foglio, xlsx)
+
+
+def _leggi_foglio(raw, foglio, xlsx=True):
+    """
+    Legge un foglio come stringhe (come read_excel con dtype=str).
+    Funzione di modulo: viene eseguita nei processi del pool.
+    """
+    if not xlsx:
+        return pd.read_excel(io.BytesIO(raw), sheet_name=foglio or 0, dtype=str)
+    wb = openpyxl.load_workbook(io.BytesIO(raw), read_only=True, data_only=True)
+    try:
+        ws = wb[foglio] if foglio is not None else wb.worksheets[0]
+        righe = ws.iter_rows(values_only=True)
+        # Intestazione = prima riga non vuota
+        header = None
+        for r in righe:
+            if any(v is not None and str(v).strip() for v in r):
+                header = r
+                break
+        if header is None:
+            return None
+        w = len(header)
+        dati = [r[:w] if len(r) >= w else r + (None,) * (w - len(r)) for r in righe]
+    finally:
+        wb.close()
+    cols = _intestazioni_excel(header)
+    if not dati:
+        return pd.DataFrame(columns=cols, dtype=str)
+    colonne = list(zip(*dati))
+    return pd.DataFrame({c: [_cella(v) for v in colonne[i]] for i, c in enumerate(cols)})
+
+
+def _intestazioni_excel(header):
+    """Nomi colonna come read_excel: vuoti -> 'Unnamed: i', duplicati -> 'X.1'."""
+    cols, visti = [], {}
+    for i, v in enumerate(header):
+        nome = 'Unnamed: {}'.format(i) if v is None or not str(v).strip() else str(_cella(v))
+        if nome in visti:
+            visti[nome] += 1
+            nome = '{}.{}'.format(nome, visti[nome])
+        else:
+            visti[nome] = 0
+        cols.append(nome)
+    return cols
+
+
+def _cella(v):
+    # Interi salvati come float (100.0) tornano '100', come fa read_excel
+    if v is None:
+        return None
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+
+# ─── CARICAMENTO A BLOCCHI (file grandi) ─────────────────────────────────────
+
+CHUNK_RIGHE = 200_000      # righe per blocco nel caricamento streaming
 
-                # Detect separator from first 10 lines
-                sample = '\n'.join(lines[:10])
-                counts = {
-                    ';': sample.count(';'),
-                    ',': sample.count(','),
-                    '\t': sample.count('\t'),
-                    '|': sample.count('|'),
-                }
-                sep = max(counts, key=counts.get)
-                if counts[sep] == 0:
-                    sep = ','
-
-                try:
-                    candidate = pd.read_csv(
-                        io.StringIO(text), sep=sep, dtype=str,
-                        on_bad_lines='skip', skip_blank_lines=True,
-                        low_memory=False
+
+def _file_size(file):
+    size = getattr(file, 'size', None)
+    if size:
+        return size
+    try:
+        pos = file.tell()
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(pos)
+        return size
+    except Exception:
+        return None
+
+
+def smart_load_stream(file, chunksize=CHUNK_RIGHE, on_progress=None, plan=None, trasforma=None,
+                      report=None, fogli=None):
+    """
+    Carica un CSV grande a blocchi di `chunksize` righe: ogni blocco viene
+    pulito e accodato, senza mai decodificare l'intero file in memoria.
+    on_progress(frazione_letta, righe_caricate) è chiamata dopo ogni blocco.
+    trasforma(df) -> df, se passata, tipizza ogni blocco prima di accodarlo
+    (le colonne category dei blocchi vengono unite senza tornare a stringa).
+    Il separatore decimale degli importi deciso sul primo blocco
+    (attrs['decimale'] del blocco tipizzato) vale per tutti i blocchi.
+    plan, report, fogli: come in smart_load. Per i file Excel ricade su smart_load.
+    """
+    if file is None:
+        return None
+    name = (getattr(file, 'name', '') or '').lower().strip()
+    if name.endswith(('.xlsx', '.xls', '.xlsm')):
+        df = smart_load(file, plan, report, fogli)
+        if trasforma and df is not None:
+            df = trasforma(df)
+        if on_progress and df is not None:
+            on_progress(1.0, len(df))
+        return df
+
+    if plan is None:
+        plan = {}
+    for p in _piani_candidati(file, plan):
+        if report is not None:
+            report.update(nuovo_report_pulizia())
+        df = _leggi_csv_blocchi(file, p, chunksize, on_progress, trasforma, report)
+        if df is not None:
+            plan.update(p)
+            return df
+    return None
+
+
+def _leggi_csv_blocchi(file, plan, chunksize, on_progress, trasforma=None, report=None):
+    try:
+        size = _file_size(file)
+        # Un file utf-8 "sporco" può fallire oltre il campione: si riparte in cp1252
+        for encoding in dict.fromkeys([plan['encoding'], 'cp1252']):
+            file.seek(0)
+            parts, cols, keep, n, decimale = [], None, None, 0, None
+            rep = nuovo_report_pulizia()
+            try:
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always', pd.errors.ParserWarning)
+                    reader = pd.read_csv(
+                        file, sep=plan['sep'], skiprows=plan.get('header') or None,
+                        dtype=str, encoding=encoding,
+                        on_bad_lines='warn', skip_blank_lines=True,
+                        chunksize=chunksize,
                     )
-                    if len(candidate.columns) >= 2 and len(candidate) >= 1:
-                        df = candidate
-                        break
-                except Exception:
+                    for chunk in reader:
+                        if cols is None:
+                            cols = _nomi_colonne(chunk.columns)
+                            keep = ~cols.str.startswith('Unnamed')
+                            rep['colonne_rimosse'] = list(cols[~keep])
+                            cols = cols[keep]
+                        chunk = chunk.loc[:, keep]
+                        chunk.columns = cols
+                        chunk = _pulisci_righe(chunk, rep)
+                        if not chunk.empty:
+                            if trasforma:
+                                if decimale:
+                                    chunk.attrs['decimale'] = decimale
+                                chunk = trasforma(chunk)
+                                decimale = decimale or chunk.attrs.get('decimale')
+                            parts.append(chunk)
+                            n += len(chunk)
+                        if on_progress:
+                            frac = min(1.0, file.tell() / size) if size else 0.0
+                            on_progress(frac, n)
+            except UnicodeDecodeError:
+                continue
+            plan['encoding'] = encoding
+            rep['righe_scartate'] = _conta_scartate(caught)
+            if report is not None:
+                report.update(rep)
+            break
+        else:
+            return None
+
+        if not parts or len(cols) < 2:
+            return None
+        df = concat_categorie(parts)
+        if on_progress:
+            on_progress(1.0, len(df))
+        return df
+
+    except Exception:
+        return None
+
+
+def concat_categorie(parts):
+    """
+    pd.concat che unisce le colonne category dei frame con categorie diverse
+    (blocchi dello streaming, ledger esistente + movimenti accodati).
+    """
+    if len(parts) == 1:
+        return parts[0].reset_index(drop=True)
+    cols = list(parts[0].columns)
+    for p in parts[1:]:
+        cols += [c for c in p.columns if c not in cols]
+    cat_cols = [c for c in cols
+                if all(c in p.columns and isinstance(p[c].dtype, pd.CategoricalDtype)
+                       for p in parts)]
+    df = pd.concat([p.drop(columns=cat_cols) for p in parts], ignore_index=True)
+    for c in cat_cols:
+        df[c] = pd.api.types.union_categoricals([p[c] for p in parts])
+    return df[cols]
+
+
+# ─── CARICAMENTO MULTIPLO (zip / più file) ───────────────────────────────────
+# Alcuni gestionali esportano un file per mese o per registro: i file vengono
+# letti e tipizzati in parallelo, un processo per file, e poi accodati.
+
+ESTENSIONI_DATI = ('.csv', '.txt', '.xlsx', '.xls', '.xlsm')
+
+
+def espandi_upload(files):
+    """
+    Lista (nome, bytes) dei file di dati negli upload, con gli zip espansi
+    (cartelle, file nascosti e metadati macOS esclusi), ordinata per nome.
+    """
+    out = []
+    for f in files:
+        name = getattr(f, 'name', '') or ''
+        raw = _byte_buffer(f)
+        raw = raw.getvalue() if hasattr(raw, 'getvalue') else raw.read()
+        if not name.lower().endswith('.zip'):
+            out.append((name, raw))
+            continue
+        with zipfile.ZipFile(io.BytesIO(raw)) as zf:
+            for info in zf.infolist():
+                base = os.path.basename(info.filename)
+                if (info.is_dir() or info.filename.startswith('__MACOSX')
+                        or base.startswith('.')
+                        or not base.lower().endswith(ESTENSIONI_DATI)):
                     continue
+                out.append((info.filename, zf.read(info)))
+    return sorted(out, key=lambda x: x[0])
 
-            if df is None:
-                return None
 
-        # ── Pulizia colonne ────────────────────────────────────────────────
-        df.columns = (
-            df.columns.astype(str)
-            .str.strip()
-            .str.replace('\ufeff', '', regex=False)  # BOM
-            .str.replace('\u200b', '', regex=False)  # zero-width space
-            .str.replace('\xa0', ' ', regex=False)   # non-breaking space
-        )
-        # Rimuovi colonne "Unnamed"
-        df = df.loc[:, ~df.columns.str.startswith('Unnamed')]
-
-        # Rimuovi righe completamente vuote
-        df = df.dropna(how='all')
-        df = df[~df.apply(lambda r: r.astype(str).str.strip().eq('').all(), axis=1)]
-        df = df.reset_index(drop=True)
+def smart_load_batch(files, plan=None, trasforma=None, on_file=None):
+    """
+    Carica più file (o zip di file) nello stesso formato e li accoda in un
+    unico frame, con la colonna 'File' di provenienza.
+    trasforma(df) -> df è applicata a ogni file nel suo processo.
+    on_file(fatti, totale, stato) è chiamata al termine di ogni file.
+    Ritorna (df o None, lista di stati per file: File, Righe, Secondi, Esito).
+    L'errore di un file (file malformato, risultato non trasferibile dal
+    processo) finisce nel suo Esito e gli altri file vengono caricati; solo
+    un guasto del pool fa ripartire il caricamento in sequenza.
+    """
+    voci = espandi_upload(files)
+    if plan is None:
+        plan = {}
+    # Stesso gestionale, stesso formato: rilevato una volta sul primo CSV
+    # e passato a tutti i processi, che saltano il rilevamento
+    voci_csv = [raw for nome, raw in voci if not nome.lower().endswith(('.xlsx', '.xls', '.xlsm'))]
+    if voci_csv and not plan:
+        plan.update(rileva_formato(io.BytesIO(voci_csv[0])) or {})
+
+    risultati = [None] * len(voci)
+    n = min(len(voci), MAX_PROCESSI)
+    fatti = 0
+    if n > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n) as pool:
+                futures = {pool.submit(_carica_file_batch, nome, raw, plan, trasforma): i
+                           for i, (nome, raw) in enumerate(voci)}
+                for fut in as_completed(futures):
+                    i = futures[fut]
+                    try:
+                        risultati[i] = fut.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        risultati[i] = (None, _stato_errore(voci[i][0], e))
+                    fatti += 1
+                    if on_file:
+                        on_file(fatti, len(voci), risultati[i][1])
+        except (BrokenProcessPool, OSError):
+            risultati, fatti = [None] * len(voci), 0   # ambiente senza processi: sequenziale
+    for i, (nome, raw) in enumerate(voci):
+        if risultati[i] is None:
+            risultati[i] = _carica_file_batch(nome, raw, plan, trasforma)
+            fatti += 1
+            if on_file:
+                on_file(fatti, len(voci), risultati[i][1])
 
-        return df if not df.empty else None
+    parts, stati = [], []
+    for df, stato in risultati:
+        stati.append(stato)
+        if df is not None:
+            df['File'] = stato['File']
+            parts.append(df)
+    if not parts:
+        return None, stati
+    df = concat_categorie(parts)
+    df['File'] = df['File'].astype('category')
+    return df, stati
 
-    except Exception:
+
+def _carica_file_batch(nome, raw, plan, trasforma=None):
+    """Carica un singolo file del batch. Funzione di modulo: gira nei processi del pool."""
+    t0 = time.perf_counter()
+    f = io.BytesIO(raw)
+    f.name = nome
+    report = {}
+    try:
+        df = smart_load(f, plan=dict(plan), report=report)
+        if df is not None and trasforma:
+            df = trasforma(df)
+    except Exception as e:
+        return None, _stato_errore(nome, e, time.perf_counter() - t0)
+    stato = {
+        'File':    nome,
+        'Righe':   len(df) if df is not None else 0,
+        'Secondi': round(time.perf_counter() - t0, 2),
+        'Esito':   'OK' if df is not None else 'Non leggibile',
+    }
+    if report.get('righe_scartate'):
+        stato['Esito'] += ' · {} righe scartate'.format(report['righe_scartate'])
+    return df, stato
+
+
+def _stato_errore(nome, errore, secondi=0.0):
+    return {'File': nome, 'Righe': 0, 'Secondi': round(secondi, 2),
+            'Esito': 'Errore: {}'.format(errore.__class__.__name__)}
+
+
+# ─── UPLOAD GIÀ ELABORATI ────────────────────────────────────────────────────
+# Streamlit riesegue lo script a ogni click: finché un file resta nel
+# file_uploader lo si ritrova a ogni rerun. Ogni slot (chiave del widget)
+# ricorda file_id + SHA-256 dell'ultimo upload elaborato e il suo esito.
+
+def impronta_upload(file):
+    """
+    SHA-256 esadecimale del contenuto dell'upload (senza copiarne i byte).
+    Per un upload multiplo (lista di file) copre tutti i file, in ordine.
+    """
+    h = hashlib.sha256()
+    for f in (file if isinstance(file, list) else [file]):
+        if hasattr(f, 'getbuffer'):
+            h.update(f.getbuffer())
+        else:
+            if hasattr(f, 'seek'):
+                f.seek(0)
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def stato_upload(file, slot):
+    """
+    None se l'upload nello slot è nuovo e va elaborato; altrimenti l'esito
+    (True/False) registrato con segna_upload. Il file_id evita di ricalcolare
+    l'hash a ogni rerun; l'hash riconosce lo stesso contenuto ricaricato.
+    """
+    visti = st.session_state.setdefault('_upload_elaborati', {})
+    rec = visti.get(slot)
+    if isinstance(file, list):
+        ids = [getattr(f, 'file_id', None) for f in file]
+        file_id = '|'.join(ids) if all(ids) else None
+    else:
+        file_id = getattr(file, 'file_id', None)
+    if rec and rec['ok'] is not None and file_id and rec['file_id'] == file_id:
+        return rec['ok']
+    sha = impronta_upload(file)
+    if rec and rec['ok'] is not None and rec['sha'] == sha:
+        rec['file_id'] = file_id
+        return rec['ok']
+    visti[slot] = {'file_id': file_id, 'sha': sha, 'ok': None}
+    return None
+
+
+def impronta_slot(slot, variante=None):
+    """
+    SHA-256 dell'upload corrente dello slot (calcolato da stato_upload).
+    variante (es. i fogli Excel scelti) distingue letture diverse dello stesso file.
+    """
+    rec = st.session_state.get('_upload_elaborati', {}).get(slot)
+    if not rec:
+        return None
+    if not variante:
+        return rec['sha']
+    return hashlib.sha256('|'.join([rec['sha']] + list(variante)).encode('utf-8')).hexdigest()
+
+
+def impronta_frame(df):
+    """
+    SHA-256 del contenuto di un DataFrame (nomi colonna + valori, indice
+    escluso), calcolato in modo vettoriale: stessa tabella → stessa impronta,
+    anche se ricaricata o ricostruita. None per frame assenti.
+    """
+    if df is None:
+        return None
+    h = hashlib.sha256('|'.join(map(str, df.columns)).encode('utf-8'))
+    if len(df):
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def impronta_dati(obj):
+    """SHA-256 di dati JSON-like (mapping, schema, rettifiche): chiavi in ordine."""
+    testo = json.dumps(obj, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(testo.encode('utf-8')).hexdigest()
+
+
+# id(frame) → (weakref, impronta): i frame del cliente si sostituiscono a ogni
+# caricamento e non si modificano sul posto, quindi l'impronta di un oggetto
+# si calcola una volta sola
+_VERSIONI_FRAME = {}
+
+
+def versione_frame(df):
+    """impronta_frame memorizzata per oggetto: costa un hash solo al primo uso."""
+    if df is None:
         return None
+    k = id(df)
+    rec = _VERSIONI_FRAME.get(k)
+    if rec is not None and rec[0]() is df:
+        return rec[1]
+    digest = impronta_frame(df)
+    _VERSIONI_FRAME[k] = (weakref.ref(df, lambda _r, k=k: _VERSIONI_FRAME.pop(k, None)), digest)
+    return digest
+
+
+def segna_upload(slot, ok=True):
+    """Registra l'esito dell'elaborazione dell'upload corrente dello slot."""
+    rec = st.session_state.setdefault('_upload_elaborati', {}).get(slot)
+    if rec is not None:
+        rec['ok'] = bool(ok)
 
 
 def find_column(df, candidates):
@@ -107,81 +765,175 @@ def find_column(df, candidates):
     """
     if df is None or df.empty:
         return None
-    cols = list(df.columns)
+    return abbina_colonna(list(df.columns), candidates)[0]
+
 
+def abbina_colonna(cols, candidates):
+    """
+    La ricerca di find_column su un elenco di nomi colonna.
+    Ritorna (colonna, esatta): esatta=False se trovata solo per corrispondenza
+    parziale, l'unico caso in cui la scelta può essere sbagliata.
+    """
     # 1. Esatto
     for c in candidates:
         if c in cols:
-            return c
+            return c, True
 
     # 2. Case-insensitive
     lower_map = {str(col).lower().strip(): col for col in cols}
     for c in candidates:
         k = str(c).lower().strip()
         if k in lower_map:
-            return lower_map[k]
+            return lower_map[k], True
 
     # 3. Partial match (candidato contenuto nel nome colonna)
     for c in candidates:
         k = str(c).lower().strip()
         for col in cols:
             if k in str(col).lower().strip():
-                return col
+                return col, False
 
-    return None
+    return None, False
+
+
+# Valuta, spazi e parentesi da togliere dagli importi (una regex, solo se presenti)
+_RE_SPORCO_IMPORTI = '[€$£\\s\xa0\u202f()]'   # caratteri letterali: la regex va anche ad Arrow (RE2)
+# Solo separatori di migliaia (1.234 / 1,234): non dicono quale sia il decimale
+_RE_SOLO_MIGLIAIA = re.compile(r'^[-+]?\d{1,3}([.,])\d{3}(\1\d{3})*$')
+_CAMPIONE_IMPORTI = 5000
+
+
+def rileva_decimale_importi(valori):
+    """
+    Separatore decimale (',' o '.') di una colonna di importi, deciso su un
+    campione di valori già ripuliti da valuta e spazi. Con entrambi i
+    separatori vince l'ultimo; i valori ambigui (solo migliaia) non votano.
+    A parità prevale la convenzione italiana.
+    """
+    virgola = punto = 0
+    for v in valori:
+        i, j = v.rfind(','), v.rfind('.')
+        if i < 0 and j < 0:
+            continue
+        if (i < 0 or j < 0) and _RE_SOLO_MIGLIAIA.match(v):
+            continue
+        if i > j:
+            virgola += 1
+        else:
+            punto += 1
+    return '.' if punto > virgola else ','
 
 
-def to_numeric(series):
+def to_numeric(series, report=None, invalidi=0.0, decimale=None):
     """
     Converte serie testuale a float. Gestisce:
     - Formato italiano: 1.234,56 → 1234.56
     - Formato US: 1,234.56 → 1234.56
     - Negativi in parentesi: (1.234) → -1234
-    - Simbolo euro, spazi, NBSP
+    - Simbolo euro/valuta, spazi, NBSP
+    Il formato (decimale e migliaia) è deciso una volta per colonna su un
+    campione, poi la colonna è convertita in un solo passaggio di pulizia
+    (niente doppio parsing italiano/US). decimale (',' o '.'), se passato,
+    impone il separatore senza rilevarlo: serve a leggere allo stesso modo
+    tutti i blocchi di un file.
+    Le celle vuote valgono 0.0; quelle non interpretabili valgono `invalidi`
+    (0.0, o NaN per distinguerle) e sono contate in report, se passato:
+    {'decimale', 'falliti', 'esempi'}.
     """
     if series is None:
         return pd.Series([], dtype=float)
 
     # Se già numerica
-    if hasattr(series, 'dtype'):
-        if series.dtype in [np.float64, np.float32, np.int64, np.int32, int, float]:
-            return series.astype(float)
-
-    s = series.astype(str).str.strip()
-    # Rimuovi caratteri non numerici non significativi
-    s = s.str.replace('€', '', regex=False)
-    s = s.str.replace('\xa0', '', regex=False)
-    s = s.str.replace('\u202f', '', regex=False)
-    s = s.str.replace('\u00a0', '', regex=False)
-    s = s.str.replace(' ', '', regex=False)
-
-    # Identifica negativi tra parentesi: (100) → -100
-    mask_paren = s.str.match(r'^\(.*\)$')
-    s = s.str.replace('(', '', regex=False).str.replace(')', '', regex=False)
-
-    # Identificare il formato: se ci sono punti E virgole, quale è il decimale?
-    # Italiano: 1.234,56 → rimuovi punto, sostituisci virgola con punto
-    # US:       1,234.56 → rimuovi virgola
-    # Solo virgola: 1234,56 → sostituisci virgola con punto
-    # Solo punto:   1234.56 → ok così
-    has_dot   = s.str.contains(r'\.', regex=True)
-    has_comma = s.str.contains(',', regex=False)
-
-    s_it = s.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-    s_en = s.str.replace(',', '', regex=False)
-
-    result = pd.to_numeric(s_it, errors='coerce')
-    # Dove it-parse fallisce, prova en
-    bad = result.isna() & (s != '') & (s.str.lower() != 'nan') & (s != '0')
-    if bad.any():
-        result[bad] = pd.to_numeric(s_en[bad], errors='coerce')
-
-    result = result.fillna(0.0)
+    if hasattr(series, 'dtype') and pd.api.types.is_numeric_dtype(series.dtype) \
+            and not pd.api.types.is_bool_dtype(series.dtype):
+        if report is not None:
+            report.update({'decimale': None, 'falliti': 0, 'esempi': []})
+        return series.astype(float)
+
+    rep = {}
+    vals = converti_unici(series, lambda u: _converti_importi(u, rep, decimale))
+    vals = vals.to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+    fallito = np.isnan(vals)
+    n_falliti = int(fallito.sum())
+    if n_falliti:
+        vals[fallito] = invalidi
+
+    if report is not None:
+        report.update({'decimale': rep.get('decimale'), 'falliti': n_falliti,
+                       'esempi': rep.get('esempi', [])})
+    return pd.Series(vals, index=series.index, name=getattr(series, 'name', None))
+
+
+def _converti_importi(series, rep, decimale=None):
+    """Corpo di to_numeric: float con 0.0 per le celle vuote e NaN per quelle non valide."""
+    raw = series.astype(str).str.strip()
+    dec = decimale
+    if dec not in (',', '.'):
+        campione = raw.dropna().head(_CAMPIONE_IMPORTI).unique()
+        dec = rileva_decimale_importi([re.sub(_RE_SPORCO_IMPORTI, '', v) for v in campione])
+    neg = raw.str.startswith('(').fillna(False).to_numpy(dtype=bool)
+
+    # Pulizia con le sole sostituzioni che servono, tutte vettoriali
+    s = raw
+    if s.str.contains(_RE_SPORCO_IMPORTI, regex=True).any():
+        s = s.str.replace(_RE_SPORCO_IMPORTI, '', regex=True)
+    if dec == ',':
+        s = s.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    else:
+        s = s.str.replace(',', '', regex=False)
+    try:
+        vals = s.astype(np.float64).to_numpy(copy=True)   # colonna pulita: cast diretto
+    except (ValueError, TypeError):
+        vals = pd.to_numeric(s, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+
+    na = np.isnan(vals)
+    rep.update({'decimale': dec, 'esempi': []})
+    if na.any():
+        cand = s[na]
+        vuoto = (series[na].isna() | cand.isna() | (cand == '') | (cand.str.lower() == 'nan')).to_numpy()
+        idx = np.flatnonzero(na)
+        vals[idx[vuoto]] = 0.0
+        rep['esempi'] = list(pd.unique(raw.iloc[idx[~vuoto][:200]]))[:5]
 
     # Applica segno negativo per parentesi
-    result[(mask_paren) & (result > 0)] *= -1
+    vals[neg & (vals > 0)] *= -1
+    return vals
+
+
+# ─── CONVERSIONE SUI VALORI DISTINTI ─────────────────────────────────────────
 
-    return result
+_CAMPIONE_UNICI = 10_000
+
+def converti_unici(series, fn, soglia=0.5):
+    """
+    Applica fn ai soli valori distinti di una colonna e riporta i risultati
+    su tutte le righe tramite i codici interi (factorize). Le colonne di un
+    ledger (date, conti, importi tondi) si ripetono moltissimo: convertire
+    poche migliaia di valori distinti invece di milioni di celle.
+    fn(Series) -> array/Series della stessa lunghezza. Le colonne category
+    usano direttamente categorie e codici. Se i distinti superano `soglia`
+    delle righe la factorize non conviene e fn lavora sull'intera colonna.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        uniques = pd.Series(series.cat.categories)
+    else:
+        # Stima sulle prime righe: una colonna quasi tutta distinta (importi
+        # con decimali) non ripaga nemmeno il costo della factorize
+        testa = series.iloc[:_CAMPIONE_UNICI]
+        if len(testa) > 100 and testa.nunique(dropna=False) > len(testa) * soglia:
+            return pd.Series(np.asarray(fn(series)), index=series.index, name=series.name)
+        codes, uniques = pd.factorize(series)
+        if len(uniques) > len(series) * soglia:
+            return pd.Series(np.asarray(fn(series)), index=series.index, name=series.name)
+        uniques = pd.Series(uniques)
+    mancanti = codes < 0
+    if mancanti.any():
+        # I NaN passano da fn come un valore distinto in più
+        codes = np.where(mancanti, len(uniques), codes)
+        uniques = uniques.reindex(range(len(uniques) + 1))
+    out = np.asarray(fn(uniques))
+    return pd.Series(out.take(codes), index=series.index, name=series.name)
 
 
 def fmt_eur(val, show_sign=False, decimals=0):
@@ -266,7 +1018,8 @@ def get_api_key():
 def cliente_vuoto():
     return {
         'df_piano': None, 'df_db': None, 'df_ricl': None,
-        'mapping': {}, 'rettifiche': [],
+        'mapping': {}, 'rettifiche': [], 'piani_parsing': {},
+        'ruoli_colonne': {},
         'schemi': {}, 'schema_attivo': None,
         'budget': {}, 'email_config': {}, 'report_history': [],
         'cfo_settings': {
@@ -0,0 +1,109 @@
+"""formule.py — Motore delle righe 'formula' dello schema CE.
+
+Ogni formula si analizza una volta in un AST sicuro (numeri, codici voce,
+operatori aritmetici, parentesi), le dipendenze tra formule si ordinano
+topologicamente (i cicli vengono segnalati, non valutati) e ogni formula si
+valuta sull'intero vettore dei mesi con una sola espressione numpy.
+"""
+import ast
+import re
+import numpy as np
+
+_NODI_AMMESSI = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.UAdd, ast.USub,
+)
+
+
+def _segnaposto(i):
+    return '_v{}'.format(i)
+
+
+def analizza_formula(formula_str, codici):
+    """
+    Formula → dict:
+      codice      : code object da valutare (None se formula vuota o non valida)
+      riferimenti : codici voce usati, nell'ordine dei segnaposto _v0, _v1, ...
+      errore      : messaggio leggibile se la formula non è valida, altrimenti None
+    I codici (anche con punti o spazi, es. 'B6.1') sono riconosciuti solo come
+    token interi: 'B6' non viene sostituito dentro 'B6.1' o 'B61'.
+    """
+    formula_str = (formula_str or '').strip()
+    if not formula_str:
+        return {'codice': None, 'riferimenti': [], 'errore': None}
+
+    riferimenti = []
+    if codici:
+        alternative = '|'.join(re.escape(c) for c in sorted(codici, key=len, reverse=True))
+        pattern = re.compile(r'(?<![\w.])(?:' + alternative + r')(?![\w.])')
+
+        def _sostituisci(m):
+            if m.group(0) not in riferimenti:
+                riferimenti.append(m.group(0))
+            return _segnaposto(riferimenti.index(m.group(0)))
+        espr = pattern.sub(_sostituisci, formula_str)
+    else:
+        espr = formula_str
+
+    try:
+        albero = ast.parse(espr, mode='eval')
+    except SyntaxError:
+        return {'codice': None, 'riferimenti': riferimenti, 'errore': 'sintassi non valida'}
+
+    ammessi = {_segnaposto(i) for i in range(len(riferimenti))}
+    for nodo in ast.walk(albero):
+        if not isinstance(nodo, _NODI_AMMESSI):
+            return {'codice': None, 'riferimenti': riferimenti,
+                    'errore': 'elemento non ammesso ({})'.format(type(nodo).__name__)}
+        if isinstance(nodo, ast.Name) and nodo.id not in ammessi:
+            return {'codice': None, 'riferimenti': riferimenti,
+                    'errore': 'voce sconosciuta: {}'.format(nodo.id)}
+        if isinstance(nodo, ast.Constant):
+            if isinstance(nodo.value, bool) or not isinstance(nodo.value, (int, float)):
+                return {'codice': None, 'riferimenti': riferimenti,
+                        'errore': 'costante non numerica: {!r}'.format(nodo.value)}
+            # Costanti float: niente aritmetica intera illimitata (es. 9**9**9)
+            nodo.value = float(nodo.value)
+
+    return {'codice': compile(albero, '<formula>', 'eval'),
+            'riferimenti': riferimenti, 'errore': None}
+
+
+def ordina_formule(dipendenze):
+    """
+    {formula: insieme delle formule da cui dipende} →
+    (ordine di valutazione, formule non risolvibili perché in un ciclo o a valle di un ciclo).
+    """
+    mancanti = {f: set(d) for f, d in dipendenze.items()}
+    ordine = []
+    pronte = [f for f in dipendenze if not mancanti[f]]
+    while pronte:
+        f = pronte.pop(0)
+        ordine.append(f)
+        for g in dipendenze:
+            if f in mancanti[g]:
+                mancanti[g].discard(f)
+                if not mancanti[g]:
+                    pronte.append(g)
+    risolte = set(ordine)
+    return ordine, [f for f in dipendenze if f not in risolte]
+
+
+def valuta_formula(analisi, valori, n_mesi):
+    """
+    Valuta la formula sul vettore dei mesi: valori = {codice: array dei mesi}.
+    Mesi con risultato non finito (divisione per zero, overflow) → 0, come
+    formule vuote o non valide.
+    """
+    if analisi['codice'] is None:
+        return np.zeros(n_mesi)
+    ns = {_segnaposto(i): valori.get(c, np.zeros(n_mesi))
+          for i, c in enumerate(analisi['riferimenti'])}
+    try:
+        with np.errstate(all='ignore'):
+            risultato = eval(analisi['codice'], {'__builtins__': {}}, ns)
+        risultato = np.broadcast_to(np.asarray(risultato, dtype=float), (n_mesi,))
+    except Exception:
+        return np.zeros(n_mesi)
+    return np.where(np.isfinite(risultato), risultato, 0.0)
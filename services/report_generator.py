@@ -3,6 +3,7 @@ report_generator.py — Report HTML professionali per email e download.
 Design: Bloomberg Terminal × McKinsey Deck — dark premium.
 """
 from datetime import datetime
+from services.riclassifica import get_mesi_disponibili, label_mese
 
 
 REPORT_CSS = """
@@ -382,12 +383,12 @@ def format_ce_for_prompt(pivot, mesi_sel: list, include_totale: bool = True) ->
         return "Dati CE non disponibili"
     cols = [c for c in mesi_sel if c in pivot.columns]
     if not cols:
-        cols = [c for c in pivot.columns if c != 'TOTALE']
+        cols = get_mesi_disponibili(pivot)
     if not cols:
         return "Nessun dato mensile"
 
     lines = []
-    col_header = " | ".join(f"{c:>10}" for c in cols)
+    col_header = " | ".join(f"{label_mese(c):>10}" for c in cols)
     lines.append(f"{'Voce CE':<38} | {col_header} | {'TOTALE':>10}")
     lines.append("─" * (38 + 14 * len(cols) + 14))
 
@@ -446,7 +447,7 @@ def format_budget_variance_for_prompt(pivot, budget: dict, mesi_sel: list) -> st
         if voce not in budget:
             continue
         eff = sum(float(pivot.loc[voce, m]) for m in mesi_sel if m in pivot.columns)
-        bud = sum(budget[voce].get(m, 0) for m in mesi_sel)
+        bud = sum(budget[voce].get(label_mese(m), 0) for m in mesi_sel)
         if bud == 0:
             continue
         scost = eff - bud
@@ -10,10 +10,129 @@ FIX FONDAMENTALE (v3):
 """
 import pandas as pd
 import numpy as np
-from services.data_utils import find_column, to_numeric
+from collections.abc import Mapping
+from services.data_utils import (
+    find_column, abbina_colonna, to_numeric, concat_categorie, converti_unici,
+    versione_frame, impronta_dati
+)
+from services.formule import analizza_formula, ordina_formule, valuta_formula
+
+
+# ─── RUOLI COLONNE ───────────────────────────────────────────────────────────
+# Ogni file caricato ha colonne con un ruolo (data, importo, conto, codice,
+# descrizione). I ruoli si riconoscono una volta al caricamento con la ricerca
+# per alias di find_column, l'utente conferma quelli dubbi (trovati solo per
+# corrispondenza parziale), e il risultato resta col cliente
+# (cliente['ruoli_colonne']) e sul frame (df.attrs['ruoli']): da lì in poi
+# colonna() è una lettura di dizionario, sempre con la stessa risposta.
+
+COL_DATA  = ['Data','data','DATA','DataDoc','DataRegistrazione',
+             'data_registrazione','DataReg','Competenza','Date']
+COL_SALDO = ['Saldo','saldo','SALDO','Importo','importo',
+             'Valore','valore','ImportoMovimento','Totale','Amount']
+COL_CONTO = ['Conto','conto','CONTO','CodConto','CodiceConto',
+             'codice_conto','Mastro','mastro','Account']
+COL_DESCR = ['Descrizione','descrizione','DESCRIZIONE','Causale','causale',
+             'DescrizioneMovimento','Note','note','Description']
+
+RUOLI_COLONNE = {
+    'df_db': {
+        'data':        COL_DATA,
+        'importo':     COL_SALDO,
+        'conto':       COL_CONTO,
+        'descrizione': COL_DESCR,
+    },
+    'df_piano': {
+        'codice':      ['Codice','codice','CodConto','Conto','conto','ID'],
+        'descrizione': ['Descrizione','descrizione','Nome','nome','Conto','conto'],
+    },
+    'df_ricl': {
+        'codice':      ['Codice','codice','CODE','code','ID','id',
+                        'CodVoce','cod_voce','CodiceVoce','codice_voce',
+                        'Voce','voce','Key','key','Cod'],
+        'descrizione': ['Descrizione','descrizione','DESCRIZIONE',
+                        'Nome','nome','NOME','Label','label','LABEL',
+                        'Description','Desc','desc','Testo','testo',
+                        'DescrizioneVoce','descrizione_voce','NomeVoce'],
+    },
+}
+RUOLI_FACOLTATIVI = ('descrizione',)
+ETICHETTE_RUOLI = {
+    'data': 'Data', 'importo': 'Importo', 'conto': 'Conto',
+    'codice': 'Codice', 'descrizione': 'Descrizione',
+}
+
+
+def rileva_ruoli(df, tipo, noti=None):
+    """
+    Riconosce i ruoli delle colonne di un frame di tipo 'df_db' / 'df_piano' /
+    'df_ricl'. noti = ruoli già confermati (es. dal caricamento precedente):
+    valgono finché la colonna esiste. Le colonne tecniche (_saldo_num, ...)
+    non concorrono. Ritorna (ruoli, dubbi): ruoli = {ruolo: colonna o None},
+    dubbi = ruoli obbligatori non trovati o trovati per corrispondenza parziale
+    tra più colonne candidate, da far confermare all'utente.
+    """
+    cols = [c for c in df.columns if not str(c).startswith('_')] if df is not None else []
+    ruoli, dubbi = {}, []
+    for ruolo, candidati in RUOLI_COLONNE[tipo].items():
+        if noti and ruolo in noti and (noti[ruolo] is None or noti[ruolo] in cols):
+            ruoli[ruolo] = noti[ruolo]
+            continue
+        col, esatta = abbina_colonna(cols, candidati)
+        ruoli[ruolo] = col
+        if col is None:
+            if ruolo not in RUOLI_FACOLTATIVI:
+                dubbi.append(ruolo)
+        elif not esatta:
+            chiavi = [str(k).lower().strip() for k in candidati]
+            simili = [c for c in cols if any(k in str(c).lower().strip() for k in chiavi)]
+            if len(simili) > 1:
+                dubbi.append(ruolo)
+    return ruoli, dubbi
+
+
+def colonna(df, tipo, ruolo):
+    """
+    Colonna che ha il ruolo dato nel frame: dal registro df.attrs['ruoli'] se
+    presente, altrimenti con la ricerca per alias (frame non registrati).
+    """
+    if df is None:
+        return None
+    ruoli = df.attrs.get('ruoli')
+    if ruoli and ruolo in ruoli and (ruoli[ruolo] is None or ruoli[ruolo] in df.columns):
+        return ruoli[ruolo]
+    return find_column(df, RUOLI_COLONNE[tipo][ruolo])
 
 
 # ─── LABEL MAP HELPERS ───────────────────────────────────────────────────────
+# Le mappe servono a ogni rerun (dashboard, CE, configurazione, workspace):
+# si costruiscono in modo vettoriale e si memorizzano per versione del frame
+# sorgente, quindi una volta per upload. Le mappe memorizzate sono condivise:
+# i chiamanti le usano in sola lettura.
+
+_MEMO_MAPPE = {}
+_MAX_MEMO_MAPPE = 16
+
+_NON_VALIDI = ('nan', 'none', '')
+
+
+def _memo_mappa(tipo, df, costruisci):
+    # Anche i ruoli fanno parte della chiave: riassegnarli cambia la mappa
+    ruoli = tuple(sorted((df.attrs.get('ruoli') or {}).items()))
+    chiave = (tipo, versione_frame(df), ruoli)
+    mappa = _MEMO_MAPPE.get(chiave)
+    if mappa is None:
+        mappa = costruisci(df)
+        if len(_MEMO_MAPPE) >= _MAX_MEMO_MAPPE:
+            _MEMO_MAPPE.pop(next(iter(_MEMO_MAPPE)))
+        _MEMO_MAPPE[chiave] = mappa
+    return mappa
+
+
+def _testo(col):
+    """Colonna → stringhe pulite; i valori mancanti diventano ''."""
+    return col.astype(object).where(col.notna(), '').astype(str).str.strip()
+
 
 def get_label_map(df_ricl):
     """cod_riclassifica → label descrittivo (da df_ricl).
@@ -21,17 +140,12 @@ def get_label_map(df_ricl):
     """
     if df_ricl is None or df_ricl.empty:
         return {}
-    col_cod  = find_column(df_ricl, [
-        'Codice','codice','CODE','code','ID','id',
-        'CodVoce','cod_voce','CodiceVoce','codice_voce',
-        'Voce','voce','Key','key','Cod'
-    ])
-    col_desc = find_column(df_ricl, [
-        'Descrizione','descrizione','DESCRIZIONE',
-        'Nome','nome','NOME','Label','label','LABEL',
-        'Description','Desc','desc','Testo','testo',
-        'DescrizioneVoce','descrizione_voce','NomeVoce'
-    ])
+    return _memo_mappa('ricl', df_ricl, _costruisci_label_map)
+
+
+def _costruisci_label_map(df_ricl):
+    col_cod  = colonna(df_ricl, 'df_ricl', 'codice')
+    col_desc = colonna(df_ricl, 'df_ricl', 'descrizione')
     if not col_cod:
         # Fallback: assume first col = code, second = description
         cols = list(df_ricl.columns)
@@ -39,76 +153,252 @@ def get_label_map(df_ricl):
             col_cod, col_desc = cols[0], cols[1]
         else:
             return {}
-    result = {}
-    for _, row in df_ricl.iterrows():
-        cod  = str(row[col_cod]).strip()
-        if col_desc and col_desc != col_cod:
-            desc = str(row[col_desc]).strip()
-        else:
-            desc = ''
-        bad = ('nan', 'none', '', 'n/a', 'na')
-        if cod and cod.lower() not in bad:
-            # Solo memorizza desc se è diversa dal codice (altrimenti è inutile)
-            if desc and desc.lower() not in bad and desc != cod:
-                result[cod] = desc
-            else:
-                result[cod] = cod  # almeno il codice stesso
-    return result
+    bad  = _NON_VALIDI + ('n/a', 'na')
+    cod  = _testo(df_ricl[col_cod])
+    desc = _testo(df_ricl[col_desc]) if (col_desc and col_desc != col_cod) else cod
+    ok   = ~cod.str.lower().isin(bad)
+    # Solo memorizza desc se è diversa dal codice (altrimenti è inutile)
+    val  = desc.where(~desc.str.lower().isin(bad) & (desc != cod), cod)
+    return dict(zip(cod[ok], val[ok]))
 
 
 def get_conto_label_map(df_piano):
     """cod_conto → descrizione conto (da df_piano)."""
     if df_piano is None or df_piano.empty:
         return {}
-    col_cod  = find_column(df_piano, ['Codice','codice','CodConto','Conto','conto','ID'])
-    col_desc = find_column(df_piano, ['Descrizione','descrizione','Nome','nome','Conto','conto'])
+    return _memo_mappa('piano', df_piano, _costruisci_conto_label_map)
+
+
+def _costruisci_conto_label_map(df_piano):
+    col_cod  = colonna(df_piano, 'df_piano', 'codice')
+    col_desc = colonna(df_piano, 'df_piano', 'descrizione')
     if not col_cod:
         return {}
-    result = {}
-    for _, row in df_piano.iterrows():
-        cod  = str(row[col_cod]).strip()
-        desc = str(row[col_desc]).strip() if (col_desc and col_desc != col_cod) else cod
-        if cod and cod.lower() not in ('nan', 'none', ''):
-            result[cod] = desc if desc.lower() not in ('nan', 'none', '') else cod
-    return result
+    cod  = _testo(df_piano[col_cod])
+    desc = _testo(df_piano[col_desc]) if (col_desc and col_desc != col_cod) else cod
+    ok   = ~cod.str.lower().isin(_NON_VALIDI)
+    val  = desc.where(~desc.str.lower().isin(_NON_VALIDI), cod)
+    return dict(zip(cod[ok], val[ok]))
 
 
-# ─── RETTIFICHE ──────────────────────────────────────────────────────────────
+# ─── LEDGER TIPIZZATO ────────────────────────────────────────────────────────
+
+TIPIZZATE = ['_saldo_num', '_mese_key', '_conto_str']
 
-def applica_rettifiche(df_db, rettifiche, col_conto, col_saldo, col_data):
-    if not rettifiche:
+
+def colonne_ledger(df_db):
+    """(col_data, col_saldo, col_conto) del DB contabile, None se mancanti."""
+    return (colonna(df_db, 'df_db', 'data'),
+            colonna(df_db, 'df_db', 'importo'),
+            colonna(df_db, 'df_db', 'conto'))
+
+
+def prepara_ledger(df_db, giorno=False, ruoli=None):
+    """
+    Ledger tipizzato, da creare una volta al caricamento del DB contabile.
+    Aggiunge alle colonne originali:
+      _saldo_num  float64   importo numerico (NaN = importo non interpretabile)
+      _mese_key   int32     mese AAAAMM (0 = data non riconosciuta)
+      _conto_str  category  codice conto normalizzato
+      _giorno_key int32     data AAAAMMGG, solo con giorno=True
+    e converte in category le colonne testuali ripetitive (date, conti, causali),
+    che sono la gran parte della memoria di un frame tutto-stringa.
+    Funziona anche su un singolo blocco del caricamento streaming.
+    ruoli = ruoli confermati dal cliente (rileva_ruoli); il ledger li porta
+    con sé in attrs['ruoli']. attrs['decimale'] del frame, se presente,
+    impone il separatore decimale degli importi; quello usato finisce in
+    attrs['decimale'] del ledger (lo streaming lo passa ai blocchi successivi).
+    """
+    if df_db is None or df_db.empty or '_mese_key' in df_db.columns:
         return df_db
-    rows = []
-    for r in rettifiche:
-        row = {c: '' for c in df_db.columns}
-        row[col_conto] = str(r.get('conto', ''))
-        row[col_saldo] = str(r.get('importo', 0))
-        mese = r.get('mese', '')
-        if mese and col_data in df_db.columns:
-            parts = mese.split('-')
-            row[col_data] = '01/{}/{}'.format(parts[1], parts[0]) if len(parts) == 2 else r.get('data', '')
-        rows.append(row)
-    if rows:
-        df_db = pd.concat([df_db, pd.DataFrame(rows)], ignore_index=True)
-    return df_db
+    ruoli, _ = rileva_ruoli(df_db, 'df_db', noti=ruoli or df_db.attrs.get('ruoli'))
+    col_data, col_saldo, col_conto = ruoli['data'], ruoli['importo'], ruoli['conto']
+    if not (col_data and col_saldo and col_conto):
+        return df_db
+
+    db = df_db.copy()
+    db.attrs['ruoli'] = ruoli
+    for c in db.columns:
+        if db[c].dtype == object or pd.api.types.is_string_dtype(db[c].dtype):
+            if c in (col_data, col_conto) or db[c].nunique() < len(db) * 0.5:
+                db[c] = db[c].astype('category')
+
+    # Importi non interpretabili -> NaN (non 0.0): restano contabili e visibili
+    rep = {}
+    db['_saldo_num'] = to_numeric(db[col_saldo], report=rep, invalidi=np.nan,
+                                  decimale=df_db.attrs.get('decimale')).astype(np.float64)
+    if rep.get('decimale'):
+        db.attrs['decimale'] = rep['decimale']
+    # Date e conti si ripetono: conversione sui soli valori distinti
+    if giorno:
+        db['_mese_key'], db['_giorno_key'] = chiavi_data(db[col_data], giorno=True)
+    else:
+        db['_mese_key'] = chiavi_data(db[col_data])
+    db['_conto_str'] = converti_unici(db[col_conto], lambda u: u.astype(str).str.strip()).astype('category')
+    return db
+
+
+def impronta_movimenti(db):
+    """
+    Hash (uint64) di ogni movimento di un ledger tipizzato, calcolato in modo
+    vettoriale su data, conto, importo e descrizione: due righe con lo stesso
+    hash sono lo stesso movimento. La data entra come chiave giorno AAAAMMGG,
+    così lo stesso movimento esportato in CSV ('05/01/2024') e in Excel
+    ('2024-01-05 00:00:00') ha lo stesso hash; le date non riconosciute
+    restano col testo originale.
+    """
+    col_data  = colonna(db, 'df_db', 'data')
+    col_descr = colonna(db, 'df_db', 'descrizione')
+    _, giorno = chiavi_data(db[col_data], giorno=True)
+    testo     = db[col_data].astype(str).str.strip()
+    chiave = pd.DataFrame({
+        'data':    testo.where(giorno == 0, pd.Series(giorno, index=db.index).astype(str)),
+        'conto':   db['_conto_str'].astype(str),
+        'importo': db['_saldo_num'].round(2),
+        'descr':   db[col_descr].astype(str).str.strip() if col_descr else '',
+    })
+    return pd.util.hash_pandas_object(chiave, index=False).to_numpy()
+
+
+def accoda_movimenti(df_db, df_nuovi):
+    """
+    Accoda al ledger esistente i movimenti di un nuovo file, scartando quelli
+    già presenti (stesso hash di impronta_movimenti). I duplicati interni al
+    nuovo file restano: due movimenti identici nello stesso file sono leciti.
+    Ritorna (ledger, esito) con esito = {'nuovi', 'duplicati', 'mesi'}:
+    mesi = chiavi AAAAMM toccate dai movimenti accodati. Se il cubo del
+    ledger esistente è in memoria, quello nuovo si ottiene sommandogli i
+    soli movimenti accodati (nessuna riaggregazione dell'intero ledger).
+    Se il nuovo file non ha le colonne Data/Conto/Importo ritorna (df_db, None).
+    """
+    # Il nuovo estratto viene dallo stesso gestionale: stessi ruoli del ledger
+    nuovi = prepara_ledger(df_nuovi, ruoli=df_db.attrs.get('ruoli') if df_db is not None else None)
+    if nuovi is None or '_mese_key' not in nuovi.columns:
+        return df_db, None
+    db = prepara_ledger(df_db) if df_db is not None else None
+    if db is None or db.empty or '_mese_key' not in db.columns:
+        mesi = sorted(int(m) for m in nuovi['_mese_key'].unique() if m > 0)
+        return nuovi, {'nuovi': len(nuovi), 'duplicati': 0, 'mesi': mesi}
+
+    gia = np.isin(impronta_movimenti(nuovi), impronta_movimenti(db))
+    aggiunti = nuovi[~gia]
+    esito = {
+        'nuovi':     len(aggiunti),
+        'duplicati': int(gia.sum()),
+        'mesi':      sorted(int(m) for m in aggiunti['_mese_key'].unique() if m > 0),
+    }
+    if aggiunti.empty:
+        return db, esito
+    ledger = concat_categorie([db, aggiunti])
+    ledger.attrs['ruoli'] = db.attrs.get('ruoli') or nuovi.attrs.get('ruoli')
+    _accoda_al_cubo(db, ledger, aggiunti)
+    return ledger, esito
+
+
+# ─── RETTIFICHE ──────────────────────────────────────────────────────────────
+
+# Le rettifiche non toccano il ledger: diventano una piccola tabella di delta
+# (conto, mese, importo) sommata al cubo conti × mesi già aggregato. Attivarle
+# o disattivarle non riscansiona i movimenti.
+
+def tabella_rettifiche(rettifiche):
+    """
+    Rettifiche attive → DataFrame tipizzato come il ledger:
+      _conto_str str, _mese_key int64 (AAAAMM), _saldo_num float64.
+    Righe senza conto o con mese non valido sono scartate.
+    """
+    conti, mesi, importi = [], [], []
+    for r in rettifiche or []:
+        if not r.get('attiva', True):
+            continue
+        conto = str(r.get('conto', '')).strip()
+        mese  = chiave_mese(r.get('mese', ''))
+        if conto in ('', 'nan') or not mese:
+            continue
+        try:
+            importo = float(r.get('importo', 0) or 0)
+        except (TypeError, ValueError):
+            continue
+        conti.append(conto)
+        mesi.append(mese)
+        importi.append(importo)
+    return pd.DataFrame({
+        '_conto_str': pd.Series(conti, dtype=str),
+        '_mese_key':  pd.Series(mesi, dtype=np.int64),
+        '_saldo_num': pd.Series(importi, dtype=np.float64),
+    })
 
 
 # ─── DATE PARSING ────────────────────────────────────────────────────────────
+# Il formato si deduce su un campione di valori distinti e si applica in modo
+# esplicito (parser C, niente inferenza riga per riga); il risultato è una
+# chiave intera AAAAMMGG, da cui il mese AAAAMM con una divisione.
+
+_FORMATI_DATA = ['%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S',
+                 '%d/%m/%y', '%d-%m-%y', '%Y/%m/%d', '%d.%m.%Y', '%d.%m.%y',
+                 '%d/%m/%Y %H:%M:%S', '%m/%d/%Y', '%Y%m%d']
+_CAMPIONE_DATE = 500
+
+
+def rileva_formato_data(valori):
+    """
+    Formato strftime che interpreta più valori del campione, None se nessuno
+    ne interpreta almeno metà. A parità vince il primo in lista (giorno prima
+    del mese, come nei gestionali italiani).
+    """
+    campione = pd.Series(valori, dtype=object).dropna().astype(str).str.strip()
+    campione = campione[campione != ''].head(_CAMPIONE_DATE)
+    if campione.empty:
+        return None
+    best, n_best = None, 0
+    for fmt in _FORMATI_DATA:
+        n = pd.to_datetime(campione, format=fmt, errors='coerce').notna().sum()
+        if n > n_best:
+            best, n_best = fmt, n
+    return best if n_best >= len(campione) * 0.5 else None
+
+
+def _date_valori(valori):
+    """Datetime di una Series di valori (distinti): formato dedotto, poi gli altri sui residui."""
+    s = valori.astype(str).str.strip()
+    fmt = rileva_formato_data(s)
+    if fmt is None:
+        return pd.to_datetime(s, errors='coerce', dayfirst=True)
+    dt = pd.to_datetime(s, format=fmt, errors='coerce')
+    # Valori in un formato diverso dal prevalente (export misti): gli altri
+    # formati noti, in ordine, sui soli residui
+    resto = dt.isna() & s.notna() & ~s.isin(['', 'nan', 'None', 'NaT'])
+    for altro in _FORMATI_DATA:
+        if not resto.any():
+            break
+        if altro != fmt:
+            dt[resto] = pd.to_datetime(s[resto], format=altro, errors='coerce')
+            resto &= dt.isna()
+    return dt
+
+
+def _giorno_key_valori(valori):
+    if pd.api.types.is_datetime64_any_dtype(valori.dtype):
+        dt = valori
+    else:
+        dt = _date_valori(valori)
+    k = dt.dt.year * 10000 + dt.dt.month * 100 + dt.dt.day
+    return k.fillna(0).to_numpy(dtype=np.int32)
+
+
+def chiavi_data(series, giorno=False):
+    """
+    Chiave mese int32 AAAAMM di ogni riga (0 = data non riconosciuta), senza
+    passare da Period/stringhe. Con giorno=True ritorna (mese, giorno) con la
+    chiave giorno AAAAMMGG. Ogni data distinta è interpretata una sola volta.
+    """
+    g = converti_unici(series, _giorno_key_valori).to_numpy(dtype=np.int32)
+    mese = g // 100
+    return (mese, g) if giorno else mese
+
 
 def _parse_date_robust(series):
-    s = series.astype(str).str.strip()
-    result = pd.to_datetime(s, errors='coerce', dayfirst=True)
-    if result.notna().sum() > len(s) * 0.5:
-        return result
-    for fmt in ['%d/%m/%Y','%d-%m-%Y','%Y-%m-%d','%d/%m/%y','%d-%m-%y',
-                '%Y/%m/%d','%d.%m.%Y','%d.%m.%y','%m/%d/%Y','%Y%m%d']:
-        try:
-            c = pd.to_datetime(s, format=fmt, errors='coerce')
-            if c.notna().sum() > result.notna().sum():
-                result = c
-        except Exception:
-            pass
-    return result
+    return converti_unici(series, _date_valori)
 
 
 # ─── SCALARI SICURI ──────────────────────────────────────────────────────────
@@ -134,6 +424,127 @@ def _safe_str(val):
 
 
 # ─── SCHEMA → PIVOT ESPANSO ──────────────────────────────────────────────────
+# Lo schema CE si compila una volta in un operatore lineare: ogni riga del CE
+# è una combinazione (coefficienti ±1) delle voci contabili sorgente e dei
+# risultati delle formule. Subtotali e totali diventano righe dell'operatore
+# e l'intero CE (tutti i mesi) si ottiene con un solo prodotto matriciale.
+
+_MEMO_SCHEMI = {}
+_MAX_MEMO_SCHEMI = 16
+
+
+def _descrizione_schema(cod, cfg, label_map):
+    """Label della riga: override non banale > label_map > codice."""
+    # Se l'override è il codice stesso (es. 'B10.1') non è utile → ignora
+    _ov = cfg.get('descrizione_override', '')
+    _ov = _ov if (_ov and _ov.strip() and _ov.strip().lower() != cod.lower()) else ''
+    return _ov or label_map.get(cod) or cod
+
+
+def compila_schema(schema_config, label_map):
+    """
+    Schema CE → dict con:
+      labels, tipi, cods : righe del CE nell'ordine dello schema
+      sorgenti           : per ogni voce contabile, le label candidate nel pivot
+      formule            : (indice formula, [(codice, riga) riferiti], analisi AST)
+                           in ordine di dipendenza (le formule in ciclo sono escluse)
+      errori_formule     : [(codice, messaggio)] per sintassi, voci sconosciute, cicli
+      operatore          : matrice righe CE × (voci contabili + formule)
+      separatori         : maschera delle righe separatore (valori NaN)
+    Memorizzato per versione dello schema e delle label usate: il risultato è
+    condiviso, in sola lettura.
+    """
+    voci_ordinate = sorted(schema_config.keys(), key=lambda v: schema_config[v].get('ordine', 999))
+    descs = [_descrizione_schema(cod, schema_config[cod], label_map) for cod in voci_ordinate]
+    chiave = (impronta_dati(schema_config), tuple(descs))
+    if chiave in _MEMO_SCHEMI:
+        return _MEMO_SCHEMI[chiave]
+
+    tipi = [schema_config[cod].get('tipo', 'contabile') for cod in voci_ordinate]
+    n_sorgenti = sum(t == 'contabile' for t in tipi)
+    n_formule  = sum(t == 'formula' for t in tipi)
+    operatore  = np.zeros((len(voci_ordinate), n_sorgenti + n_formule))
+    accum_sub  = np.zeros(n_sorgenti + n_formule)
+    accum_tot  = np.zeros(n_sorgenti + n_formule)
+
+    righe, labels, cods, sorgenti, formule = [], [], [], [], []
+    riga_voce = {}   # cod → riga dell'operatore (contabili e formule già incontrate)
+    riga_cod  = {}   # cod → riga dell'operatore (tutte le voci riferibili dalle formule)
+    _sep_counter = 0
+
+    for i, (cod, desc, tipo) in enumerate(zip(voci_ordinate, descs, tipi)):
+        cfg = schema_config[cod]
+
+        if tipo == 'separatore':
+            _sep_counter += 1
+            righe.append(i)
+            labels.append('\u200b' * _sep_counter)   # zero-width spaces = univoci
+            cods.append('')
+            continue
+
+        if tipo == 'contabile':
+            # Il pivot_base.index è già rinominato con le descrizioni:
+            # si cerca prima per desc, poi per codice
+            operatore[i, len(sorgenti)] = -1.0 if cfg.get('segno', 1) == -1 else 1.0
+            sorgenti.append((desc, cod))
+            accum_sub += operatore[i]
+            accum_tot += operatore[i]
+            riga_voce[cod] = i
+
+        elif tipo == 'formula':
+            operatore[i, n_sorgenti + len(formule)] = 1.0
+            formule.append((cod, cfg.get('formula', '')))
+            riga_voce[cod] = i
+
+        elif tipo in ('subtotale', 'totale'):
+            voci_include = cfg.get('voci_include', [])
+            if voci_include:
+                for vc in voci_include:
+                    if vc in riga_voce:
+                        operatore[i] += operatore[riga_voce[vc]]
+            elif tipo == 'subtotale':
+                operatore[i] = accum_sub
+            else:
+                operatore[i] = accum_tot
+            if tipo == 'subtotale':
+                accum_sub = np.zeros_like(accum_sub)
+
+        else:
+            continue   # tipo sconosciuto: nessuna riga
+        riga_cod[cod] = i
+        righe.append(i)
+        labels.append(desc)
+        cods.append(cod)
+
+    # Formule: AST una volta per versione dello schema, poi ordine topologico.
+    # Una formula dipende dalle formule che compaiono (coefficiente ≠ 0) nelle
+    # righe che riferisce: anche subtotali/totali che le includono.
+    analisi, dipendenze = {}, {}
+    for f, (cod, formula_str) in enumerate(formule):
+        analisi[f] = analizza_formula(formula_str, riga_cod)
+        dipendenze[f] = {
+            g for c in analisi[f]['riferimenti']
+            for g in np.flatnonzero(operatore[riga_cod[c], n_sorgenti:])
+        }
+    ordine, in_ciclo = ordina_formule(dipendenze)
+    errori = [(formule[f][0], analisi[f]['errore']) for f in analisi if analisi[f]['errore']]
+    if in_ciclo:
+        errori.append((', '.join(formule[f][0] for f in in_ciclo),
+                       'riferimento circolare: formule non calcolate'))
+
+    compilato = {
+        'labels': labels, 'tipi': [tipi[i] for i in righe], 'cods': cods,
+        'sorgenti': sorgenti, 'operatore': operatore, 'righe': righe,
+        'formule': [(f, [(c, riga_cod[c]) for c in analisi[f]['riferimenti']], analisi[f])
+                    for f in ordine],
+        'errori_formule': errori,
+        'separatori': np.array([tipi[i] == 'separatore' for i in righe], dtype=bool),
+    }
+    if len(_MEMO_SCHEMI) >= _MAX_MEMO_SCHEMI:
+        _MEMO_SCHEMI.pop(next(iter(_MEMO_SCHEMI)))
+    _MEMO_SCHEMI[chiave] = compilato
+    return compilato
+
 
 def _applica_schema_con_totali(pivot_contabili, schema_config, label_map):
     """
@@ -143,136 +554,326 @@ def _applica_schema_con_totali(pivot_contabili, schema_config, label_map):
     (= il label originale da df_ricl che è nell'indice di pivot_contabili),
     NON il descrizione_override che potrebbe essere stato rinominato dall'utente.
 
-    Il DataFrame risultante ha colonne aggiuntive:
+    Restituisce un CEResult: il DataFrame ha colonne aggiuntive
       _tipo  : contabile / subtotale / totale / separatore
       _cod   : codice riclassifica originale (per lookup successivi)
     """
-    if not schema_config:
-        pivot_contabili = pivot_contabili.copy()
-        pivot_contabili['_tipo'] = 'contabile'
-        pivot_contabili['_cod']  = pivot_contabili.index.astype(str)
-        return pivot_contabili
-
     mesi_cols = [c for c in pivot_contabili.columns if c not in ('TOTALE',)]
-    all_cols  = mesi_cols + ['TOTALE']
+    comp = compila_schema(schema_config, label_map) if schema_config else None
+    if not comp or not comp['righe']:
+        etichette = list(pivot_contabili.index)
+        return CEResult(pivot_contabili[mesi_cols + ['TOTALE']].to_numpy(dtype=float),
+                        etichette, ['contabile'] * len(etichette),
+                        [str(e) for e in etichette], mesi_cols)
+
+    valori = pivot_contabili[mesi_cols].to_numpy(dtype=float)
+    valori = np.where(np.isnan(valori), 0.0, valori)
+
+    # Righe sorgenti: voce contabile → prima riga del pivot con desc o codice
+    posizione = {}
+    for p, lab in enumerate(pivot_contabili.index):
+        posizione.setdefault(lab, p)
+    n_sorgenti = len(comp['sorgenti'])
+    sorgenti = np.zeros((comp['operatore'].shape[1], len(mesi_cols)))
+    for k, (desc, cod) in enumerate(comp['sorgenti']):
+        p = posizione.get(desc, posizione.get(cod))
+        if p is not None:
+            sorgenti[k] = valori[p]
+
+    # Formule in ordine di dipendenza, ciascuna sull'intero vettore dei mesi
+    operatore = comp['operatore']
+    for f, riferimenti, analisi in comp['formule']:
+        valori_rif = {c: operatore[r] @ sorgenti for c, r in riferimenti}
+        sorgenti[n_sorgenti + f] = valuta_formula(analisi, valori_rif, len(mesi_cols))
+
+    valori = np.empty((len(comp['righe']), len(mesi_cols) + 1))
+    valori[:, :-1] = operatore[comp['righe']] @ sorgenti
+    valori[:, -1]  = valori[:, :-1].sum(axis=1)
+    valori[comp['separatori']] = np.nan
+    ruoli = {cod: cfg.get('kpi_role') for cod, cfg in schema_config.items()}
+    return CEResult(valori, comp['labels'], comp['tipi'], comp['cods'], mesi_cols, ruoli)
+
+
+# ─── KERNEL DI AGGREGAZIONE ──────────────────────────────────────────────────
+# Le somme del CE sono sempre "per (riga, colonna)" su codici interi (conto,
+# voce, mese): un np.bincount sull'indice piatto riga * n_colonne + colonna
+# riempie direttamente la matrice densa, senza il groupby/reshape di
+# pd.pivot_table.
+
+def somma_matrice(righe, colonne, valori, n_righe, n_colonne):
+    """
+    Matrice n_righe × n_colonne con la somma dei valori per (riga, colonna).
+    righe/colonne: codici interi in [0, n). I NaN non contano (come sum()).
+    """
+    flat = righe.astype(np.int64) * n_colonne + colonne
+    pesi = np.nan_to_num(np.asarray(valori, dtype=np.float64), nan=0.0)
+    return np.bincount(flat, weights=pesi, minlength=n_righe * n_colonne).reshape(n_righe, n_colonne)
 
-    voci_ordinate = sorted(schema_config.keys(), key=lambda v: schema_config[v].get('ordine', 999))
 
-    labels, data_rows, tipi, cods = [], [], [], []
-    _sep_counter = [0]
-    accum_sub = {c: 0.0 for c in all_cols}
-    accum_tot = {c: 0.0 for c in all_cols}
-    voce_vals = {}   # cod → {col: val}
-
-    for cod in voci_ordinate:
-        cfg  = schema_config[cod]
-        tipo = cfg.get('tipo', 'contabile')
-        # Display label (sempre la descrizione leggibile)
-        # Priority: non-trivial override > label_map > cod itself
-        _ov = cfg.get('descrizione_override', '')
-        # Se l'override è il codice stesso (es. 'B10.1') non è utile → ignora
-        _ov = _ov if (_ov and _ov.strip() and _ov.strip().lower() != cod.lower()) else ''
-        desc = _ov or label_map.get(cod) or cod
-        # Lookup nel pivot: il pivot_base.index è già stato rinominato con le descrizioni
-        # quindi cerchiamo prima per desc, poi per label_map originale, poi per cod
-        lookup_label = desc
+def somma_righe(codici, matrice, n_gruppi):
+    """Somma le righe della matrice per gruppo (codici interi in [0, n_gruppi))."""
+    n_col = matrice.shape[1]
+    return somma_matrice(np.repeat(codici, n_col), np.tile(np.arange(n_col), len(codici)),
+                         matrice.ravel(), n_gruppi, n_col)
 
-        if tipo == 'separatore':
-            _sep_counter[0] += 1
-            labels.append('\u200b' * _sep_counter[0])   # zero-width spaces = univoci
-            data_rows.append({c: np.nan for c in all_cols})
-            tipi.append('separatore')
-            cods.append('')
-            continue
 
-        if tipo == 'contabile':
-            # Lookup nel pivot usando il label originale (non l'override!)
-            target = None
-            for candidate in [lookup_label, cod, desc]:
-                if candidate and candidate in pivot_contabili.index:
-                    target = candidate
-                    break
-
-            if target is not None:
-                row = pivot_contabili.loc[target]
-                if isinstance(row, pd.DataFrame):
-                    row = row.iloc[0]
-                row_d = {c: _safe_scalar(row.get(c, 0.0)) for c in all_cols}
-            else:
-                row_d = {c: 0.0 for c in all_cols}
+def _raggruppa(df, chiavi, nome):
+    """Righe di df (valori numerici) sommate per chiave, indice ordinato come groupby."""
+    codici, gruppi = pd.factorize(chiavi, sort=True)
+    somme = somma_righe(codici, df.to_numpy(dtype=np.float64), len(gruppi))
+    return pd.DataFrame(somme, index=pd.Index(gruppi, name=nome), columns=df.columns)
 
-            if cfg.get('segno', 1) == -1:
-                row_d = {c: -v for c, v in row_d.items()}
 
-            for c in all_cols:
-                accum_sub[c] += row_d.get(c, 0.0)
-                accum_tot[c] += row_d.get(c, 0.0)
-            voce_vals[cod] = row_d
+def _indice_mese(chiavi):
+    """Chiavi AAAAMM → numero progressivo del mese (differenze = distanza in mesi)."""
+    return (chiavi // 100) * 12 + chiavi % 100 - 1
 
-            labels.append(desc)
-            data_rows.append(row_d)
-            tipi.append('contabile')
-            cods.append(cod)
 
-        elif tipo == 'formula':
-            formula_str = cfg.get('formula', '').strip()
-            form_d = {c: 0.0 for c in all_cols}
-            if formula_str:
-                import re as _re
-                for c in mesi_cols:
-                    # Build local namespace with all voce_vals for this column
-                    ns = {vc.replace('.','_').replace(' ','_'): voce_vals.get(vc, {}).get(c, 0.0)
-                          for vc in voce_vals}
-                    # Also support original cod keys with dots (replace . with _)
-                    ns_orig = {vc: voce_vals.get(vc, {}).get(c, 0.0) for vc in voce_vals}
-                    # Replace voce codes in formula with safe identifiers
-                    safe_f = formula_str
-                    for vc in sorted(voce_vals.keys(), key=len, reverse=True):
-                        safe_key = vc.replace('.','_').replace(' ','_')
-                        safe_f = safe_f.replace(vc, safe_key)
-                    try:
-                        result_val = float(eval(safe_f, {"__builtins__": {}}, ns))
-                        form_d[c] = result_val
-                    except Exception:
-                        form_d[c] = 0.0
-                form_d['TOTALE'] = sum(form_d.get(c, 0.0) for c in mesi_cols)
-            voce_vals[cod] = form_d
-            labels.append(desc)
-            data_rows.append(form_d)
-            tipi.append('formula')
-            cods.append(cod)
+# ─── CUBO CONTI × MESI ───────────────────────────────────────────────────────
+# Primo stadio dell'aggregazione: somme per (conto, mese) del ledger, calcolate
+# una volta per versione del ledger. Rettifiche, mappatura, schema ed etichette
+# lavorano sul cubo (migliaia di conti × decine di mesi), non sui milioni di
+# movimenti: modificarli non riscansiona il ledger.
 
-        elif tipo in ('subtotale', 'totale'):
-            voci_include = cfg.get('voci_include', [])
-            if voci_include:
-                sub_d = {c: sum(voce_vals.get(vc, {}).get(c, 0.0) for vc in voci_include) for c in all_cols}
-                sub_d['TOTALE'] = sum(sub_d.get(c, 0.0) for c in mesi_cols)
-            elif tipo == 'subtotale':
-                sub_d = dict(accum_sub)
-                sub_d['TOTALE'] = sum(sub_d.get(c, 0.0) for c in mesi_cols)
-            else:
-                sub_d = dict(accum_tot)
-                sub_d['TOTALE'] = sum(sub_d.get(c, 0.0) for c in mesi_cols)
+_MEMO_CUBI = {}
+_MAX_MEMO_CUBI = 8
 
-            labels.append(desc)
-            data_rows.append(sub_d)
-            tipi.append(tipo)
-            cods.append(cod)
 
-            if tipo == 'subtotale':
-                accum_sub = {c: 0.0 for c in all_cols}
-
-    if not labels:
-        pivot_contabili = pivot_contabili.copy()
-        pivot_contabili['_tipo'] = 'contabile'
-        pivot_contabili['_cod']  = pivot_contabili.index.astype(str)
-        return pivot_contabili
-
-    result = pd.DataFrame(data_rows, index=labels)
-    result.index.name = None
-    result['_tipo'] = tipi
-    result['_cod']  = cods   # ← codice riclassifica originale, stabile
-    return result
+def cubo_conti(df_db, rettifiche=None):
+    """
+    DataFrame conti × mesi (indice = codice conto normalizzato, colonne =
+    asse AAAAMM contiguo dal primo all'ultimo mese con movimenti, valori =
+    somma degli importi; gli importi non interpretabili non contano). None se nessun movimento ha data e
+    conto validi. Il cubo del ledger è memorizzato per versione di ledger e
+    ruoli (risultato condiviso, in sola lettura); le rettifiche attive si
+    sommano dopo, come delta (applica_delta_cubo).
+    """
+    chiave = _chiave_cubo(df_db)
+    if chiave not in _MEMO_CUBI:
+        _memorizza_cubo(chiave, _aggrega_cubo(df_db))
+    if rettifiche:
+        return applica_delta_cubo(_MEMO_CUBI[chiave], tabella_rettifiche(rettifiche))
+    return _MEMO_CUBI[chiave]
+
+
+def _chiave_cubo(df_db):
+    return versione_frame(df_db), tuple(sorted((df_db.attrs.get('ruoli') or {}).items()))
+
+
+def _memorizza_cubo(chiave, cubo):
+    if len(_MEMO_CUBI) >= _MAX_MEMO_CUBI:
+        _MEMO_CUBI.pop(next(iter(_MEMO_CUBI)))
+    _MEMO_CUBI[chiave] = cubo
+
+
+def _accoda_al_cubo(db, ledger, aggiunti):
+    """
+    Cubo di ledger = cubo di db (se memorizzato) + movimenti aggiunti, come
+    delta: l'accodamento mensile aggrega solo le righe nuove.
+    """
+    base = _MEMO_CUBI.get(_chiave_cubo(db), False)
+    if base is False:
+        return
+    mesi  = aggiunti['_mese_key'].to_numpy()
+    conti = aggiunti['_conto_str'].astype(str)
+    valid = (mesi > 0) & ~conti.isin(['', 'nan']).to_numpy()
+    delta = pd.DataFrame({
+        '_conto_str': conti[valid].to_numpy(),
+        '_mese_key':  mesi[valid].astype(np.int64),
+        '_saldo_num': aggiunti['_saldo_num'].to_numpy(np.float64)[valid],
+    })
+    _memorizza_cubo(_chiave_cubo(ledger), applica_delta_cubo(base, delta))
+
+
+def _aggrega_cubo(df_db):
+    """Cubo del solo ledger, senza rettifiche (vedi cubo_conti)."""
+    # Ledger tipizzato al caricamento; i DB in sessione da versioni precedenti
+    # vengono tipizzati qui (una volta per versione del ledger)
+    db = prepara_ledger(df_db)
+
+    # Conti come codici interi: quelli del category, o factorize se non tipizzati
+    col = db['_conto_str']
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codici, conti = col.cat.codes.to_numpy(), col.cat.categories.astype(str)
+    else:
+        codici, conti = pd.factorize(col.astype(str))
+    mesi  = db['_mese_key'].to_numpy()
+    valid = (codici >= 0) & (mesi > 0)
+    valid[valid] = ~np.asarray(conti.isin(['', 'nan']))[codici[valid]]
+    cubo = None
+    if valid.any():
+        codici, mesi = codici[valid], mesi[valid].astype(np.int64)
+        asse = asse_mesi(int(mesi.min()), int(mesi.max()))
+        somme = somma_matrice(codici, _indice_mese(mesi) - _indice_mese(asse[0]),
+                              db['_saldo_num'].to_numpy()[valid], len(conti), len(asse))
+        presenti = np.bincount(codici, minlength=len(conti)) > 0
+        cubo = pd.DataFrame(somme[presenti], columns=asse,
+                            index=pd.Index(np.asarray(conti)[presenti], name='_conto_str'))
+    return cubo
+
+
+def applica_delta_cubo(cubo, delta):
+    """
+    Cubo + tabella delta (tabella_rettifiche) → nuovo cubo. I conti nuovi
+    vanno in coda, i mesi fuori asse lo estendono (asse sempre contiguo).
+    Costo proporzionale al cubo e al numero di delta, non al ledger.
+    """
+    if delta is None or delta.empty:
+        return cubo
+    d_conti = pd.Index(delta['_conto_str'].astype(str))
+    d_mesi  = delta['_mese_key'].to_numpy(np.int64)
+    if cubo is None:
+        base_conti, base_asse = pd.Index([], dtype=str), []
+    else:
+        base_conti, base_asse = cubo.index, list(cubo.columns)
+    asse  = asse_mesi(min(base_asse[:1] + [int(d_mesi.min())]),
+                      max(base_asse[-1:] + [int(d_mesi.max())]))
+    conti = base_conti.append(d_conti.unique().difference(base_conti, sort=False))
+    conti.name = '_conto_str'
+
+    valori = np.zeros((len(conti), len(asse)))
+    if base_asse:
+        inizio = _indice_mese(base_asse[0]) - _indice_mese(asse[0])
+        valori[:len(base_conti), inizio:inizio + len(base_asse)] = cubo.to_numpy()
+    valori += somma_matrice(conti.get_indexer(d_conti), _indice_mese(d_mesi) - _indice_mese(asse[0]),
+                            delta['_saldo_num'].to_numpy(np.float64), len(conti), len(asse))
+    return pd.DataFrame(valori, index=conti, columns=asse)
+
+
+# ─── DETTAGLIO DRILL-DOWN ────────────────────────────────────────────────────
+
+class DettaglioCE(Mapping):
+    """
+    Drill-down pigro: i conti di una voce si aggregano solo quando la voce
+    viene aperta. Tiene il cubo conti × mesi dei conti mappati con le righe
+    ordinate per voce_label (indice: fetta contigua per voce); dettaglio[voce]
+    somma le righe della voce per descrizione conto e memorizza il risultato.
+    Si usa come il dict {voce: pivot_conti} di prima.
+    """
+
+    def __init__(self, cubo, voce_label, conto_display, voci):
+        codici, etichette = pd.factorize(voce_label.to_numpy())
+        ordine = np.argsort(codici, kind='stable')
+        self._cubo = cubo.iloc[ordine]
+        self._conto_display = conto_display.to_numpy()[ordine]
+        inizi = np.searchsorted(codici[ordine], np.arange(len(etichette)))
+        fini = np.r_[inizi[1:], len(ordine)]
+        self._righe = {etichette[i]: slice(inizi[i], fini[i]) for i in range(len(etichette))}
+        self._voci = voci                     # voce CE → voce_label del cubo
+        self._memo = {}
+
+    def __getitem__(self, voce):
+        label = self._voci[voce]
+        if label not in self._memo:
+            r = self._righe[label]
+            det = _raggruppa(self._cubo.iloc[r], self._conto_display[r], '_conto_display')
+            det['TOTALE'] = det.sum(axis=1)
+            self._memo[label] = det
+        return self._memo[label]
+
+    def __iter__(self):
+        return iter(self._voci)
+
+    def __len__(self):
+        return len(self._voci)
+
+    def __contains__(self, voce):
+        # Solo appartenenza: Mapping.__contains__ passerebbe da __getitem__ e aggregherebbe
+        try:
+            return voce in self._voci
+        except TypeError:
+            return False
+
+    def get(self, voce, default=None):
+        return self[voce] if voce in self else default
+
+    def n_conti(self, voce):
+        """Numero di righe del dettaglio della voce, senza aggregarlo."""
+        r = self._righe[self._voci[voce]]
+        return len(pd.unique(self._conto_display[r]))
+
+
+# ─── CE RISULTATO ────────────────────────────────────────────────────────────
+
+class CEResult(pd.DataFrame):
+    """
+    CE riclassificato tipizzato. Per i consumatori resta il pivot di sempre
+    (righe = voci, colonne = mesi AAAAMM, TOTALE, _tipo, _cod); in più espone
+    la struttura su cui lavorano gli helper, senza accessi cella per cella:
+      valori               float64 righe × (mesi + TOTALE), condivisa col DataFrame
+      etichette, tipi, codici   array paralleli alle righe
+      mesi                 asse AAAAMM contiguo (colonne 0..n-1 di valori)
+      riga_per_cod         codice riclassifica → riga
+      riga_per_ruolo       kpi_role dello schema → riga
+      riga_per_etichetta   label → prima riga con quel label (come .loc + iloc[0])
+    Le operazioni pandas (slice, copy, ...) restituiscono DataFrame normali.
+    """
+    _metadata = ['valori', 'etichette', 'tipi', 'codici', 'mesi',
+                 'riga_per_cod', 'riga_per_ruolo', 'riga_per_etichetta']
+
+    def __init__(self, valori, etichette, tipi, codici, mesi, ruoli=None):
+        valori = np.ascontiguousarray(valori, dtype=np.float64)
+        frame = pd.DataFrame(valori, index=list(etichette),
+                             columns=list(mesi) + ['TOTALE'], copy=False)
+        frame['_tipo'] = list(tipi)
+        frame['_cod']  = list(codici)   # ← codice riclassifica originale, stabile
+        super().__init__(frame)
+        self.valori    = valori
+        self.etichette = np.asarray(etichette, dtype=object)
+        self.tipi      = np.asarray(tipi, dtype=object)
+        self.codici    = np.asarray(codici, dtype=object)
+        self.mesi      = [int(m) for m in mesi]
+
+        self.riga_per_etichetta = {}
+        for r, lab in enumerate(self.etichette):
+            self.riga_per_etichetta.setdefault(lab, r)
+        self.riga_per_cod = {}
+        for r, cod in enumerate(self.codici):
+            if cod:
+                self.riga_per_cod.setdefault(cod, r)
+        self.riga_per_ruolo = {}
+        for cod, ruolo in (ruoli or {}).items():
+            if ruolo and ruolo not in self.riga_per_ruolo and cod in self.riga_per_cod:
+                self.riga_per_ruolo[ruolo] = self.riga_per_cod[cod]
+
+    @property
+    def _constructor(self):
+        return pd.DataFrame
+
+    def colonna(self, mese):
+        """Posizione in valori del mese AAAAMM (o 'TOTALE'); None se fuori asse."""
+        if isinstance(mese, str):
+            return len(self.mesi) if mese == 'TOTALE' else None
+        if not self.mesi:
+            return None
+        i = _indice_mese(int(mese)) - _indice_mese(self.mesi[0])
+        return i if 0 <= i < len(self.mesi) else None
+
+    def colonne(self, mesi):
+        """Posizioni dei mesi presenti: slice se contigui e crescenti, altrimenti lista."""
+        pos = [p for p in (self.colonna(m) for m in mesi) if p is not None]
+        if pos and pos == list(range(pos[0], pos[-1] + 1)):
+            return slice(pos[0], pos[-1] + 1)
+        return pos
+
+    def periodo(self, mesi):
+        """valori delle sole colonne dei mesi: vista senza copia per periodi contigui."""
+        return self.valori[:, self.colonne(mesi)]
+
+    def riga(self, voce):
+        return self.riga_per_etichetta.get(voce)
+
+    def valore(self, voce, mese, default=0.0):
+        """Scalare della cella (voce, mese); NaN, voce o mese assenti → default."""
+        r, c = self.riga(voce), self.colonna(mese)
+        if r is None or c is None:
+            return default
+        v = self.valori[r, c]
+        return default if v != v else float(v)
+
+    def tipo(self, voce):
+        r = self.riga(voce)
+        return '' if r is None else self.tipi[r]
 
 
 # ─── CE RICLASSIFICATO ───────────────────────────────────────────────────────
@@ -280,20 +881,17 @@ def _applica_schema_con_totali(pivot_contabili, schema_config, label_map):
 def costruisci_ce_riclassificato(df_db, df_piano, df_ricl, mapping, schema_config, rettifiche=None):
     """
     Ritorna (pivot, dettaglio, errore).
-    pivot: DataFrame con _tipo e _cod
-    dettaglio: {voce_label: pivot_conti} per drill-down
+    pivot: DataFrame con _tipo e _cod; le colonne mese sono chiavi intere
+    AAAAMM contigue (vedi ASSE MESI), più TOTALE
+    dettaglio: {voce_label: pivot_conti} per drill-down, stesso asse mesi
+    Aggrega il cubo conti × mesi (cubo_conti), non il ledger.
     """
     if df_db is None or df_db.empty:
         return None, None, 'DB Contabile vuoto o non caricato.'
     if not mapping:
         return None, None, 'Nessuna mappatura configurata. Vai in Workspace → Mappatura Conti.'
 
-    col_data  = find_column(df_db, ['Data','data','DATA','DataDoc','DataRegistrazione',
-                                     'data_registrazione','DataReg','Competenza','Date'])
-    col_saldo = find_column(df_db, ['Saldo','saldo','SALDO','Importo','importo',
-                                     'Valore','valore','ImportoMovimento','Totale','Amount'])
-    col_conto = find_column(df_db, ['Conto','conto','CONTO','CodConto','CodiceConto',
-                                     'codice_conto','Mastro','mastro','Account'])
+    col_data, col_saldo, col_conto = colonne_ledger(df_db)
 
     missing = [n for n, c in [('Data', col_data),('Saldo/Importo', col_saldo),('Conto', col_conto)] if not c]
     if missing:
@@ -302,56 +900,47 @@ def costruisci_ce_riclassificato(df_db, df_piano, df_ricl, mapping, schema_confi
             'Rinomina in: Data, CodConto (o Conto), Importo (o Saldo).'
         ).format(', '.join(missing), list(df_db.columns)[:12])
 
-    db = df_db.copy()
-    if rettifiche:
-        db = applica_rettifiche(db, rettifiche, col_conto, col_saldo, col_data)
-
-    db['_saldo_num'] = to_numeric(db[col_saldo])
-    db['_data_dt']   = _parse_date_robust(db[col_data])
-    db['_conto_str'] = db[col_conto].astype(str).str.strip()
-
-    db = db[db['_data_dt'].notna() & (db['_conto_str'] != '') & (db['_conto_str'] != 'nan')]
-    if db.empty:
+    cubo = cubo_conti(df_db, rettifiche)
+    if cubo is None:
         sample = df_db[col_data].dropna().head(3).tolist()
         return None, None, (
             'Nessuna riga valida dopo parsing date. '
             'Esempi: {}. Formati supportati: GG/MM/AAAA, AAAA-MM-GG.'
         ).format(sample)
 
-    db['_mese']       = db['_data_dt'].dt.to_period('M').astype(str)
     label_map         = get_label_map(df_ricl)
     conto_label       = get_conto_label_map(df_piano)
 
     # cod_voce = codice riclassifica (es. "RIC001")
     # voce_label = label leggibile (es. "Ricavi Commerciali") usato come indice pivot
-    db['_cod_voce']   = db['_conto_str'].map(mapping)
-    db['_voce_label'] = db['_cod_voce'].map(label_map).fillna(db['_cod_voce'])
+    conti       = cubo.index.to_series(index=cubo.index)
+    cod_voce    = conti.map(mapping)
+    voce_label  = cod_voce.map(label_map).fillna(cod_voce)
+    mappati     = voce_label.notna() & ~voce_label.astype(str).isin(['nan','None','NaN',''])
 
-    db_mapped = db[
-        db['_voce_label'].notna() &
-        ~db['_voce_label'].astype(str).isin(['nan','None','NaN',''])
-    ].copy()
-
-    if db_mapped.empty:
+    if not mappati.any():
         return None, None, (
             'Nessun conto del DB risulta mappato.\n'
             'Conti DB (es.): {}\nConti mapping (es.): {}'
-        ).format(list(db['_conto_str'].unique())[:5], list(mapping.keys())[:5])
-
-    db_mapped['_desc_conto']    = db_mapped['_conto_str'].map(conto_label).fillna(db_mapped['_conto_str'])
+        ).format(list(cubo.index)[:5], list(mapping.keys())[:5])
+
+    # Asse mesi contiguo dal primo all'ultimo mese con movimenti sui conti mappati:
+    # conti non mappati (o loro rettifiche) non allungano il CE
+    cubo_m = cubo.loc[mappati.to_numpy()]
+    attivi = cubo_m.columns[(cubo_m.to_numpy() != 0).any(axis=0)]
+    if len(attivi) == 0:
+        attivi = cubo_m.columns
+    asse   = asse_mesi(min(attivi), max(attivi))
+    cubo_m = cubo_m.reindex(columns=asse, fill_value=0.0)
+    voce_label = voce_label[mappati].rename('_voce_label')
+    desc_conto = voce_label.index.to_series(index=voce_label.index).map(conto_label)
     # Mostra solo descrizione, senza codice conto
-    db_mapped['_conto_display'] = db_mapped['_desc_conto'].where(db_mapped['_desc_conto'].notna() & (db_mapped['_desc_conto'] != db_mapped['_conto_str']), db_mapped['_conto_str'])
+    conto_display = desc_conto.where(desc_conto.notna() & (desc_conto != desc_conto.index),
+                                     desc_conto.index.to_series(index=desc_conto.index))
 
     # Pivot base: indice = _voce_label (es. "Ricavi Commerciali")
-    pivot_base = pd.pivot_table(
-        db_mapped, values='_saldo_num',
-        index='_voce_label', columns='_mese',
-        aggfunc='sum', fill_value=0
-    )
-    try:
-        pivot_base = pivot_base[sorted(pivot_base.columns)]
-    except Exception:
-        pass
+    pivot_base = _raggruppa(cubo_m, voce_label, '_voce_label')
+    pivot_base.columns = list(asse)
     pivot_base['TOTALE'] = pivot_base.sum(axis=1)
     # Rinomina indice: codici → descrizioni usando label_map + descrizione_override da schema
     # Questo garantisce che pivot.index contenga SEMPRE descrizioni leggibili
@@ -368,12 +957,10 @@ def costruisci_ce_riclassificato(df_db, df_piano, df_ricl, mapping, schema_confi
     # Espandi con subtotali/totali
     pivot = _applica_schema_con_totali(pivot_base, schema_config, label_map)
 
-    # Dettaglio drill-down:
+    # Dettaglio drill-down (pigro): riga del CE → voce_label del cubo.
     # CHIAVE: usiamo _cod per ritrovare i dati, NON il display label
     # perché il display label può essere stato rinominato dall'utente
-    dettaglio = {}
-
-    # Mappa cod → voce_label originale (come è in db_mapped)
+    # Mappa cod → voce_label originale (come è nel cubo)
     # cod è il codice riclassifica (es. "RIC001"), voce_label è "Ricavi Commerciali"
     cod_to_orig_label = {}
     if schema_config:
@@ -381,48 +968,93 @@ def costruisci_ce_riclassificato(df_db, df_piano, df_ricl, mapping, schema_confi
             orig = label_map.get(cod, cod)
             cod_to_orig_label[cod] = orig
 
-    for i, voce in enumerate(pivot.index):
-        tipo_v = _safe_str(pivot.loc[voce, '_tipo']) if '_tipo' in pivot.columns else 'contabile'
-        if tipo_v != 'contabile':
+    nel_cubo = set(voce_label)
+    voci_det = {}
+    for voce, r in pivot.riga_per_etichetta.items():
+        if pivot.tipi[r] != 'contabile':
             continue
 
         # Recupera il codice riclassifica di questa riga
-        cod_v = _safe_str(pivot.loc[voce, '_cod']) if '_cod' in pivot.columns else ''
-        # Da codice → label originale in db_mapped
+        cod_v = pivot.codici[r]
+        # Da codice → label originale nel cubo
         orig_label = cod_to_orig_label.get(cod_v, voce)
 
-        # Cerca in db_mapped prima con orig_label, poi con voce (display)
-        df_v = db_mapped[db_mapped['_voce_label'] == orig_label]
-        if df_v.empty and orig_label != voce:
-            df_v = db_mapped[db_mapped['_voce_label'] == voce]
-        if df_v.empty:
-            continue
+        # Cerca nel cubo prima con orig_label, poi con voce (display)
+        if orig_label in nel_cubo:
+            voci_det[voce] = orig_label
+        elif voce in nel_cubo:
+            voci_det[voce] = voce
 
-        piv_c = pd.pivot_table(
-            df_v, values='_saldo_num',
-            index='_conto_display', columns='_mese',
-            aggfunc='sum', fill_value=0
-        )
-        try:
-            piv_c = piv_c[sorted(piv_c.columns)]
-        except Exception:
-            pass
-        piv_c['TOTALE'] = piv_c.sum(axis=1)
-        dettaglio[voce] = piv_c
+    return pivot, DettaglioCE(cubo_m, voce_label, conto_display, voci_det), None
 
-    return pivot, dettaglio, None
+
+# ─── ASSE MESI ───────────────────────────────────────────────────────────────
+# Le colonne mese del CE sono chiavi intere AAAAMM, ordinate e contigue (i mesi
+# senza movimenti valgono 0): anno = k // 100, mese = k % 100, stesso mese
+# dell'anno precedente = k - 100. Selezioni e confronti sono aritmetica sugli
+# interi; l'etichetta 'AAAA-MM' si forma solo in visualizzazione (label_mese).
+
+def label_mese(k):
+    """AAAAMM → 'AAAA-MM'."""
+    k = int(k)
+    return '{}-{:02d}'.format(k // 100, k % 100)
+
+
+def chiave_mese(label):
+    """'AAAA-MM' (o AAAAMM) → AAAAMM; None se non è un mese (mese fuori 1..12)."""
+    try:
+        if isinstance(label, (int, np.integer)):
+            a, m = divmod(int(label), 100)
+        else:
+            a, m = (int(x) for x in str(label).strip()[:7].split('-'))
+    except (ValueError, TypeError):
+        return None
+    if a <= 0 or not 1 <= m <= 12:
+        return None
+    return a * 100 + m
+
+
+def asse_mesi(primo, ultimo):
+    """Chiavi AAAAMM contigue da primo a ultimo (inclusi)."""
+    n0 = (primo // 100) * 12 + primo % 100 - 1
+    n1 = (ultimo // 100) * 12 + ultimo % 100 - 1
+    n = np.arange(n0, n1 + 1)
+    return [int(k) for k in (n // 12) * 100 + n % 12 + 1]
+
+
+def anni_disponibili(mesi):
+    """Anni presenti sull'asse, dal più recente."""
+    return sorted({int(m) // 100 for m in mesi}, reverse=True)
+
+
+def mesi_anno(mesi, anno):
+    """Mesi dell'asse che cadono nell'anno dato."""
+    anno = int(anno)
+    return [m for m in mesi if m // 100 == anno]
+
+
+def mesi_corrispondenti(mesi_sel, anno):
+    """Gli stessi mesi di mesi_sel spostati nell'anno dato (confronto YoY)."""
+    anno = int(anno)
+    return [anno * 100 + m % 100 for m in mesi_sel]
 
 
 # ─── HELPERS PIVOT ───────────────────────────────────────────────────────────
 
 def get_mesi_disponibili(pivot):
+    """Chiavi AAAAMM delle colonne mese del pivot, in ordine."""
     if pivot is None:
         return []
-    return [c for c in pivot.columns if c not in ('TOTALE', '_tipo', '_cod')]
+    if isinstance(pivot, CEResult):
+        return list(pivot.mesi)
+    return [c for c in pivot.columns if isinstance(c, (int, np.integer))]
 
 
 def _find_voce_by_cod(pivot, cod):
     """Cerca riga nel pivot per codice riclassifica (_cod colonna)."""
+    if isinstance(pivot, CEResult):
+        r = pivot.riga_per_cod.get(cod)
+        return None if r is None else pivot.etichette[r]
     if pivot is None or '_cod' not in pivot.columns:
         return None
     for idx in pivot.index:
@@ -435,6 +1067,9 @@ def _find_voce_by_role(pivot, schema_config, role):
     """Cerca riga nel pivot dove schema_config[cod]['kpi_role'] == role."""
     if pivot is None or not schema_config:
         return None
+    if isinstance(pivot, CEResult):
+        r = pivot.riga_per_ruolo.get(role)
+        return None if r is None else pivot.etichette[r]
     for cod, cfg in schema_config.items():
         if cfg.get('kpi_role') == role:
             # Trova la riga con _cod == cod
@@ -448,9 +1083,16 @@ def _find_voce_keywords(pivot, keywords):
     """Fallback: cerca per keyword nel label (case-insensitive)."""
     if pivot is None:
         return None
+    keywords = [str(k).lower() for k in keywords]
+    if isinstance(pivot, CEResult):
+        for lab, tipo in zip(pivot.etichette, pivot.tipi):
+            s = str(lab).lower()
+            if tipo in ('contabile', 'subtotale', 'totale') and any(k in s for k in keywords):
+                return lab
+        return None
     for idx in pivot.index:
         s = str(idx).lower()
-        if any(str(k).lower() in s for k in keywords):
+        if any(k in s for k in keywords):
             tipo = _safe_str(pivot.loc[idx, '_tipo']) if '_tipo' in pivot.columns else 'contabile'
             if tipo in ('contabile', 'subtotale', 'totale'):
                 return idx
@@ -458,6 +1100,11 @@ def _find_voce_keywords(pivot, keywords):
 
 
 def _sum_voce(pivot, voce, cols):
+    if isinstance(pivot, CEResult):
+        r = pivot.riga(voce) if voce is not None else None
+        if r is None:
+            return 0.0
+        return float(np.nansum(pivot.valori[r, pivot.colonne(cols)]))
     if voce is None or voce not in pivot.index:
         return 0.0
     valid = [c for c in cols if c in pivot.columns]
@@ -486,7 +1133,7 @@ def calcola_kpi_finanziari(pivot, mesi_sel, schema_config=None):
     """
     if pivot is None or not mesi_sel:
         return {}
-    cols = [c for c in mesi_sel if c in pivot.columns and c not in ('TOTALE', '_tipo', '_cod')]
+    cols = [c for c in mesi_sel if c in get_mesi_disponibili(pivot)]
     if not cols:
         return {}
 
@@ -532,11 +1179,14 @@ def calcola_kpi_finanziari(pivot, mesi_sel, schema_config=None):
 def calcola_trend(pivot, voce, n_mesi=6):
     if pivot is None or voce not in pivot.index:
         return None
-    mesi_ord  = sorted([c for c in pivot.columns if c not in ('TOTALE', '_tipo', '_cod')])
+    mesi_ord  = get_mesi_disponibili(pivot)
     mesi_used = mesi_ord[-n_mesi:] if len(mesi_ord) >= n_mesi else mesi_ord
     if len(mesi_used) < 2:
         return None
-    vals = [_safe_scalar(pivot.loc[voce, m]) for m in mesi_used]
+    if isinstance(pivot, CEResult):
+        vals = [pivot.valore(voce, m) for m in mesi_used]
+    else:
+        vals = [_safe_scalar(pivot.loc[voce, m]) for m in mesi_used]
     media = float(np.mean(vals))
     std   = float(np.std(vals))
     last3 = vals[-3:] if len(vals) >= 3 else vals
@@ -555,13 +1205,22 @@ def calcola_trend(pivot, voce, n_mesi=6):
 def calcola_statistiche_mensili(pivot):
     if pivot is None:
         return {}
-    mesi = [c for c in pivot.columns if c not in ('TOTALE', '_tipo', '_cod')]
+    mesi = get_mesi_disponibili(pivot)
+    tipizzato = isinstance(pivot, CEResult)
+    if tipizzato:
+        valori = np.nan_to_num(pivot.periodo(mesi), nan=0.0)
     result = {}
     for voce in pivot.index:
-        tipo = _safe_str(pivot.loc[voce, '_tipo']) if '_tipo' in pivot.columns else 'contabile'
-        if tipo == 'separatore':
-            continue
-        vals = [_safe_scalar(pivot.loc[voce, m]) for m in mesi if m in pivot.columns]
+        if tipizzato:
+            r = pivot.riga(voce)
+            if pivot.tipi[r] == 'separatore':
+                continue
+            vals = valori[r].tolist()
+        else:
+            tipo = _safe_str(pivot.loc[voce, '_tipo']) if '_tipo' in pivot.columns else 'contabile'
+            if tipo == 'separatore':
+                continue
+            vals = [_safe_scalar(pivot.loc[voce, m]) for m in mesi if m in pivot.columns]
         if not vals:
             continue
         media = float(np.mean(vals))
@@ -579,7 +1238,7 @@ def calcola_ebitda_bridge(pivot, mesi_att, mesi_prec, schema_config=None):
     if pivot is None:
         return {}
     def get_period(mesi):
-        cols = [c for c in mesi if c in pivot.columns and c not in ('TOTALE', '_tipo', '_cod')]
+        cols = [c for c in mesi if c in get_mesi_disponibili(pivot)]
         def s(role, kw): return _sum_voce(pivot, (_find_voce_by_role(pivot, schema_config, role) if schema_config else None) or _find_voce_keywords(pivot, kw), cols)
         return {
             'ricavi':    s('ricavi',    ['ricav','fattur']),
@@ -0,0 +1,88 @@
+"""upload_cache.py — Cache su disco dei file caricati, indirizzata per contenuto.
+
+Chiave = SHA-256 dei byte caricati + tipo di file (df_piano, df_db, df_ricl).
+Valore = il DataFrame già pulito e tipizzato, in formato colonnare Arrow/Feather:
+ricaricare lo stesso file (anche dopo un riavvio del server) costa una lettura
+binaria invece del parsing testuale. LRU con limite di spazio su disco.
+"""
+import os
+import pandas as pd
+from services.data_utils import VERSIONE_PIPELINE
+
+try:
+    import pyarrow  # noqa: F401  (dipendenza di streamlit: Feather = Arrow IPC)
+    _ARROW_OK = True
+except Exception:
+    _ARROW_OK = False
+
+# Segue la versione della pipeline di pulizia/tipizzazione: le voci scritte
+# da una pipeline precedente non vengono più trovate (e l'LRU le rimuove)
+_VERSIONE = 'v{}'.format(VERSIONE_PIPELINE)
+
+CACHE_DIR = os.environ.get(
+    'AI_MANAGER_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'ai-manager', 'uploads')
+)
+MAX_BYTES = int(os.environ.get('AI_MANAGER_CACHE_MAX_MB', '2048')) * 1024 * 1024
+
+
+def _path(digest, tipo):
+    return os.path.join(CACHE_DIR, '{}_{}_{}.feather'.format(_VERSIONE, tipo, digest))
+
+
+def carica_da_cache(digest, tipo):
+    """DataFrame in cache per (digest, tipo), None se assente o illeggibile."""
+    if not _ARROW_OK or not digest:
+        return None
+    path = _path(digest, tipo)
+    if not os.path.exists(path):
+        return None
+    try:
+        df = pd.read_feather(path)
+        os.utime(path)   # LRU: l'mtime è l'ultimo accesso
+        return df
+    except Exception:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+
+def salva_in_cache(digest, tipo, df):
+    """Scrive il frame in cache (scrittura atomica) e applica il limite di spazio."""
+    if not _ARROW_OK or not digest or df is None or df.empty:
+        return False
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = _path(digest, tipo)
+        tmp  = path + '.tmp'
+        df.reset_index(drop=True).to_feather(tmp)
+        os.replace(tmp, path)
+        _evict()
+        return True
+    except Exception:
+        return False
+
+
+def _evict():
+    """Rimuove le voci usate meno di recente finché la cache supera MAX_BYTES."""
+    try:
+        entries = []
+        for name in os.listdir(CACHE_DIR):
+            if not name.endswith('.feather'):
+                continue
+            p  = os.path.join(CACHE_DIR, name)
+            st = os.stat(p)
+            entries.append((st.st_mtime, st.st_size, p))
+    except OSError:
+        return
+    totale = sum(e[1] for e in entries)
+    for _, size, p in sorted(entries):
+        if totale <= MAX_BYTES:
+            break
+        try:
+            os.remove(p)
+            totale -= size
+        except OSError:
+            pass
@@ -0,0 +1,30 @@
+"""Accodamento di un nuovo estratto al DB contabile: riconoscimento dei duplicati."""
+import pandas as pd
+
+from services.riclassifica import accoda_movimenti
+
+
+def test_stessi_movimenti_con_date_scritte_diversamente_sono_duplicati():
+    db = pd.DataFrame({
+        'Data':        ['05/01/2024', '20/01/2024', '03/02/2024'],
+        'Conto':       ['700', '701', '700'],
+        'Importo':     [10.0, -4.5, 7.25],
+        'Descrizione': ['Fattura 1', 'Nota 2', 'Fattura 3'],
+    })
+    # Lo stesso estratto riesportato da Excel: date come timestamp testuali
+    nuovi = db.assign(Data=['2024-01-05 00:00:00', '2024-01-20 00:00:00', '2024-02-03 00:00:00'])
+    ledger, esito = accoda_movimenti(db, nuovi)
+    assert esito['duplicati'] == len(nuovi)
+    assert esito['nuovi'] == 0
+    assert len(ledger) == len(db)
+
+
+def test_movimenti_nuovi_accodati():
+    db = pd.DataFrame({'Data': ['05/01/2024'], 'Conto': ['700'], 'Importo': [10.0]})
+    nuovi = pd.DataFrame({'Data': ['2024-01-05', '2024-03-01'], 'Conto': ['700', '700'],
+                          'Importo': [10.0, 3.0]})
+    ledger, esito = accoda_movimenti(db, nuovi)
+    assert esito['duplicati'] == 1
+    assert esito['nuovi'] == 1
+    assert esito['mesi'] == [202403]
+    assert len(ledger) == 2
@@ -0,0 +1,49 @@
+"""Caricamento multiplo: l'errore di un file non blocca gli altri."""
+import io
+import zipfile
+
+import pytest
+
+from services import data_utils
+from services.data_utils import smart_load_batch
+
+
+def _file(raw, nome):
+    f = io.BytesIO(raw)
+    f.name = nome
+    return f
+
+
+def _rifiuta_marzo(df):
+    # Modulo importabile: la funzione arriva ai processi del pool
+    if df['Data'].str.contains('/03/').any():
+        raise ValueError('file malformato')
+    return df
+
+
+def _zip_mensile():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for mese in (1, 2, 3):
+            zf.writestr('db_{:02d}.csv'.format(mese), ''.join(
+                ['Data;Conto;Importo\n'] +
+                ['{:02d}/{:02d}/2024;700;1,00\n'.format(g, mese) for g in range(1, 6)]))
+    return _file(buf.getvalue(), 'export.zip')
+
+
+@pytest.mark.parametrize('processi', [1, 3])
+def test_errore_di_un_file_registrato_nel_suo_stato(monkeypatch, processi):
+    monkeypatch.setattr(data_utils, 'MAX_PROCESSI', processi)
+    df, stati = smart_load_batch([_zip_mensile()], trasforma=_rifiuta_marzo)
+    esiti = {s['File']: s['Esito'] for s in stati}
+    assert esiti['db_01.csv'] == 'OK' and esiti['db_02.csv'] == 'OK'
+    assert esiti['db_03.csv'].startswith('Errore')
+    assert len(df) == 10
+    assert sorted(df['File'].unique()) == ['db_01.csv', 'db_02.csv']
+
+
+def test_trasformazione_non_trasferibile_al_pool(monkeypatch):
+    monkeypatch.setattr(data_utils, 'MAX_PROCESSI', 3)
+    df, stati = smart_load_batch([_zip_mensile()], trasforma=lambda df: df)
+    assert df is None
+    assert len(stati) == 3 and all(s['Esito'].startswith('Errore') for s in stati)
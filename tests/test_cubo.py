@@ -0,0 +1,56 @@
+"""Cubo conti × mesi: aggiornamenti incrementali uguali a una ricostruzione completa."""
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from services.riclassifica import (
+    prepara_ledger, cubo_conti, accoda_movimenti, _aggrega_cubo, _chiave_cubo, _MEMO_CUBI,
+)
+
+
+def _ledger(n, seed, mesi=(1, 2, 3), conti=20):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Data':    ['{:02d}/{:02d}/2024'.format(g, m) for g, m in
+                    zip(rng.integers(1, 29, n), rng.choice(mesi, n))],
+        'Conto':   ['{}'.format(700 + c) for c in rng.integers(0, conti, n)],
+        'Importo': np.round(rng.normal(0, 1000, n), 2),
+        'Descrizione': ['Mov {}'.format(i) for i in rng.integers(0, 10**9, n)],
+    })
+
+
+def _ordina(cubo):
+    return cubo.sort_index()
+
+
+def test_accodamento_incrementale_uguale_a_ricostruzione():
+    db = prepara_ledger(_ledger(500, 1))
+    cubo_conti(db)   # cubo del ledger esistente in memoria
+    # Nuovi movimenti: conti e mesi nuovi, più alcune righe già presenti
+    nuovi = pd.concat([_ledger(200, 2, mesi=(3, 4, 6), conti=25), _ledger(500, 1).head(30)],
+                      ignore_index=True)
+    ledger, esito = accoda_movimenti(db, nuovi)
+    assert esito['duplicati'] == 30
+    assert _chiave_cubo(ledger) in _MEMO_CUBI   # cubo ottenuto come delta
+    assert_frame_equal(_ordina(cubo_conti(ledger)), _ordina(_aggrega_cubo(ledger)),
+                       check_exact=False, rtol=0, atol=1e-6)
+
+
+def test_rettifiche_come_delta_uguali_a_righe_accodate():
+    raw = _ledger(500, 3)
+    db = prepara_ledger(raw)
+    rettifiche = [
+        {'conto': '705', 'mese': '2024-02', 'importo': 150.0},
+        {'conto': '999', 'mese': '2024-07', 'importo': -40.0},   # conto e mese nuovi
+        {'conto': '701', 'mese': '2024-01', 'importo': 10.0, 'attiva': False},
+    ]
+    attive = [r for r in rettifiche if r.get('attiva', True)]
+    righe = pd.DataFrame({
+        'Data':    ['15/{}/{}'.format(r['mese'][5:], r['mese'][:4]) for r in attive],
+        'Conto':   [r['conto'] for r in attive],
+        'Importo': [r['importo'] for r in attive],
+        'Descrizione': ['Rettifica'] * len(attive),
+    })
+    atteso = _aggrega_cubo(prepara_ledger(pd.concat([raw, righe], ignore_index=True)))
+    assert_frame_equal(_ordina(cubo_conti(db, rettifiche)), _ordina(atteso),
+                       check_exact=False, rtol=0, atol=1e-6)
@@ -0,0 +1,48 @@
+"""Excel con più fogli: lettura parallela uguale a quella sequenziale."""
+import io
+
+import openpyxl
+import pytest
+from pandas.testing import assert_frame_equal
+
+from services import data_utils
+from services.data_utils import smart_load
+
+
+def _workbook():
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    for mese in (1, 2, 3):
+        ws = wb.create_sheet('M{}'.format(mese))
+        ws.append(['Data', 'Conto', 'Importo'])
+        for g in range(1, 6):
+            ws.append(['{:02d}/{:02d}/2024'.format(g, mese), 700 + g, g * 10.5])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def _file(raw, nome='db.xlsx'):
+    f = io.BytesIO(raw)
+    f.name = nome
+    return f
+
+
+@pytest.mark.parametrize('processi', [1, 3])
+def test_fogli_multipli(monkeypatch, processi):
+    monkeypatch.setattr(data_utils, 'MAX_PROCESSI', processi)
+    raw = _workbook()
+    df = smart_load(_file(raw), fogli=['M1', 'M2', 'M3'])
+    assert len(df) == 15
+    assert list(df['Foglio'].unique()) == ['M1', 'M2', 'M3']
+    assert df['Conto'].iloc[0] == '701' and df['Importo'].iloc[0] == '10.5'
+
+
+def test_pool_e_sequenziale_uguali(monkeypatch):
+    raw = _workbook()
+    monkeypatch.setattr(data_utils, 'MAX_PROCESSI', 3)
+    parallelo = data_utils._leggi_fogli(raw, ['M1', 'M2', 'M3'], True)
+    monkeypatch.setattr(data_utils, 'MAX_PROCESSI', 1)
+    sequenziale = data_utils._leggi_fogli(raw, ['M1', 'M2', 'M3'], True)
+    for a, b in zip(parallelo, sequenziale):
+        assert_frame_equal(a, b)
@@ -0,0 +1,67 @@
+"""Formule dello schema CE: AST sicuro, ordine di dipendenza, cicli, valori non finiti."""
+import numpy as np
+import pandas as pd
+
+from services.formule import analizza_formula, ordina_formule, valuta_formula
+from services.riclassifica import compila_schema, _applica_schema_con_totali
+
+MESI = [202401, 202402]
+
+
+def _pivot(righe):
+    """{label: [valori mesi]} → pivot contabile con TOTALE."""
+    df = pd.DataFrame.from_dict(righe, orient='index', columns=MESI, dtype=float)
+    df['TOTALE'] = df.sum(axis=1)
+    return df
+
+
+def test_nodi_non_ammessi_rifiutati():
+    for formula in ('__import__("os")', 'abs(A)', '(1).real', 'A if A else 1', '[A]', '"testo"'):
+        analisi = analizza_formula(formula, {'A': 0})
+        assert analisi['codice'] is None and analisi['errore'], formula
+        assert np.array_equal(valuta_formula(analisi, {'A': np.ones(2)}, 2), np.zeros(2))
+
+
+def test_nome_non_definito_rifiutato():
+    analisi = analizza_formula('A + B', {'A': 0})
+    assert analisi['codice'] is None
+    assert 'B' in analisi['errore']
+
+
+def test_codici_con_prefisso_comune():
+    analisi = analizza_formula('A10 - A1 + A1.1', {'A1': 0, 'A10': 1, 'A1.1': 2})
+    assert analisi['errore'] is None
+    assert sorted(analisi['riferimenti']) == ['A1', 'A1.1', 'A10']
+    valori = {'A1': np.array([1.0, 2.0]), 'A10': np.array([10.0, 20.0]), 'A1.1': np.array([0.5, 0.5])}
+    assert valuta_formula(analisi, valori, 2).tolist() == [9.5, 18.5]
+
+
+def test_divisione_per_zero_vale_zero():
+    analisi = analizza_formula('A / B', {'A': 0, 'B': 1})
+    valori = {'A': np.array([6.0, 6.0]), 'B': np.array([0.0, 3.0])}
+    assert valuta_formula(analisi, valori, 2).tolist() == [0.0, 2.0]
+
+
+def test_ordine_topologico_e_cicli():
+    ordine, in_ciclo = ordina_formule({0: {2}, 1: set(), 2: {1}, 3: {4}, 4: {3}, 5: {3}})
+    assert ordine == [1, 2, 0]
+    assert sorted(in_ciclo) == [3, 4, 5]
+
+
+def test_riferimento_in_avanti_e_ciclo_nello_schema():
+    schema = {
+        'R':  {'tipo': 'contabile', 'ordine': 1},
+        'M':  {'tipo': 'formula',   'ordine': 2, 'formula': 'F2 * 2'},   # F2 viene dopo
+        'F2': {'tipo': 'formula',   'ordine': 3, 'formula': 'R / 2'},
+        'X':  {'tipo': 'formula',   'ordine': 4, 'formula': 'Y + 1'},
+        'Y':  {'tipo': 'formula',   'ordine': 5, 'formula': 'X + 1'},
+    }
+    label_map = {'R': 'Ricavi'}
+    comp = compila_schema(schema, label_map)
+    cicli = [e for e in comp['errori_formule'] if 'circolare' in e[1]]
+    assert len(cicli) == 1 and set(cicli[0][0].split(', ')) == {'X', 'Y'}
+
+    ce = _applica_schema_con_totali(_pivot({'Ricavi': [100.0, 40.0]}), schema, label_map)
+    assert ce.valore('F2', 202401) == 50.0
+    assert ce.valore('M', 202401) == 100.0 and ce.valore('M', 202402) == 40.0
+    assert ce.valore('X', 202401) == 0.0 and ce.valore('Y', 202402) == 0.0
@@ -0,0 +1,32 @@
+"""Importi del caricamento a blocchi: un solo separatore decimale per file."""
+import io
+
+import pandas as pd
+
+from services.data_utils import smart_load_stream
+from services.riclassifica import prepara_ledger
+
+
+def _file(testo, nome='db.csv'):
+    f = io.BytesIO(testo.encode('utf-8'))
+    f.name = nome
+    return f
+
+
+def test_separatore_decimale_deciso_sul_primo_blocco():
+    # Primo blocco in formato US; il secondo ha solo valori ambigui ('1.234'),
+    # che da soli verrebbero letti come migliaia all'italiana
+    righe = ['Data;Conto;Importo']
+    righe += ['0{}/01/2024;700;1,234.50'.format(i) for i in range(1, 6)]
+    righe += ['0{}/02/2024;700;1.234'.format(i) for i in range(1, 6)]
+    df = smart_load_stream(_file('\n'.join(righe) + '\n'), chunksize=5, trasforma=prepara_ledger)
+    assert df is not None and len(df) == 10
+    assert df.attrs['decimale'] == '.'
+    assert df['_saldo_num'].tolist() == [1234.5] * 5 + [1.234] * 5
+
+
+def test_decimale_imposto_dagli_attrs():
+    db = pd.DataFrame({'Data': ['01/01/2024'], 'Conto': ['700'], 'Importo': ['1.234']})
+    assert prepara_ledger(db)['_saldo_num'].tolist() == [1234.0]
+    db.attrs['decimale'] = '.'
+    assert prepara_ledger(db)['_saldo_num'].tolist() == [1.234]
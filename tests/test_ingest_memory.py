@@ -0,0 +1,39 @@
+"""Memoria del caricamento CSV: il buffer di byte va al parser senza copie in str/StringIO."""
+import io
+import tracemalloc
+
+from services.data_utils import smart_load, rileva_formato
+
+N_RIGHE = 200_000
+
+
+def _ledger_sintetico():
+    righe = ['Data;Conto;Descrizione;Importo'] + [
+        '{:02d}/{:02d}/2024;{:06d};Fattura n. {} cliente {};{},{:02d}'.format(
+            i % 28 + 1, i % 12 + 1, 700000 + i % 3000, i, i % 977, i % 100000, i % 100)
+        for i in range(N_RIGHE)]
+    return ('\n'.join(righe) + '\n').encode('utf-8')
+
+
+def _picco(fn):
+    tracemalloc.start()
+    try:
+        risultato = fn()
+        return risultato, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_picco_allocazioni_proporzionato_al_file():
+    raw = _ledger_sintetico()
+    f = io.BytesIO(raw)
+    f.name = 'db.csv'
+    plan = rileva_formato(f)
+
+    df, picco = _picco(lambda: smart_load(f, plan=plan))
+
+    assert df is not None and len(df) == N_RIGHE
+    # Decodifica in str + StringIO + buffer del parser costava ~6× il file;
+    # il percorso diretto dai byte resta sotto 3×
+    assert picco < 3 * len(raw), 'picco {:.1f} MB su file di {:.1f} MB'.format(
+        picco / 1e6, len(raw) / 1e6)
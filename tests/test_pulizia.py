@@ -0,0 +1,29 @@
+"""Pulizia di colonne e righe al caricamento."""
+import io
+
+from services.data_utils import smart_load, nuovo_report_pulizia
+
+
+def _file(testo, nome='db.csv'):
+    f = io.BytesIO(testo.encode('utf-8'))
+    f.name = nome
+    return f
+
+
+def test_nomi_colonna_che_collidono_dopo_normalizzazione():
+    testo = 'Data;Conto; Data ;Importo\n' + ''.join(
+        '0{0}/01/2024;700;0{0}/01/2024;10,00\n'.format(i) for i in range(1, 6)) + ';;;\n'
+    report = {}
+    df = smart_load(_file(testo), report=report)
+    assert df is not None
+    assert list(df.columns) == ['Data', 'Conto', 'Data', 'Importo']
+    assert len(df) == 5
+    assert report['righe_vuote'] == 1
+
+
+def test_righe_vuote_rimosse_e_contate():
+    testo = 'Data;Conto;Importo\n01/01/2024;700;1\n;;\n \xa0; ;\n02/01/2024;701;2\n'
+    report = nuovo_report_pulizia()
+    df = smart_load(_file(testo), report=report)
+    assert list(df['Conto'].astype(str)) == ['700', '701']
+    assert report['righe_vuote'] == 2
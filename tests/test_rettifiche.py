@@ -0,0 +1,18 @@
+"""Rettifiche extra-contabili: validazione del mese di competenza."""
+from services.riclassifica import chiave_mese, tabella_rettifiche
+
+
+def test_chiave_mese_rifiuta_mesi_fuori_intervallo():
+    assert chiave_mese('2024-12') == 202412
+    assert chiave_mese(202401) == 202401
+    for mese in ('2024-13', '2024-00', 202413, 202400, '', 'abc'):
+        assert chiave_mese(mese) is None
+
+
+def test_rettifiche_con_mese_non_valido_scartate():
+    tab = tabella_rettifiche([
+        {'conto': '700', 'mese': '2024-13', 'importo': 5},
+        {'conto': '700', 'mese': '2024-03', 'importo': 7},
+    ])
+    assert tab['_mese_key'].tolist() == [202403]
+    assert tab['_saldo_num'].tolist() == [7.0]
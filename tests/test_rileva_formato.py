@@ -0,0 +1,61 @@
+"""Rilevamento del formato CSV: intestazione e separatore con campi tra virgolette."""
+import io
+
+from services.data_utils import rileva_formato, smart_load
+
+
+def _file(testo, nome='db.csv'):
+    f = io.BytesIO(testo.encode('utf-8'))
+    f.name = nome
+    return f
+
+
+def test_importi_tra_virgolette():
+    testo = 'Data;Conto;Importo\n' + ''.join(
+        '0{}/01/2024;700;"12,50"\n'.format(i) for i in range(1, 8))
+    piano = rileva_formato(_file(testo))
+    assert piano['sep'] == ';' and piano['header'] == 0
+    df = smart_load(_file(testo))
+    assert list(df.columns) == ['Data', 'Conto', 'Importo']
+    assert len(df) == 7
+
+
+def test_descrizioni_con_separatore():
+    testo = ('Data;Importo;Descrizione\n'
+             '01/01/2024;100,5;"Fatt. 1; acconto"\n'
+             '02/01/2024;200,00;"Fatt. 2; saldo"\n'
+             '03/01/2024;300,5;Fatt. 3\n'
+             '04/01/2024;12,00;"Nota; credito; parziale"\n')
+    piano = rileva_formato(_file(testo))
+    assert piano['sep'] == ';' and piano['header'] == 0
+    df = smart_load(_file(testo))
+    assert list(df.columns)[:3] == ['Data', 'Importo', 'Descrizione']
+    assert df['Descrizione'].iloc[0] == 'Fatt. 1; acconto'
+
+
+def test_separatore_finale_sulle_righe_dati():
+    testo = 'Data;Conto;Importo\n' + ''.join(
+        '0{}/01/2024;700;10,00;\n'.format(i) for i in range(1, 8))
+    piano = rileva_formato(_file(testo))
+    assert piano['sep'] == ';' and piano['header'] == 0
+    df = smart_load(_file(testo))
+    assert list(df.columns)[:3] == ['Data', 'Conto', 'Importo']
+    assert len(df) == 7
+
+
+def test_colonne_facoltative_vuote():
+    testo = 'Data;Conto;Importo;Note\n' + ''.join(
+        '0{}/01/2024;700;10,00;\n'.format(i) for i in range(1, 8))
+    piano = rileva_formato(_file(testo))
+    assert piano['header'] == 0
+    assert list(smart_load(_file(testo)).columns) == ['Data', 'Conto', 'Importo', 'Note']
+
+
+def test_preambolo_saltato():
+    testo = ('Estratto movimenti;;\n'
+             'Periodo 2024;;\n'
+             'Data;Conto;Importo\n' + ''.join(
+                 '0{}/01/2024;700;10,00\n'.format(i) for i in range(1, 8)))
+    piano = rileva_formato(_file(testo))
+    assert piano['header'] == 2
+    assert list(smart_load(_file(testo)).columns) == ['Data', 'Conto', 'Importo']
@@ -0,0 +1,47 @@
+"""Schema CE compilato in operatore ±1: subtotali e totali calcolati a mano."""
+import numpy as np
+import pandas as pd
+
+from services.riclassifica import _applica_schema_con_totali
+
+MESI = [202401, 202402]
+
+SCHEMA = {
+    'R':   {'tipo': 'contabile',  'ordine': 1},
+    'C':   {'tipo': 'contabile',  'ordine': 2, 'segno': -1},
+    'S1':  {'tipo': 'subtotale',  'ordine': 3},
+    'SEP': {'tipo': 'separatore', 'ordine': 4},
+    'D':   {'tipo': 'contabile',  'ordine': 5, 'segno': -1},
+    'Z':   {'tipo': 'contabile',  'ordine': 6},                       # assente dal pivot
+    'S2':  {'tipo': 'subtotale',  'ordine': 7},
+    'T':   {'tipo': 'totale',     'ordine': 8},
+    'T2':  {'tipo': 'totale',     'ordine': 9, 'voci_include': ['R', 'D']},
+}
+LABELS = {'R': 'Ricavi', 'C': 'Costi', 'D': 'Oneri', 'Z': 'Altro'}
+
+
+def _pivot(righe):
+    df = pd.DataFrame.from_dict(righe, orient='index', columns=MESI, dtype=float)
+    df['TOTALE'] = df.sum(axis=1)
+    return df
+
+
+def test_subtotali_e_totali():
+    pivot = _pivot({'Ricavi': [100.0, 200.0], 'Costi': [30.0, 50.0], 'Oneri': [10.0, 20.0]})
+    ce = _applica_schema_con_totali(pivot, SCHEMA, LABELS)
+    attesi = {
+        'Ricavi': [100.0, 200.0],
+        'Costi':  [-30.0, -50.0],      # segno -1
+        'S1':     [70.0, 150.0],       # R + C
+        'Oneri':  [-10.0, -20.0],
+        'Altro':  [0.0, 0.0],
+        'S2':     [-10.0, -20.0],      # si riparte dopo S1: D + Z
+        'T':      [60.0, 130.0],       # S1 + S2: il totale attraversa i subtotali
+        'T2':     [90.0, 180.0],       # voci_include: R + D (col segno della voce)
+    }
+    for voce, valori in attesi.items():
+        assert [ce.valore(voce, m) for m in MESI] == valori, voce
+        assert ce.valore(voce, 'TOTALE') == sum(valori), voce
+    assert list(ce.tipi) == ['contabile', 'contabile', 'subtotale', 'separatore',
+                             'contabile', 'contabile', 'subtotale', 'totale', 'totale']
+    assert np.isnan(ce.valori[ce.tipi == 'separatore']).all()